@@ -24,9 +24,10 @@ bookmark structure in pdf or djvu files. You can then use the aforementioned
 tools to add the described bookmarks to the pdf or djvu file.
 
 The script includes some rudimentary functionality to extract the bookmarks
-directly from a pdf file (writing to any of the supported text formats). This
-functionality depends on the pdfminer library. Advanced features like
-formatting of the bookmark titles are not supported in the extraction.
+directly from a pdf file (writing to any of the supported text formats). The
+pdf file is read by a built-in reader, which falls back to the pdfminer
+library for files it cannot read, e.g. encrypted files. Advanced features
+like formatting of the bookmark titles are not supported in the extraction.
 
 In addition to converting between the different formats, the script can also
 shift the page numbers associated with the bookmarks. This is useful if you need
@@ -39,7 +40,7 @@ When used as a module from python, this script provides a toolbox for making
 Script Usage
 ============
 
-Usage: bmconverter.py options inputfile [outputfile]
+Usage: bmconverter.py options inputfile [outputfile ...]
 
 
 Command Line Options
@@ -56,7 +57,59 @@ Command Line Options
 
  --pdf FILENAME       Set metadata['pdf'] to the given filename. When used
                       together with the latex output mode, the resulting tex
-                      file will reference the given filename.
+                      file will reference the given filename. With the pdf
+                      output mode, the bookmarks are added to the given pdf
+                      file.
+
+ --djvu FILENAME      Set metadata['djvu'] to the given filename. With the
+                      djvu output mode, the bookmarks are added to the given
+                      djvu file.
+
+ --fsync              Force the output file to the disk before it replaces the
+                      destination. The output is always written to a temporary
+                      file first, so that the destination is never left
+                      partially written.
+
+ --jobs N             Parse the input and format the output in N processes,
+                      for the pdftk, text and csv input formats and the pdftk,
+                      text, csv and latex output formats. The result is the
+                      same as with a single process. If N is 0, one process
+                      per CPU is used.
+ -j N                 Short for --jobs
+
+ --force              Overwrite existing output files without asking
+ -f                   Short for --force
+
+ --no-clobber         Never overwrite existing output files. It is an error if
+                      an output file exists.
+ -n                   Short for --no-clobber
+
+ --no-cache           Do not use the cache of the bookmarks read from pdf
+                      files. Normally, the bookmarks of a pdf file are kept in
+                      ~/.cache/bmconverter, and are only read again once the
+                      pdf file changes.
+
+ --batch              Read the bookmarks of many pdf files, which are given
+                      instead of the input and output files, in worker
+                      processes (see --jobs). A directory stands for the pdf
+                      files in it and its subdirectories, and @LIST for the
+                      files named in LIST, one per line (@- for the standard
+                      input). With the mode pdf2out, the bookmarks of every
+                      pdf file are written next to it, under its name with
+                      the extension of the output format.
+
+ --output-dir DIR     With --batch, write the output files to DIR instead,
+                      where a pdf file from a given directory keeps its path
+                      relative to that directory.
+
+ --ndjson FILE        With --batch, write the bookmarks of all pdf files to
+                      FILE ('-' for the standard output) instead, one line of
+                      JSON per pdf file, e.g. {"file": "a.pdf", "bookmarks":
+                      [{"level": 1, "title": "Intro", ...}]}. For a file that
+                      cannot be read, "error" gives the reason instead of
+                      "bookmarks". --mode is not used.
+
+ --timeout SECONDS    With --batch, give up on a pdf file after SECONDS.
 
  --help               Displays full help
  -h                   Short for -help
@@ -65,8 +118,41 @@ In the mode option, 'in' and 'out' can be any of the supported formats:
 'xml', 'text', 'pdftk', 'csv', 'djvused', 'latex', or 'html'
 
 Additionally, 'in' can be 'pdf', in which case the bookmarks are read directly
-from the given pdf file. The pdfminer library must be installed for this to
-work.
+from the given pdf file. The pdfminer library is only needed for the pdf
+files that the built-in reader cannot read (e.g. encrypted files).
+
+'in' can also be 'djvu', to read the bookmarks directly from the given
+(bundled, or the index file of an indirect) djvu file, without djvused.
+
+'out' can be 'pdf' as well, to add the bookmarks to the pdf file given with
+--pdf (or to the pdf file that they were read from). Without an output
+file, they are added to that pdf file itself, which is very fast, as the
+bookmarks are appended to the file, without rewriting it.
+
+'out' can also be 'djvu', to add the bookmarks to the djvu file given with
+--djvu (or to the djvu file that they were read from), without djvused.
+Without an output file, they are added to that djvu file itself.
+
+With --batch, a pdf file that cannot be read, or that takes longer than
+--timeout, is reported, and the others are read nevertheless. The exit
+status is nonzero if any file failed. An example usage is
+'bmconverter.py --batch -j 0 --timeout 60 --ndjson bm.ndjson pdfs/'
+
+'out' can also be a comma-separated list of formats, e.g. 'xml2pdftk,csv'. In
+this case, the input is read only once, one output file must be given for each
+of the formats (in the same order), and the output files are written in
+parallel.
+
+Either file can be given as '-' for the standard input or output, so that the
+script can be used in a pipeline, e.g.
+'pdftk in.pdf dump_data | bmconverter.py -m pdftk2xml - bm.xml'. If no output
+file is given, the input file is overwritten, or, if the input is '-', the
+output is written to the standard output.
+
+Before an existing output file is overwritten, you are asked for confirmation,
+unless --force or --no-clobber is given. If the standard input is not a
+terminal, there is never a question, and existing files are only overwritten
+with --force.
 
 An example usage is 'bmconverter.py --offset 2 --mode xml2text bm.xml bm.txt'
 
@@ -74,6 +160,10 @@ All data is read and written in UTF-8 encoding, with the exception of xml files,
 which are read in the encoding declared in their header, but always written in
 UTF-8
 
+Input files that are compressed with gzip, bz2 or xz are decompressed on the
+fly, and output files whose names end in '.gz', '.bz2' or '.xz' are compressed
+accordingly. xz requires the backports.lzma package.
+
 
 The XML Format
 ==============
@@ -129,8 +219,9 @@ The format is used by the pdfWriteBookmarks tool.
 
 The format of the text file is simple: each bookmark is represented by a single
 line. The bookmark's level is taken from the indentation. There must be exactly
-4 spaces indentation per level. Next is the title of the Bookmark, then a double
-colon, and lastly the pagenumber, optionally followed by a destination.
+4 spaces indentation per level (a tab advances to the next multiple of 4
+columns). Next is the title of the Bookmark, then a double colon, and lastly
+the pagenumber, optionally followed by a destination.
 
 An example bookmark text file is:
 
@@ -150,7 +241,8 @@ Sublevels on page 4 :: 4
     Sub5 :: 10
 Page 11 :: 11
 
-Specifically, each line is matched by the following regular expression:
+Specifically, each line is parsed as if matched by the following regular
+expression, where the double colon is the last one in the line:
 
       (?P<indent>\s*)
       (?P<text>\S.*)   ::  [ ]*  (?P<page>[0-9]*)
@@ -173,7 +265,8 @@ BookmarkTitle: Page1
 BookmarkLevel: 1
 BookmarkPageNumber: 1
 
-Lines not belonging to this structure are discarded.
+The document information (InfoKey/InfoValue) and page label records of a
+pdftk dump are read into the metadata. All other lines are discarded.
 The format is the direct output of the pdftk utility, when run as
 #> pdftk file.pdf dumpdata
 
@@ -317,6 +410,42 @@ For more information, read the Bookmark class documentation.
 Apart from the Bookmark data structure, the module provides importers and
 exporters for all the supported formats.
 
+Each importer read_<format> has a generator counterpart iter_<format> that yields a
+tuple (level, fields) for every bookmark as soon as it is parsed, without
+building the tree. The level of a toplevel bookmark is 1, and fields is a dict
+of Bookmark attributes. Use build_tree to turn such records into a tree.
+All exporters except write_djvused also accept the detached nodes
+yielded by iter_nodes in place of a tree, and write their output as they
+go.
+The escaping of special characters in the pdftk, djvused, csv and latex
+formats is available as escape_<format>, and is undone by
+unescape_<format>.
+The exporters write through an OutputFile, which buffers the output and
+only moves it to its destination once it is complete.
+If the same tree is written repeatedly, set Bookmark.cache_rendered to True
+to keep the escaped fields on the nodes until they change.
+The pdftk, text and csv importers parse large files in several processes if
+given jobs > 1, and iter_parallel does the same for their generators.
+All importers also read from file-like objects, and all exporters write to
+them. convert(data, from_format, to_format, **options) converts a byte
+string, unicode string or file-like object entirely in memory, and
+read_data and write_data do the same for reading and writing alone.
+Compressed input is recognized by all importers, and OutputFile compresses the
+output according to the extension of the file name (see input_blocks).
+The bookmarks read from pdf files are kept in the OutlineCache.
+read_pdf(infilename, backend='pdfminer') reads a pdf file with pdfminer
+only.
+write_pdf adds the bookmarks to the pdf file metadata['pdf'], as an
+incremental update.
+iter_pdf_batch reads many pdf files in worker processes, with a
+timeout per file.
+A damaged outline is read as far as possible, within the OutlineLimits, and
+the warnings about it are in metadata['diagnostics'].
+read_djvu reads the outline of a djvu file itself, which read_djvused reads
+from the output of djvused.
+write_djvu adds the bookmarks to the djvu file metadata['djvu'], without
+djvused.
+
 An example of an interactive usage is shown below. It reads the bookmark
 structure from a text file, sets the appearance of all bookmarks at a level
 deeper than 2 to 'closed' in Acrobat Reader, and write the resulting structure
@@ -342,45 +471,565 @@ inside the python interpretor
 # TODO: improve support for handling metadata
 # TODO: add support for jpdfbookmarks
 
+import os
 import sys
+import time
+import signal
+import json
 import re
 import codecs
+import io
+import binascii
+import zlib
+import struct
+import bz2
+import atexit
+import inspect
+import hashlib
+import cPickle
+import cStringIO
+import mmap
+import tempfile
+import multiprocessing
+import itertools
+import bisect
 from xml.sax import saxutils
 
 
 def warn(msg):
-    """ print a warning message to stderr """
+    """ print a warning message to stderr (in UTF-8, if it is unicode) """
+    if isinstance(msg, unicode):
+        msg = msg.encode('utf-8')
     sys.stderr.write(str(msg))
     sys.stderr.write("\n")
 
 def die(msg):
     """ print a warning message to stderr and exit"""
-    sys.stderr.write(str(msg))
-    sys.stderr.write("\n")
+    warn(msg)
     exit(2)
 
 
+def input_blocks(infilename, blocksize=1048576, start=0, end=None):
+    """Yield the raw content of the file infilename as a sequence of strings
+    of (at most) blocksize bytes. Only the bytes from offset start up to
+    offset end (exclusive, or to the end of the file if end is None) are
+    read.
+
+    Instead of a file name, infilename may be a file-like object, which is
+    read from its current position (start must be 0 then), and is not
+    closed. If its read method returns unicode strings, they are encoded in
+    UTF-8.
+
+    If the content is compressed with gzip, bz2, or xz, the decompressed
+    data is yielded instead. start and end always refer to the file itself,
+    so they cannot be used with compressed files.
+    """
+    blocks = _raw_blocks(infilename, blocksize, start, end)
+    if (start != 0) or (end is not None):
+        for block in blocks:
+            yield block
+        return
+    head = ''
+    for block in blocks:
+        head += block
+        if len(head) >= 10:
+            break
+    compression = compression_of(head)
+    if compression is not None:
+        blocks = decompress_blocks(itertools.chain([head], blocks),
+                                   compression, blocksize)
+    elif head:
+        yield head
+    for block in blocks:
+        yield block
+
+def _raw_blocks(infilename, blocksize, start, end):
+    """Yield the blocks of input_blocks, as they are stored in the file"""
+    if is_filelike(infilename):
+        if start != 0:
+            raise ValueError("A file-like object cannot be read from an "
+                             "offset")
+        while True:
+            if end is not None:
+                blocksize = min(blocksize, end - start)
+                if blocksize <= 0:
+                    break
+            block = infilename.read(blocksize)
+            if not block:
+                break
+            if isinstance(block, unicode):
+                block = block.encode('utf-8')
+            start += len(block)
+            yield block
+        return
+    infile = open(infilename, "rb")
+    try:
+        infile.seek(start)
+        while True:
+            if end is not None:
+                blocksize = min(blocksize, end - infile.tell())
+                if blocksize <= 0:
+                    break
+            block = infile.read(blocksize)
+            if not block:
+                break
+            yield block
+    finally:
+        infile.close()
+
+def input_lines(infilename, blocksize=1048576, start=0, end=None):
+    """Yield the lines of the UTF-8 encoded file infilename (a file name, or
+    a file-like object) as unicode strings, including the line endings.
+    start and end restrict the input to a range of bytes, as in
+    input_blocks.
+
+    The file is read in large blocks, each of which is decoded and split into
+    lines as a whole. This is much faster than iterating over a file opened
+    with codecs.open, and gives the same lines.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    rest = u''
+    for block in input_blocks(infilename, blocksize, start, end):
+        lines = (rest + decoder.decode(block)).splitlines(True)
+        # the last line may be incomplete (or be a '\r' that is followed by
+        # a '\n' in the next block), so it is kept for the next round
+        rest = lines.pop() if lines else u''
+        for line in lines:
+            yield line
+    rest += decoder.decode('', True)
+    for line in rest.splitlines(True):
+        yield line
+
+def input_compression(infilename):
+    """Return the compression of the file infilename (see compression_of),
+    or None. A file-like object must be seekable."""
+    if is_filelike(infilename):
+        position = infilename.tell()
+        head = infilename.read(10)
+        infilename.seek(position)
+    else:
+        infile = open(infilename, "rb")
+        try:
+            head = infile.read(10)
+        finally:
+            infile.close()
+    return compression_of(head)
+
+def is_filelike(obj):
+    """Return True if obj is to be read or written as a file-like object,
+    rather than used as a file name"""
+    return hasattr(obj, 'read') or hasattr(obj, 'write')
+
+
+# Compression
+#
+# Compressed input (gzip, bz2, or xz) is recognized by its magic bytes, and
+# output is compressed if the file name ends in the matching extension. The
+# data is (de)compressed block by block, so that it is never held in memory
+# as a whole.
+
+_compressions = [
+    # (name, extension, magic bytes)
+    ('gzip', '.gz',  re.compile(r'\x1f\x8b')),
+    ('bz2',  '.bz2', re.compile(r'BZh[1-9](1AY&SY|\x17rE8P\x90)')),
+    ('xz',   '.xz',  re.compile(r'\xfd7zXZ\x00')),
+]
+
+def compression_of(head):
+    """Return the name of the compression ('gzip', 'bz2', or 'xz') of data
+    starting with the byte string head (which should be at least 10 bytes
+    long), or None if it is not compressed"""
+    for (name, extension, magic) in _compressions:
+        if magic.match(head):
+            return name
+    return None
+
+def compression_for(outfilename):
+    """Return the name of the compression that is used for the output to the
+    file outfilename, according to its extension, or None"""
+    for (name, extension, magic) in _compressions:
+        if outfilename.lower().endswith(extension):
+            return name
+    return None
+
+def _lzma():
+    """Return the lzma module, which is needed for the xz format"""
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            die("You must install the backports.lzma package to read or "
+                "write xz files")
+    return lzma
+
+def _decompressor(compression):
+    """Return a new decompressor object for the named compression"""
+    if compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    else:
+        return _lzma().LZMADecompressor()
+
+def _compressor(compression):
+    """Return a new compressor object for the named compression"""
+    if compression == 'gzip':
+        return zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        return bz2.BZ2Compressor()
+    else:
+        return _lzma().LZMACompressor()
+
+def decompress_blocks(blocks, compression, blocksize=1048576):
+    """Yield the decompressed data of the sequence of byte strings blocks,
+    which are compressed with the named compression, in strings of at most
+    blocksize bytes. Several concatenated streams (as written by e.g.
+    'cat a.gz b.gz') are decompressed one after the other."""
+    decompressor = _decompressor(compression)
+    first_stream = True
+    for block in blocks:
+        while block:
+            try:
+                data = decompressor.decompress(block)
+                unused = decompressor.unused_data
+            except EOFError:
+                # bz2 refuses any data after the end of its stream
+                data, unused = '', block
+            except Exception, details:
+                # zlib.error, IOError (bz2), or LZMAError
+                if first_stream:
+                    die("The %s compressed input is corrupt: %s"
+                        % (compression, details))
+                warn("Ignored trailing garbage after the %s compressed input"
+                     % compression)
+                return
+            # a block can decompress to many times its size
+            for start in xrange(0, len(data), blocksize):
+                yield data[start:start + blocksize]
+            if not unused:
+                break
+            # the stream has ended, and another one may follow
+            decompressor = _decompressor(compression)
+            first_stream = False
+            block = unused
+    if not _stream_ended(decompressor):
+        warn("The %s compressed input is truncated" % compression)
+
+def _stream_ended(decompressor):
+    """Return False if the decompressor is known to be in the middle of its
+    stream"""
+    if hasattr(decompressor, 'eof'):
+        return decompressor.eof
+    if hasattr(decompressor, 'copy'):
+        # zlib: any data after the end of the stream is left unused
+        probe = decompressor.copy()
+        try:
+            probe.decompress('\0')
+        except zlib.error:
+            return False
+        return bool(probe.unused_data)
+    return True
+
+
+class OutputFile:
+    """ Buffered, atomic output to a UTF-8 encoded file
+
+    All writers produce their output through an OutputFile. The unicode
+    strings passed to write() are collected, and encoded and written in large
+    blocks. The data goes into a temporary file next to the destination,
+    which only replaces the destination when the OutputFile is closed. Thus,
+    an interrupted writer never leaves a partially written file behind.
+
+    If the program ends before the OutputFile is closed, e.g. because a
+    writer died, the temporary file is removed.
+
+    If the class attribute fsync is set to True, the data is forced to the
+    disk before the temporary file is renamed.
+
+    Instead of a file name, outfilename may be a file-like object, into
+    which the output is written directly, as UTF-8 encoded bytes (or as
+    unicode strings, if it is an io.TextIOBase). It is not closed.
+
+    If outfilename ends in '.gz', '.bz2', or '.xz', the output is compressed
+    accordingly, block by block.
+    """
+
+    fsync = False
+
+    def __init__(self, outfilename, buffersize=1048576):
+        """Open a temporary file for the output to outfilename"""
+        self._buffer = []
+        self._buffered = 0 # number of characters in self._buffer
+        self._buffersize = buffersize
+        self._compressor = None
+        if is_filelike(outfilename):
+            self.name = getattr(outfilename, 'name', None)
+            self._tempname = None
+            self._file = outfilename
+            self._encode = not isinstance(outfilename, io.TextIOBase)
+            return
+        self._encode = True
+        compression = compression_for(outfilename)
+        if compression is not None:
+            self._compressor = _compressor(compression)
+        # the destination of a symlink is replaced, not the symlink itself
+        self.name = os.path.realpath(outfilename)
+        handle, self._tempname = tempfile.mkstemp(
+                                 dir=os.path.dirname(self.name),
+                                 prefix=".%s." % os.path.basename(self.name),
+                                 suffix=".tmp")
+        self._file = os.fdopen(handle, "wb", 0)
+        _open_outputs.add(self)
+
+    def write(self, data):
+        """Write the unicode string data (or an ascii str)"""
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._buffersize:
+            self.flush()
+
+    def write_bytes(self, data):
+        """Write the str data as it is (e.g. binary data), after all data
+        written before"""
+        self.flush()
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._file.write(data)
+
+    def flush(self):
+        """Write out the buffered data to the temporary file"""
+        if self._buffer:
+            data = u''.join(self._buffer)
+            if self._encode:
+                data = data.encode('utf-8')
+            if self._compressor is not None:
+                data = self._compressor.compress(data)
+            self._file.write(data)
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+        """Write out all data, and move the temporary file to the
+        destination"""
+        if self._file is None:
+            return
+        if self._tempname is None:
+            # a file-like object, which belongs to the caller
+            self.flush()
+            if hasattr(self._file, 'flush'):
+                self._file.flush()
+            self._file = None
+            return
+        try:
+            self.flush()
+            if self._compressor is not None:
+                self._file.write(self._compressor.flush())
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            # mkstemp creates files that only the owner can read, but the
+            # output should have the same permissions as a regular new file
+            if os.path.exists(self.name):
+                mode = os.stat(self.name).st_mode & 07777
+            else:
+                mode = 0666 & ~_umask
+            os.chmod(self._tempname, mode)
+            self._file.close()
+            self._file = None
+            if os.name == 'nt' and os.path.exists(self.name):
+                # rename cannot replace existing files on Windows
+                os.remove(self.name)
+            os.rename(self._tempname, self.name)
+            _open_outputs.discard(self)
+            if self.fsync and os.name != 'nt':
+                # make the rename itself durable
+                dirhandle = os.open(os.path.dirname(self.name), os.O_RDONLY)
+                try:
+                    os.fsync(dirhandle)
+                finally:
+                    os.close(dirhandle)
+        except:
+            self.discard()
+            raise
+
+    def discard(self):
+        """Close and remove the temporary file, leaving the destination
+        untouched"""
+        self._buffer = []
+        self._buffered = 0
+        if self._tempname is None:
+            self._file = None
+            return
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self._tempname):
+            os.remove(self._tempname)
+        _open_outputs.discard(self)
+
+# the umask is needed to give new output files the default permissions, but
+# can only be read by setting it
+_umask = os.umask(0)
+os.umask(_umask)
+
+# OutputFiles that have not been closed yet, and are discarded at exit
+_open_outputs = set()
+
+def _discard_open_outputs():
+    """Remove the temporary files of all OutputFiles that were not closed"""
+    for output in list(_open_outputs):
+        output.discard()
+
+atexit.register(_discard_open_outputs)
+
+
+# Escape codecs
+#
+# Every format that needs to protect special characters has a pair of
+# escape_<format>/unescape_<format> functions. The escapes are driven by
+# translation tables that are computed once, and return strings that contain
+# nothing to escape (the vast majority of titles) unchanged, after a single
+# regular expression search.
+
+_latex_special_chars = {
+    u'$':  u'\\$',
+    u'%':  u'\\%',
+    u'&':  u'\\&',
+    u'#':  u'\\#',
+    u'_':  u'\\_',
+    u'{':  u'\\{',
+    u'}':  u'\\}',
+    u'[':  u'{[}',
+    u']':  u'{]}',
+    u'"':  u"{''}",
+    u'\\': u'\\textbackslash{}',
+    u'~':  u'\\textasciitilde{}',
+    u'<':  u'\\textless{}',
+    u'>':  u'\\textgreater{}',
+    u'^':  u'\\textasciicircum{}',
+    u'`':  u'{}`',   # avoid ?` and !`
+}
+_latex_table = dict((ord(c), e) for (c, e) in _latex_special_chars.items())
+_latex_escape_re = re.compile(u'[$%&#_{}\\[\\]"\\\\~<>^`]')
+_latex_unescape_re = re.compile(u'|'.join([re.escape(e) for e in
+                       sorted(_latex_special_chars.values(), key=len,
+                              reverse=True)]))
+_latex_unescapes = dict((e, c) for (c, e) in _latex_special_chars.items())
+
 def escape_latex(unistring):
     '''Escape a unicode string for LaTeX. '''
-    _latex_special_chars = {
-        u'$':  u'\\$',
-        u'%':  u'\\%',
-        u'&':  u'\\&',
-        u'#':  u'\\#',
-        u'_':  u'\\_',
-        u'{':  u'\\{',
-        u'}':  u'\\}',
-        u'[':  u'{[}',
-        u']':  u'{]}',
-        u'"':  u"{''}",
-        u'\\': u'\\textbackslash{}',
-        u'~':  u'\\textasciitilde{}',
-        u'<':  u'\\textless{}',
-        u'>':  u'\\textgreater{}',
-        u'^':  u'\\textasciicircum{}',
-        u'`':  u'{}`',   # avoid ?` and !`
-    }
-    return u''.join(_latex_special_chars.get(c, c) for c in unistring)
+    if not _latex_escape_re.search(unistring):
+        return unistring
+    return unistring.translate(_latex_table)
+
+def unescape_latex(unistring):
+    '''Undo escape_latex'''
+    if not _latex_unescape_re.search(unistring):
+        return unistring
+    return _latex_unescape_re.sub(lambda m: _latex_unescapes[m.group()],
+                                  unistring)
+
+
+# xml: the XML special characters, including quotes, as named entities
+_xml_entities = {u'"': u'&quot;', u"'": u'&apos;'}
+_xml_unentities = {u'&quot;': u'"', u'&apos;': u"'"}
+
+def escape_xml(unistring):
+    """Escape a unicode string for XML text or attribute values"""
+    if unistring is None: return u""
+    return saxutils.escape(unistring, _xml_entities)
+
+def unescape_xml(unistring):
+    """Undo escape_xml"""
+    return saxutils.unescape(unistring, _xml_unentities)
+
+
+# pdftk: all non-ascii characters (or non-printables) as XML decimal
+# entities, and the XML special characters except ' as named entities
+_pdftk_table = dict((i, u'&#%i;' % i) for i in range(32) + [127])
+_pdftk_table.update({ord(u'&'): u'&amp;', ord(u'<'): u'&lt;',
+                     ord(u'>'): u'&gt;', ord(u'"'): u'&quot;'})
+_pdftk_escape_re = re.compile(u'[^\\x20-\\x7e]|[&<>"]')
+_pdftk_unescape_re = re.compile(r'&(?:#([0-9]+)|(quot|apos|amp|lt|gt));')
+_pdftk_entities = {'quot': u'"', 'apos': u"'", 'amp': u'&', 'lt': u'<',
+                   'gt': u'>'}
+
+def escape_pdftk(unistring):
+    """Receive and return unicode string, convert all non-ascii characters
+    (or non-printables) to XML decimal entities"""
+    if unistring is None: return u""
+    if not _pdftk_escape_re.search(unistring):
+        return unistring
+    return unistring.translate(_pdftk_table).encode('ascii',
+                                         'xmlcharrefreplace').decode('ascii')
+
+def unescape_pdftk(unistring):
+    """Return the un-escaped unicode string for the given pdftk value"""
+    def replace(match):
+        """Return the un-escaped replacement for the entity matched"""
+        if match.group(1) is not None:
+            return unichr(int(match.group(1)))
+        return _pdftk_entities[match.group(2)]
+    if u'&' not in unistring:
+        return unistring
+    return _pdftk_unescape_re.sub(replace, unistring)
+
+
+# csv: all nonprintable characters (ascii < 32) and the characters [\;"'] are
+# replaced by '\HH', where HH is the two digit ascii hex code (in upper case)
+# for that character.
+_csv_table = dict((i, u'\\%02X' % i) for i in range(32) + map(ord, u'\\;"\''))
+_csv_escape_re = re.compile(u'[\\x00-\\x1f\\\\;"\']')
+_csv_unescape_re = re.compile(r'\\([0-9A-Fa-f]{2})')
+
+def escape_csv(unistring):
+    """Apply the escape scheme used in the csv"""
+    if not _csv_escape_re.search(unistring):
+        return unistring
+    return unistring.translate(_csv_table)
+
+def unescape_csv(unistring):
+    """Undo the escape scheme used in the csv"""
+    if unistring is None: return None
+    if u'\\' not in unistring:
+        return unistring
+    return _csv_unescape_re.sub(lambda m: unichr(int(m.group(1), 16)),
+                                unistring)
+
+
+# djvused: all non-ascii characters (or non-printables) as octal-escaped
+# UTF-8, and the double quote and the backslash as \" and \\
+_djvused_bytes = dict((chr(i), '\\%03o' % i)
+                      for i in range(32) + range(127, 256))
+_djvused_bytes['"'] = '\\"'
+_djvused_bytes['\\'] = '\\\\'
+_djvused_escape_re = re.compile(u'[^\\x20-\\x7e]|["\\\\]')
+_djvused_bytes_re = re.compile(r'[\x00-\x1f\x7f-\xff"\\]+')
+_djvused_unescape_re = re.compile(r'\\([0-7]{3}|["\\])')
+
+def escape_djvused(unistring):
+    """Receive and return unicode string, convert all non-ascii characters
+    (or non-printables) to octal-escaped UTF-8"""
+    if unistring is None: return u""
+    if not _djvused_escape_re.search(unistring):
+        return unistring
+    return _djvused_bytes_re.sub(
+                lambda m: ''.join([_djvused_bytes[b] for b in m.group()]),
+                unistring.encode('utf-8')).decode('ascii')
+
+def unescape_djvused(unistring):
+    """Receive and return unicode string, unescape all octal-escaped UTF-8
+    characters"""
+    def replace(match):
+        """Return the byte for the escape sequence matched"""
+        if len(match.group(1)) == 1:
+            return match.group(1)
+        return chr(int(match.group(1), 8))
+    if u'\\' not in unistring:
+        return unistring
+    return _djvused_unescape_re.sub(replace,
+                                    unistring.encode('utf-8')).decode('utf-8')
 
 
 class Bookmark:
@@ -493,7 +1142,9 @@ class Bookmark:
     '''
     colorpattern = re.compile(_colorpattern_str, re.X)
     destpattern = re.compile(_destpattern_str, re.X)
+    cache_rendered = False # keep the results of rendered(), see there
     def __init__(self):
+        self.__dict__['_rendered'] = {} # field name => {codec => value}
         self.action = None
         self._level = 0
         self.title  = u""
@@ -517,6 +1168,9 @@ class Bookmark:
                         # int numbering the iteration.
         self._iteritem = None # the node that the currently running iteration
                               # that started from self is at.
+        self._iterstack = None # for iterations started from the root: list
+                               # of [node, index of next child] for the nodes
+                               # on the path to self._iteritem
         self._delete = False
 
     def __setattr__(self, name, value):
@@ -567,8 +1221,25 @@ class Bookmark:
                 warn(self._colorpattern_str)
                 warn("Not set.")
                 return None
+        if name in self._rendered:
+            del self._rendered[name]
         self.__dict__[name] = value
 
+    def rendered(self, name, codec):
+        """Return codec(value) for the value of the attribute name, e.g.
+        node.rendered('title', escape_latex).
+
+        If cache_rendered is True (on the class, or on the node), the result
+        is stored on the node, and returned again as long as the attribute is
+        not changed. This saves the escaping when an unchanged tree is written
+        repeatedly, or in several formats."""
+        if not self.cache_rendered:
+            return codec(self.__dict__[name])
+        cache = self._rendered.setdefault(name, {})
+        if codec not in cache:
+            cache[codec] = codec(self.__dict__[name])
+        return cache[codec]
+
     def level(self):
         """Return the level this bookmark is in"""
         return self._level
@@ -724,6 +1395,23 @@ class Bookmark:
             startnode """
             node._seen[id(startnode)] = startnode._seen[id(startnode)]
 
+        if self._iteritem is None and self.is_root():
+            # iterations over the whole tree keep the path to the current
+            # node on a stack, which makes them linear in the number of nodes
+            self._iteritem = self
+            self._iterstack = [[self, 0]]
+        if self._iterstack is not None:
+            while self._iterstack:
+                entry = self._iterstack[-1]
+                node, index = entry
+                if index < len(node._children):
+                    entry[1] = index + 1
+                    self._iteritem = node._children[index]
+                    self._iterstack.append([self._iteritem, 0])
+                    return self._iteritem
+                self._iterstack.pop()
+            self.reset()
+            raise StopIteration
         if self._iteritem is None:
             # start a new iteration run
             self._seen[id(self)] = self._seen.setdefault(id(self), 0) + 1
@@ -750,6 +1438,7 @@ class Bookmark:
         """Reset the traversion status of the node if it is halfway through an
         iteration run, so that a new iteration can restart"""
         self._iteritem = None
+        self._iterstack = None
 
     def shift_pagenumber(self, offset):
         """Shift the pagenumbers in the bookmark tree below this node by the
@@ -875,13 +1564,345 @@ class Bookmark:
             newnode.set_child(-1, child.copy())
         return newnode
 
+def build_tree(records):
+    """Build a bookmark tree from an iterable of (level, fields) tuples, as
+    yielded by the iter_* functions, and return its root node. The records
+    must be in preorder, with toplevel bookmarks at level 1. The fields are a
+    dict that maps Bookmark attribute names to the values they are set to.
+    """
+    root = Bookmark()
+    current_node = root
+    for (level, fields) in records:
+        while (current_node.level() >= level) and not current_node.is_root():
+            current_node = current_node.parent()
+        current_node = current_node.newchild()
+        for name, value in fields.iteritems():
+            setattr(current_node, name, value)
+    return root
+
+
+def iter_nodes(records, offset=0):
+    """Yield a Bookmark node for every (level, fields) record in records, as
+    yielded by the iter_* functions, and shift its page number by offset.
+
+    The nodes are not linked into a tree: each one only knows its level.
+    This is enough for the writers of all formats except djvused (pdftk,
+    text, csv, latex, xml, html), which accept the resulting iterator in place
+    of a root node, and allows to convert into these formats in constant
+    memory.
+    """
+    for (level, fields) in records:
+        node = Bookmark()
+        node._level = level
+        for name, value in fields.iteritems():
+            setattr(node, name, value)
+        if offset != 0 and isinstance(node.page, int):
+            node.page += offset
+        yield node
+
+
+def write_nodes(render, root, write, warnings, jobs=1, args=()):
+    """Call render(nodes, write, warnings, *args) for the bookmarks in root,
+    where root is either a root node, or an iterator over nodes in preorder.
+    This is how the writers of the line-oriented formats (pdftk, text, csv,
+    latex) format the bookmarks: render must pass the formatted text of the
+    given nodes to the function write, and may add messages to the set
+    warnings.
+
+    If jobs is larger than one and root is a root node, the tree is split
+    into chunks of consecutive toplevel bookmarks, which are formatted in
+    jobs processes. The results are passed to write in order, so that the
+    output is the same as if render was called for the whole tree. The
+    processes are started with fork, on systems that do not support it
+    (Windows) the tree is always formatted in a single process.
+    """
+    global _parallel_root
+    if (jobs <= 1) or (os.name == 'nt') or not isinstance(root, Bookmark) \
+    or not root.is_root():
+        render(root, write, warnings, *args)
+        return
+    # split the toplevel bookmarks into chunks with roughly the same number
+    # of nodes, several per process, so that the load is balanced
+    sizes = [len(child) + 1 for child in root.children()]
+    chunksize = max(1, sum(sizes) // (4 * jobs))
+    chunks = []
+    start = 0
+    size = 0
+    for (i, child_size) in enumerate(sizes):
+        size += child_size
+        if size >= chunksize:
+            chunks.append((render, start, i + 1, args))
+            start = i + 1
+            size = 0
+    if start < len(sizes):
+        chunks.append((render, start, len(sizes), args))
+    # the processes inherit the tree, only the chunk boundaries and the
+    # formatted text are passed between them
+    _parallel_root = root
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for (text, chunk_warnings) in pool.imap(_render_chunk, chunks):
+            write(text)
+            warnings.update(chunk_warnings)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _parallel_root = None
+
+# the tree that is formatted by the processes of write_nodes
+_parallel_root = None
+
+def _render_chunk(chunk):
+    """Format the toplevel bookmarks of _parallel_root with the indices start
+    to end (exclusive) and all their children with render, where chunk is the
+    tuple (render, start, end, args). Return the formatted text and the
+    warnings"""
+    (render, start, end, args) = chunk
+    pieces = []
+    warnings = set()
+    render(_preorder(_parallel_root.children()[start:end]), pieces.append,
+           warnings, *args)
+    return (u''.join(pieces), warnings)
+
+def _preorder(nodes):
+    """Yield the given nodes and all their children, in preorder"""
+    stack = list(reversed(nodes))
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children()))
+
+
+def iter_parallel(iterator, infilename, jobs, metadata=None, args=()):
+    """Yield the same records as iterator(infilename, *args), where iterator
+    is iter_csv, iter_text, or iter_pdftk (in the last case, metadata is
+    passed as the first argument), but parse the file in jobs processes.
+
+    The file is split into chunks at the start of toplevel bookmarks, and
+    every chunk is parsed into a list of records by a separate call of the
+    iterator. As a subtree never crosses the start of a toplevel bookmark,
+    the records of the chunks simply follow each other. Warnings refer to
+    the line numbers in the whole file, and are printed in order. The
+    metadata of the chunks (pdftk) is merged as if the file had been parsed
+    in one piece. A file-like object instead of a file name, or a compressed
+    file, is always parsed in a single process.
+    """
+    chunks = []
+    if (jobs > 1) and not is_filelike(infilename) \
+    and (input_compression(infilename) is None):
+        is_toplevel = _toplevel_scanners[iterator.__name__]
+        for (start, end, line_nr) in _toplevel_chunks(infilename, 4 * jobs,
+                                                      is_toplevel, args):
+            chunks.append((iterator, infilename, start, end, line_nr, args))
+    if len(chunks) <= 1:
+        if iterator.__name__ == 'iter_pdftk':
+            args = (metadata,)
+        for record in iterator(infilename, *args):
+            yield record
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for (records, chunk_metadata, messages, status) \
+        in pool.imap(_parse_chunk, chunks):
+            for message in messages:
+                warn(message)
+            if status is not None:
+                # the process died (the reason was its last message)
+                exit(status)
+            if metadata is not None:
+                _merge_metadata(metadata, chunk_metadata)
+            for record in records:
+                yield record
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def _parse_chunk(chunk):
+    """Parse the chunk (iterator, infilename, start, end, line_nr, args) of
+    iter_parallel. Return the list of records, the metadata, the warnings,
+    and the exit status, if the iterator died"""
+    (iterator, infilename, start, end, line_nr, args) = chunk
+    metadata = {}
+    if iterator.__name__ == 'iter_pdftk':
+        args = (metadata,)
+    records = []
+    def parse():
+        for record in iterator(infilename, *args, start=start, end=end,
+                               line_nr=line_nr):
+            records.append(record)
+    # the warnings are passed to iter_parallel, so that they can be printed
+    # in the order of the file
+    (messages, status) = _capture_stderr(parse)
+    return (records, metadata, messages, status)
+
+def _capture_stderr(function):
+    """Call function() in a worker process, and return the tuple (messages,
+    status) of the lines that it wrote to stderr (warnings, and the reason
+    why die() gave up), and of the exit status if it died (else None)"""
+    status = None
+    stderr = sys.stderr
+    sys.stderr = cStringIO.StringIO()
+    try:
+        try:
+            function()
+        except SystemExit, exit_exception:
+            status = exit_exception.code
+    finally:
+        messages = [message for message in sys.stderr.getvalue().splitlines()
+                    if message]
+        sys.stderr = stderr
+    return (messages, status)
+
+def _merge_metadata(metadata, chunk_metadata):
+    """Add the metadata that iter_pdftk stored for a chunk to the metadata
+    of the previous chunks"""
+    for (key, value) in chunk_metadata.items():
+        if key == 'info':
+            metadata.setdefault('info', {}).update(value)
+        elif key == 'pagelabels':
+            metadata.setdefault('pagelabels', []).extend(value)
+        else:
+            metadata[key] = value
+
+# line breaks, as recognized by unicode.splitlines, in UTF-8
+_linebreak_re = re.compile(r'\r\n|[\n\r\x0b\x0c\x1c-\x1e]'
+                           r'|\xc2\x85|\xe2\x80[\xa8\xa9]')
+
+def _toplevel_chunks(infilename, number, is_toplevel, args):
+    """Split the file infilename into (at most) number chunks of similar
+    size, each of which starts with a line for which is_toplevel returns
+    True. Return a list of tuples (start, end, line_nr), where start and end
+    are the byte offsets of a chunk, and line_nr is the number of lines
+    before it (end is None for the last chunk)."""
+    size = os.path.getsize(infilename)
+    if (number <= 1) or (size == 0):
+        return [(0, None, 0)]
+    infile = open(infilename, "rb")
+    try:
+        data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            starts = [0]
+            for i in xrange(1, number):
+                position = max(i * size // number, starts[-1] + 1)
+                start = is_toplevel(data, position, args)
+                if start is None:
+                    break
+                starts.append(start)
+            chunks = []
+            line_nr = 0
+            for (start, end) in zip(starts, starts[1:] + [None]):
+                chunks.append((start, end, line_nr))
+                if end is not None:
+                    line_nr += len(_linebreak_re.findall(data, start, end))
+            return chunks
+        finally:
+            data.close()
+    finally:
+        infile.close()
+
+def _first_line(data, start):
+    """Return the line starting at the byte offset start of data, decoded
+    from UTF-8, or None if it cannot be decoded"""
+    end = data.find('\n', start)
+    if end < 0:
+        end = len(data)
+    try:
+        return data[start:end + 1].decode('utf-8').splitlines(True)[0]
+    except (UnicodeDecodeError, IndexError):
+        return None
+
+def _find_toplevel(data, position, pattern, is_toplevel_line):
+    """Return the offset of the first line at or after position that
+    matches the (bytes) regex pattern and for which is_toplevel_line
+    returns True, or None"""
+    while True:
+        match = pattern.search(data, position - 1)
+        if match is None:
+            return None
+        start = match.start() + 1
+        if is_toplevel_line(data, start):
+            return start
+        position = start + 1
+
+def _csv_toplevel(data, position, args):
+    """Find the next toplevel bookmark for iter_csv (see _find_toplevel)"""
+    def is_toplevel_line(data, start):
+        line = _first_line(data, start)
+        return (line is not None) and bool(_csv_toplevel_re.match(line))
+    return _find_toplevel(data, position, _csv_candidate_re, is_toplevel_line)
+_csv_candidate_re = re.compile(r'\n(?=1;)')
+_csv_toplevel_re = re.compile(r'1;O?B?I?;[^;]*;-?[0-9]+')
+
+def _text_toplevel(data, position, args):
+    """Find the next toplevel bookmark for iter_text (see _find_toplevel)"""
+    levelprefix = (len(args) > 1) and args[1]
+    def is_toplevel_line(data, start):
+        line = _first_line(data, start)
+        if line is None:
+            return False
+        separator = line.rfind(u'::')
+        text = line[:max(separator, 0)].lstrip(u' \t\n\r\f\v')
+        if levelprefix:
+            level, space, text = text.partition(u' ')
+            return (level == u'1') and (text.strip() != u'')
+        return (text != u'') and (len(text) == separator)
+    if levelprefix:
+        pattern = _text_prefix_candidate_re
+    else:
+        pattern = _text_candidate_re
+    return _find_toplevel(data, position, pattern, is_toplevel_line)
+_text_candidate_re = re.compile(r'\n(?=[^ \t\n\r\f\v])')
+_text_prefix_candidate_re = re.compile(r'\n(?=[ \t\f\v]*1 )')
+
+def _pdftk_toplevel(data, position, args):
+    """Find the next toplevel bookmark for iter_pdftk (see _find_toplevel).
+    Only bookmarks whose title and level 1 precede the page number are
+    accepted, so that no information from the preceding lines is needed to
+    parse them."""
+    def is_toplevel_line(data, start):
+        seen = set()
+        for line in data[start:start + 4096].splitlines():
+            key, colon, value = line.partition(':')
+            key = key.strip()
+            if key == 'BookmarkBegin' and not seen:
+                continue
+            elif key == 'BookmarkTitle':
+                seen.add(key)
+            elif key == 'BookmarkLevel':
+                if value.strip() != '1':
+                    return False
+                seen.add(key)
+            elif key == 'BookmarkPageNumber':
+                return len(seen) == 2
+            else:
+                return False
+        return False
+    return _find_toplevel(data, position, _pdftk_candidate_re,
+                          is_toplevel_line)
+_pdftk_candidate_re = re.compile(r'\n(?=BookmarkBegin|BookmarkTitle)')
+
+# the functions that find the start of the toplevel bookmarks, for all
+# iterators that iter_parallel supports
+_toplevel_scanners = {
+    'iter_csv'   : _csv_toplevel,
+    'iter_text'  : _text_toplevel,
+    'iter_pdftk' : _pdftk_toplevel,
+}
+
+
 def usage():
     """Display Program Usage"""
     print """
 bmconverter.py
 (c) 2011 Michael Goerz - This program is provided under the terms of the GPL.
 
-Usage: bmconverter.py options inputfile [outputfile]
+Usage: bmconverter.py options inputfile [outputfile ...]
 
 
 Command Line Options
@@ -899,7 +1920,59 @@ Command Line Options
 
  --pdf FILENAME       Set metadata['pdf'] to the given filename. When used
                       together with the latex output mode, the resulting tex
-                      file will reference the given filename.
+                      file will reference the given filename. With the pdf
+                      output mode, the bookmarks are added to the given pdf
+                      file.
+
+ --djvu FILENAME      Set metadata['djvu'] to the given filename. With the
+                      djvu output mode, the bookmarks are added to the given
+                      djvu file.
+
+ --fsync              Force the output file to the disk before it replaces the
+                      destination. The output is always written to a temporary
+                      file first, so that the destination is never left
+                      partially written.
+
+ --jobs N             Parse the input and format the output in N processes,
+                      for the pdftk, text and csv input formats and the pdftk,
+                      text, csv and latex output formats. The result is the
+                      same as with a single process. If N is 0, one process
+                      per CPU is used.
+ -j N                 Short for --jobs
+
+ --force              Overwrite existing output files without asking
+ -f                   Short for --force
+
+ --no-clobber         Never overwrite existing output files. It is an error if
+                      an output file exists.
+ -n                   Short for --no-clobber
+
+ --no-cache           Do not use the cache of the bookmarks read from pdf
+                      files. Normally, the bookmarks of a pdf file are kept in
+                      ~/.cache/bmconverter, and are only read again once the
+                      pdf file changes.
+
+ --batch              Read the bookmarks of many pdf files, which are given
+                      instead of the input and output files, in worker
+                      processes (see --jobs). A directory stands for the pdf
+                      files in it and its subdirectories, and @LIST for the
+                      files named in LIST, one per line (@- for the standard
+                      input). With the mode pdf2out, the bookmarks of every
+                      pdf file are written next to it, under its name with
+                      the extension of the output format.
+
+ --output-dir DIR     With --batch, write the output files to DIR instead,
+                      where a pdf file from a given directory keeps its path
+                      relative to that directory.
+
+ --ndjson FILE        With --batch, write the bookmarks of all pdf files to
+                      FILE ('-' for the standard output) instead, one line of
+                      JSON per pdf file, e.g. {"file": "a.pdf", "bookmarks":
+                      [{"level": 1, "title": "Intro", ...}]}. For a file that
+                      cannot be read, "error" gives the reason instead of
+                      "bookmarks". --mode is not used.
+
+ --timeout SECONDS    With --batch, give up on a pdf file after SECONDS.
 
  --help               Displays full help
  -h                   Short for -help
@@ -908,14 +1981,51 @@ In the mode option, 'in' and 'out' can be any of the supported formats:
 'xml', 'text', 'pdftk', 'csv', 'djvused', 'latex', or 'html'
 
 Additionally, 'in' can be 'pdf', in which case the bookmarks are read directly
-from the given pdf file. The pdfminer library must be installed for this to
-work.
+from the given pdf file. The pdfminer library is only needed for the pdf
+files that the built-in reader cannot read (e.g. encrypted files).
+
+'in' can also be 'djvu', to read the bookmarks directly from the given
+(bundled, or the index file of an indirect) djvu file, without djvused.
+
+'out' can be 'pdf' as well, to add the bookmarks to the pdf file given with
+--pdf (or to the pdf file that they were read from). Without an output
+file, they are added to that pdf file itself, which is very fast, as the
+bookmarks are appended to the file, without rewriting it.
+
+'out' can also be 'djvu', to add the bookmarks to the djvu file given with
+--djvu (or to the djvu file that they were read from), without djvused.
+Without an output file, they are added to that djvu file itself.
+
+With --batch, a pdf file that cannot be read, or that takes longer than
+--timeout, is reported, and the others are read nevertheless. The exit
+status is nonzero if any file failed. An example usage is
+'bmconverter.py --batch -j 0 --timeout 60 --ndjson bm.ndjson pdfs/'
+
+'out' can also be a comma-separated list of formats, e.g. 'xml2pdftk,csv'. In
+this case, the input is read only once, one output file must be given for each
+of the formats (in the same order), and the output files are written in
+parallel.
+
+Either file can be given as '-' for the standard input or output, so that the
+script can be used in a pipeline, e.g.
+'pdftk in.pdf dump_data | bmconverter.py -m pdftk2xml - bm.xml'. If no output
+file is given, the input file is overwritten, or, if the input is '-', the
+output is written to the standard output.
+
+Before an existing output file is overwritten, you are asked for confirmation,
+unless --force or --no-clobber is given. If the standard input is not a
+terminal, there is never a question, and existing files are only overwritten
+with --force.
 
 An example usage is 'bmconverter.py --offset 2 --mode xml2text bm.xml bm.txt'
 
 All data is read and written in UTF-8 encoding, with the exception of xml files,
 which are read in the encoding declared in their header, but always written in
 UTF-8
+
+Input files that are compressed with gzip, bz2 or xz are decompressed on the
+fly, and output files whose names end in '.gz', '.bz2' or '.xz' are compressed
+accordingly. xz requires the backports.lzma package.
 """
 
 def show_help():
@@ -935,16 +2045,28 @@ def main():
         exit(2)
 
     try:
-        opts, files = getopt.getopt(sys.argv[1:], "hm:o:l",
+        opts, files = getopt.getopt(sys.argv[1:], "hm:o:lj:fn",
                                                  ["help", "mode=", "offset=",
-                                                  "pdf=", "long"])
+                                                  "pdf=", "djvu=", "long",
+                                                  "fsync",
+                                                  "jobs=", "force",
+                                                  "no-clobber", "no-cache",
+                                                  "batch", "output-dir=",
+                                                  "ndjson=", "timeout="])
     except getopt.GetoptError, details:
         die(details)
 
     pdf = None
+    djvu = None
     mode = ""
     offset = 0
     text_long = False
+    jobs = 1
+    clobber = None # overwrite existing files: True, False, or None to ask
+    batch = False
+    output_dir = None
+    ndjson = None
+    timeout = None
     for o, a in opts:
         if o in ("-h", "--help"):
             show_help()
@@ -960,283 +2082,605 @@ def main():
             text_long = True
         if o == "--pdf":
             pdf = a
+        if o == "--djvu":
+            djvu = a
+        if o == "--fsync":
+            OutputFile.fsync = True
+        if o in ("-j", "--jobs"):
+            try:
+                jobs = int(a)
+            except ValueError:
+                die("Jobs must be an integer.")
+            if jobs < 1:
+                jobs = multiprocessing.cpu_count()
+        if o in ("-f", "--force"):
+            clobber = True
+        if o in ("-n", "--no-clobber"):
+            clobber = False
+        if o == "--no-cache":
+            OutlineCache.enabled = False
+        if o == "--batch":
+            batch = True
+        if o == "--output-dir":
+            output_dir = a
+        if o == "--ndjson":
+            ndjson = a
+        if o == "--timeout":
+            try:
+                timeout = float(a)
+            except ValueError:
+                die("Timeout must be a number.")
 
-    # deal with the input- and output file
-    if len(files) < 1:
-        die("You must provide an input file")
-    infilename = files[0]
-    if not os.path.isfile(infilename):
-        die ("The input file '%s' does not exist" % infilename)
-    outfilename = infilename
-    if len(files) < 2:
-        warn ("You did not provide an output file. "
-              +"The input file will be overwritten")
-        answer = raw_input("Do you want to overwrite? Yes [No]: ").lower()
-        if answer != "yes":
-            exit(0)
-    else:
-        outfilename = files[1]
-        if os.path.exists(outfilename):
-            warn("The output filename '%s' already exists." % outfilename)
-            answer = raw_input("Do you want to overwrite? Yes [No]: ").lower()
-            if answer != "yes":
-                exit(0)
+    if batch:
+        _main_batch(files, mode, jobs, timeout, output_dir, ndjson, clobber)
+        return
 
     # parse the mode, to find out what we have to do
-    handlers = {
-        'csv'     : (read_csv,     write_csv),
-        'html'    : (read_html,    write_html),
-        'pdftk'   : (read_pdftk,   write_pdftk),
-        'text'    : (read_text,    write_text),
-        'xml'     : (read_xml,     write_xml),
-        'djvused' : (read_djvused, write_djvused),
-        'latex'   : (read_latex,   write_latex),
-        'pdf'     : (read_pdf,     None),
-    }
+    handlers = dict(formats)
+    # output formats whose writers only need the bookmarks in preorder, so
+    # that they can be fed directly from the input, without building the tree
+    stream_formats = ['pdftk', 'text', 'csv', 'latex', 'xml', 'html']
+    # output formats whose writers can format the tree in several processes,
+    # and input formats that can be parsed in several processes
+    parallel_formats = ['pdftk', 'text', 'csv', 'latex']
+    parallel_readers = ['pdftk', 'text', 'csv']
     from_format = None
-    to_format = None
-    mode_pattern = re.compile(r'([a-z]+)2([a-z]+)')
+    to_formats = []
+    mode_pattern = re.compile(r'([a-z]+)2([a-z]+(,[a-z]+)*)')
     mode_match = mode_pattern.match(mode)
     if mode_match:
         from_format = mode_match.group(1)
-        to_format   = mode_match.group(2)
+        to_formats  = mode_match.group(2).split(',')
     else:
         die("Could not get modes. " \
             + "Did you provide the --mode option correctly?\n" \
             + "The correct format is '--mode in2out', where 'in' and 'out' " \
             + "can be 'xml', 'text', 'pdftk', 'html', 'djvused' or 'csv'.")
-    from_handler = handlers.setdefault(from_format, (None, None))[0]
-    to_handler   = handlers.setdefault(to_format,   (None, None))[1]
+    from_handler = handlers.setdefault(from_format, (None, None, None))[0]
     if from_handler is None:
         warn("No Handler for '%s'" % str(from_format))
         die("Did you provide the --mode option correctly?\n" \
             + "The correct format is '--mode in2out', where 'in' and 'out' " \
             + "can be 'xml', 'text', 'pdftk', 'html', 'djvused', or 'csv'.")
-    if to_handler is None:
-        warn("No Handler for '%s'" % str(to_format))
-        die("Did you provide the --mode option correctly?\n" \
-            + "The correct format is '--mode in2out', where 'in' and 'out' " \
-            + "can be 'xml', 'text', 'pdftk', 'html', 'djvused' or 'csv'.")
+    for to_format in to_formats:
+        if handlers.setdefault(to_format, (None, None, None))[1] is None:
+            warn("No Handler for '%s'" % str(to_format))
+            die("Did you provide the --mode option correctly?\n" \
+                + "The correct format is '--mode in2out', where 'in' and " \
+                + "'out' can be 'xml', 'text', 'pdftk', 'html', 'djvused' " \
+                + "or 'csv'.")
+
+    # deal with the input- and output files
+    if len(files) < 1:
+        die("You must provide an input file")
+    infilename = files[0]
+    if infilename != '-' and not os.path.isfile(infilename):
+        die ("The input file '%s' does not exist" % infilename)
+    # the user can only be asked if the standard input is a terminal, and
+    # not used for the input file
+    interactive = (infilename != '-') and sys.stdin.isatty()
+    if len(files) < 2 and to_formats == ['pdf'] and pdf is not None:
+        # the bookmarks are added to the pdf file itself
+        outfilenames = [pdf]
+        warn("You did not provide an output file. The bookmarks will be "
+             "added to '%s'" % pdf)
+        _confirm_overwrite(pdf, clobber, interactive)
+    elif len(files) < 2 and to_formats == ['djvu'] and djvu is not None:
+        # the bookmarks are added to the djvu file itself
+        outfilenames = [djvu]
+        warn("You did not provide an output file. The bookmarks will be "
+             "added to '%s'" % djvu)
+        _confirm_overwrite(djvu, clobber, interactive)
+    elif len(files) < 2 and len(to_formats) == 1:
+        outfilenames = [infilename]
+        if infilename != '-':
+            warn ("You did not provide an output file. "
+                  +"The input file will be overwritten")
+            _confirm_overwrite(infilename, clobber, interactive)
+    else:
+        outfilenames = files[1:]
+        if len(outfilenames) != len(to_formats):
+            die("You must provide one output file for each output format")
+        if outfilenames.count('-') > 1:
+            die("Only one output can go to the standard output")
+        for outfilename in outfilenames:
+            if outfilename != '-' and os.path.exists(outfilename):
+                warn("The output filename '%s' already exists." % outfilename)
+                _confirm_overwrite(outfilename, clobber, interactive)
+    # '-' stands for the standard input and output
+    if os.name == 'nt':
+        import msvcrt
+        msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+        msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+    if infilename == '-':
+        infilename = sys.stdin
+        if from_format in ['pdf', 'djvu']:
+            # the pdf and djvu parsers need to seek
+            infilename = cStringIO.StringIO(sys.stdin.read())
+    for (i, outfilename) in enumerate(outfilenames):
+        if outfilename == '-':
+            outfilenames[i] = sys.stdout
+    # as the output only replaces the input file once it is complete, this
+    # is possible even if both are the same file. With several output
+    # formats, the tree is built once and shared by all writers, and
+    # formatting in several processes needs the tree, too
+    streaming = (len(to_formats) == 1) and (to_formats[0] in stream_formats) \
+                and not ( (jobs > 1) and (to_formats[0] in parallel_formats) )
 
     # Execute
-    warn("Reading bookmarks in '%s' in %s format" % (infilename, from_format))
-    bm, metadata = from_handler(infilename)
+    if files[0] == '-':
+        warn("Reading bookmarks from the standard input in %s format"
+             % from_format)
+    else:
+        warn("Reading bookmarks in '%s' in %s format"
+             % (infilename, from_format))
+    if streaming:
+        iterator = handlers[from_format][2]
+        metadata = {}
+        if (jobs > 1) and (from_format in parallel_readers):
+            records = iter(iter_parallel(iterator, infilename, jobs,
+                                         metadata))
+        elif from_format in ['pdftk', 'pdf']:
+            records = iter(iterator(infilename, metadata))
+        else:
+            records = iter(iterator(infilename))
+        # parse up to the first bookmark, so that any metadata preceding it is
+        # available when the writer starts
+        try:
+            records = itertools.chain([records.next()], records)
+        except StopIteration:
+            pass
+        bm = iter_nodes(records, offset)
+    elif from_format in parallel_readers:
+        bm, metadata = from_handler(infilename, jobs=jobs)
+    else:
+        bm, metadata = from_handler(infilename)
     if pdf is not None:
         metadata['pdf'] = pdf
+    if djvu is not None:
+        metadata['djvu'] = djvu
     if (offset != 0):
         warn("Shifting page-numbers by %i" % offset)
-        bm.shift_pagenumber(offset)
-    warn("Writing out bookmarks to '%s' in %s format" \
-          % (outfilename, to_format))
-    if to_format == 'text':
-        to_handler(bm, outfilename, metadata, text_long)
+        if not streaming:
+            bm.shift_pagenumber(offset)
+    writers = []
+    for (to_format, outfilename) in zip(to_formats, outfilenames):
+        if outfilename is sys.stdout:
+            warn("Writing out bookmarks to the standard output in %s format"
+                 % to_format)
+        else:
+            warn("Writing out bookmarks to '%s' in %s format" \
+                  % (outfilename, to_format))
+        args = (bm, outfilename, metadata)
+        if to_format == 'text':
+            args += (text_long,)
+        if to_format in parallel_formats:
+            args += (jobs,)
+        writers.append((handlers[to_format][1], args))
+    if len(writers) == 1:
+        to_handler, args = writers[0]
+        to_handler(*args)
     else:
-        to_handler(bm, outfilename, metadata)
+        # every output file is written by a separate process
+        processes = []
+        for (to_handler, args) in writers:
+            process = multiprocessing.Process(target=_run_writer,
+                                              args=(to_handler, args))
+            process.start()
+            processes.append(process)
+        failed = False
+        for process in processes:
+            process.join()
+            if process.exitcode != 0:
+                failed = True
+        if failed:
+            die("Not all output files could be written")
+
+
+def _confirm_overwrite(filename, clobber, interactive):
+    """Exit unless the existing file filename may be overwritten, according
+    to clobber (True: always, False: never, None: ask the user if
+    interactive is True, and never otherwise)"""
+    if clobber is None and interactive:
+        answer = raw_input("Do you want to overwrite? Yes [No]: ")
+        if answer.lower() != "yes":
+            exit(0)
+    elif not clobber:
+        die("Not overwriting '%s'. Use --force to overwrite it." % filename)
 
 
+def _run_writer(to_handler, args):
+    """Call to_handler with args in a process started by main(), removing
+    the temporary output file if the writer fails"""
+    try:
+        to_handler(*args)
+    finally:
+        # processes started by multiprocessing do not run exit handlers
+        _discard_open_outputs()
 
-def read_xml(infilename):
-    """Read in an iText XML file describing the bookmarks, return a tuple
-    (root, {}) where root is a root bookmark node. The root node itself is
-    empty, and contains all the bookmarks as children."""
-    root = Bookmark()
+
+def _main_batch(files, mode, jobs, timeout, output_dir, ndjson, clobber):
+    """Read the bookmarks of the pdf files given by files (see --batch),
+    and write them to an output file per pdf file in the format given by
+    mode, or all to the ndjson file"""
+    to_format = None
+    if ndjson is None:
+        mode_match = re.match(r'pdf2([a-z]+)$', mode)
+        # the pdf and djvu writers add the bookmarks to an existing file,
+        # which a batch does not have
+        if not mode_match or mode_match.group(1) in ('pdf', 'djvu') \
+        or formats.get(mode_match.group(1), (None, None))[1] is None:
+            die("With --batch, the mode must be 'pdf2out', where 'out' can "
+                "be 'xml', 'text', 'pdftk', 'html', 'djvused', 'csv', or "
+                "'latex'. Alternatively, use --ndjson.")
+        to_format = mode_match.group(1)
+    elif mode:
+        die("The options --mode and --ndjson cannot be combined")
+    if len(files) < 1:
+        die("You must provide the input files")
+    outputs = {}
+    skipped = []
+    def tasks():
+        """Yield the pdf files to read, and find their output files"""
+        for (infilename, relname) in _batch_inputs(files):
+            if to_format is None:
+                yield infilename
+                continue
+            extension = _batch_extensions.get(to_format, to_format)
+            if output_dir is None:
+                outfilename = "%s.%s" % (os.path.splitext(infilename)[0],
+                                         extension)
+            else:
+                outfilename = os.path.join(output_dir, "%s.%s"
+                                  % (os.path.splitext(relname)[0], extension))
+            if os.path.exists(outfilename) and not clobber:
+                warn("%s: The output file '%s' already exists. Use --force "
+                     "to overwrite it." % (infilename, outfilename))
+                skipped.append(infilename)
+                continue
+            outdir = os.path.dirname(outfilename)
+            if outdir and not os.path.isdir(outdir):
+                os.makedirs(outdir)
+            outputs[infilename] = (to_format, outfilename)
+            yield infilename
+    output = None
+    if ndjson is not None:
+        if ndjson == '-':
+            output = OutputFile(sys.stdout)
+        else:
+            output = OutputFile(ndjson)
+    count = 0
+    failed = 0
+    for (infilename, records, messages, error) \
+    in iter_pdf_batch(tasks(), jobs, timeout, outputs):
+        count += 1
+        if error is not None:
+            failed += 1
+        if output is not None:
+            result = {'file': infilename}
+            if error is None:
+                result['bookmarks'] = [dict(fields, level=level)
+                                       for (level, fields) in records]
+            else:
+                result['error'] = error
+            if messages:
+                result['warnings'] = messages
+            output.write(json.dumps(result, sort_keys=True) + "\n")
+            # every line is passed on as soon as it is complete
+            output.flush()
+            if ndjson == '-':
+                sys.stdout.flush()
+        else:
+            for message in messages:
+                warn("%s: %s" % (infilename, message))
+            if error is not None:
+                warn("%s: %s" % (infilename, error))
+    if output is not None:
+        output.close()
+    count += len(skipped)
+    failed += len(skipped)
+    if failed:
+        die("The bookmarks of %i of %i pdf files could not be read"
+            % (failed, count))
+    warn("Read the bookmarks of %i pdf files" % count)
+
+# the extensions of the output files of --batch that differ from the format
+_batch_extensions = {'text': 'txt', 'latex': 'tex'}
+
+def _batch_inputs(files):
+    """Yield a tuple (filename, relname) for every pdf file given by files
+    (see --batch), where relname is the name of the output file relative to
+    the output directory, without the extension"""
+    for name in files:
+        if name.startswith('@'):
+            if name == '@-':
+                listfile = sys.stdin
+            else:
+                listfile = open(name[1:])
+            for line in listfile:
+                filename = line.strip()
+                if filename:
+                    yield (filename, os.path.basename(filename))
+            if listfile is not sys.stdin:
+                listfile.close()
+        elif os.path.isdir(name):
+            for (dirpath, dirnames, filenames) in os.walk(name):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.lower().endswith('.pdf'):
+                        path = os.path.join(dirpath, filename)
+                        yield (path, os.path.relpath(path, name))
+        else:
+            yield (name, os.path.basename(name))
+
+
+def iter_xml(infilename):
+    """Parse an iText XML file describing the bookmarks, and yield a tuple
+    (level, fields) for every bookmark, in preorder. The level of a toplevel
+    bookmark is 1, and fields is a dict that maps Bookmark attribute names to
+    their values. The file is parsed incrementally, so records are yielded as
+    soon as they are complete."""
+    records = []
 
     # Define specialized handler class
     from xml.sax import ContentHandler
     class docHandler(ContentHandler):
-        def __init__(self, root):
+        def __init__(self):
             """Initialize parser state variables """
-            self.current_node = root
+            self.level = 0
+            self.fields = None # fields of the bookmark whose title is read
             self.open_element = ""
+        def finish_title(self):
+            """Store the record of the bookmark whose title is being read, as
+            its title ends at the first linebreak or child bookmark """
+            if self.fields is not None:
+                title = self.fields['title']
+                linebreak = title.find("\n")
+                if linebreak >= 0:
+                    self.fields['title'] = title[:linebreak]
+                records.append((self.level, self.fields))
+                self.fields = None
         def startElement(self, name, attrs):
             """Hook for opening XML tags """
             if name == "Title":
+                self.finish_title()
                 self.open_element = name
-                self.current_node = self.current_node.newchild()
-                node = self.current_node
-                node.action = attrs.get("Action", None)
+                self.level += 1
+                fields = {'title': u""}
+                fields['action'] = attrs.get("Action", None)
                 page = attrs.get("Page", None)
                 if (page is not None) and (page.index(" ") >= 0):
-                    node.destination = page.split(" ", 1)[1]
+                    fields['destination'] = page.split(" ", 1)[1]
                     try:
-                        node.page = int(page.split(" ", 1)[0])
+                        fields['page'] = int(page.split(" ", 1)[0])
                     except ValueError:
                         die("The Page reference '%s' could not be parsed"
                         % page)
-                node.named = attrs.get("Named", None)
-                node.namedn = attrs.get("NamedN", None)
-                node.file = attrs.get("File", None)
-                node.newwindow = attrs.get("NewWindow", None)
-                node.uri = attrs.get("URI", None)
+                fields['named'] = attrs.get("Named", None)
+                fields['namedn'] = attrs.get("NamedN", None)
+                fields['file'] = attrs.get("File", None)
+                fields['newwindow'] = attrs.get("NewWindow", None)
+                fields['uri'] = attrs.get("URI", None)
                 style = attrs.get("Style", "").lower()
                 if 'italic' in style:
-                    node.italic = True
+                    fields['italic'] = True
                 if 'bold' in style:
-                    node.bold = True
-                node.color = attrs.get("Color", None)
+                    fields['bold'] = True
+                fields['color'] = attrs.get("Color", None)
                 if attrs.get("Open", "true").lower() == "false":
-                    node.open = False
+                    fields['open'] = False
+                self.fields = fields
         def characters(self, content):
             """Hook for XML text data """
-            if self.open_element == "Title":
-                self.current_node.title += content
+            if self.open_element == "Title" and self.fields is not None:
+                self.fields['title'] += content
         def endElement(self, name):
             """Hook for closing XML tags """
             if name == "Title":
+                self.finish_title()
                 self.open_element = ""
-                linebreak = self.current_node.title.find("\n")
-                if linebreak >= 0:
-                    self.current_node.title \
-                                           = self.current_node.title[:linebreak]
-                self.current_node = self.current_node.parent()
+                self.level -= 1
 
-    # Create an XML parser
+    # Create an incremental XML parser
     from xml.sax import make_parser
     parser = make_parser()
-    parser.setContentHandler(docHandler(root))
+    parser.setContentHandler(docHandler())
 
     # Parse the infile;
     try:
-        parser.parse(infilename)
+        for block in input_blocks(infilename):
+            parser.feed(block)
+            for record in records:
+                yield record
+            del records[:]
+        parser.close()
     except Exception, data:
         warn("There was a fatal error in parsing the xml file:")
         die(data)
+    for record in records:
+        yield record
 
-    return (root, {})
+
+def read_xml(infilename):
+    """Read in an iText XML file describing the bookmarks, return a tuple
+    (root, {}) where root is a root bookmark node. The root node itself is
+    empty, and contains all the bookmarks as children."""
+    return (build_tree(iter_xml(infilename)), {})
 
 
 def write_xml(root, outfilename, metadata={}):
     """ Write bookmarks into an iText XML file, encoded in UTF-8.
-        The metadata is ignored for this format
+        The metadata is ignored for this format. Instead of a root node, root
+        may be any iterator over nodes in preorder (see iter_nodes)
     """
-    outfile = codecs.open(outfilename, "w", "utf-8")
-    def str_bm(node):
-        if node.is_root():
-            s  = r'<?xml version="1.0" encoding="UTF-8"?>'+"\n"
-            s += "<Bookmark>\n"
-            for child in node.children():
-                s +=  str_bm(child)
-            s += "</Bookmark>\n"
-        else:
-            s  = "  " * node.level()
-            s += '<Title'
-            if not node.open:
-                s += ' Open="%s"'  % (str(node.open).lower())
-            if node.action is not None: s += ' Action="%s"' % (node.action)
-            if node.action in ['GoTo', 'GoToR']:
-                s  += ' Page="%s'  % node.page
-                if (node.destination is not None) \
-                and (not node.destination == ''):
-                    s += ' %s"' % (node.destination)
-                else:
-                    s += '"'
-            if node.color  is not None: s += ' Color="%s"' % (node.color)
-            style = ""
-            if node.italic:
-                style = "italic"
-            if node.bold:
-                if len(style) > 0: style += " "
-                style += "bold"
-            if style != "": s += ' Style="%s"' % style
-            if node.uri    is not None: s += ' URI="%s"'   \
-                      % saxutils.escape(node.uri, {'"':'&quot;', "'": '&apos;'})
-            if node.file  is not None: s  += ' File="%s"'  \
-                     % saxutils.escape(node.file, {'"':'&quot;', "'": '&apos;'})
-            if node.newwindow  is not None:
-                s  += ' NewWindow="%s"' % (node.newwindow)
-            if node.named is not None: s  += ' Named="%s"' \
-                    % saxutils.escape(node.named, {'"':'&quot;', "'": '&apos;'})
-            if node.namedn is not None: s  += ' NamedN="%s"' \
-                   % saxutils.escape(node.namedn, {'"':'&quot;', "'": '&apos;'})
-            s += ' >%s' \
-                    % saxutils.escape(node.title, {'"':'&quot;', "'": '&apos;'})
-            if node.has_children():
-                s += "\n"
-                for child in node.children():
-                    s +=  str_bm(child)
-                s += "  " * node.level()
-            s += "</Title>\n"
-        return s
-    outfile.write(str_bm(root))
+    outfile = OutputFile(outfilename)
+    outfile.write(r'<?xml version="1.0" encoding="UTF-8"?>'+"\n")
+    outfile.write("<Bookmark>\n")
+    # Each Title is written as soon as its node comes up. Whether it contains
+    # children, and which enclosing Titles have to be closed, is only decided
+    # by the level of the node that follows it
+    previous_level = 0
+    for node in root:
+        level = node.level()
+        if previous_level > 0:
+            if level > previous_level:
+                outfile.write("\n")
+            else:
+                outfile.write("</Title>\n")
+                for closed_level in xrange(previous_level - 1, level - 1, -1):
+                    outfile.write("  " * closed_level + "</Title>\n")
+        s  = "  " * level
+        s += '<Title'
+        if not node.open:
+            s += ' Open="%s"'  % (str(node.open).lower())
+        if node.action is not None: s += ' Action="%s"' % (node.action)
+        if node.action in ['GoTo', 'GoToR']:
+            s  += ' Page="%s'  % node.page
+            if (node.destination is not None) \
+            and (not node.destination == ''):
+                s += ' %s"' % (node.destination)
+            else:
+                s += '"'
+        if node.color  is not None: s += ' Color="%s"' % (node.color)
+        style = ""
+        if node.italic:
+            style = "italic"
+        if node.bold:
+            if len(style) > 0: style += " "
+            style += "bold"
+        if style != "": s += ' Style="%s"' % style
+        if node.uri    is not None: s += ' URI="%s"'   \
+                  % node.rendered('uri', escape_xml)
+        if node.file  is not None: s  += ' File="%s"'  \
+                 % node.rendered('file', escape_xml)
+        if node.newwindow  is not None:
+            s  += ' NewWindow="%s"' % (node.newwindow)
+        if node.named is not None: s  += ' Named="%s"' \
+                % node.rendered('named', escape_xml)
+        if node.namedn is not None: s  += ' NamedN="%s"' \
+               % node.rendered('namedn', escape_xml)
+        s += ' >%s' % node.rendered('title', escape_xml)
+        outfile.write(s)
+        previous_level = level
+    if previous_level > 0:
+        outfile.write("</Title>\n")
+        for closed_level in xrange(previous_level - 1, 0, -1):
+            outfile.write("  " * closed_level + "</Title>\n")
+    outfile.write("</Bookmark>\n")
     outfile.close()
 
 
-def read_pdftk(infilename):
-    """ Read in a pdftk text file describing the bookmarks, return a tuple
-        (root, metadata), where root a root bookmark node and metadata is a dict
-        of metadata entries. The root node itself is empty, and contains all the
-        bookmarks as children.
+def iter_pdftk(infilename, metadata=None, start=0, end=None, line_nr=0):
+    """ Parse a pdftk text file describing the bookmarks, and yield a tuple
+        (level, fields) for every bookmark, in preorder (see iter_xml).
+
+        If a dict is given as metadata, the document information and page
+        labels are stored in it as soon as they are parsed, as described in
+        read_pdftk.
+
+        start, end and line_nr restrict the parsing to a range of bytes of the
+        file (see input_blocks), where line_nr is the number of lines that
+        precede start. They allow iter_parallel to parse the file in chunks.
     """
-    # TODO: parse proper metadata
-    titlepattern = re.compile(r'BookmarkTitle:\s*(.+)')
-    levelpattern = re.compile(r'BookmarkLevel:\s*([0-9]+)\s*')
-    pagepattern  = re.compile(r'BookmarkPageNumber:\s*([0-9]+)\s*')
-    escape_re = re.compile(r'&#([0-9]+);')
-    root = Bookmark()
-    current_node = root
+    # keys that are known to be part of a pdftk dump, but that carry no
+    # information we use
+    ignored_keys = set(['BookmarkBegin', 'InfoBegin', 'PageMediaBegin',
+                        'PageMediaNumber', 'PageMediaRotation',
+                        'PageMediaRect', 'PageMediaDimensions',
+                        'PageMediaCropRect', 'PdfID0', 'PdfID1',
+                        'NumberOfPages'])
     current_level = 0
-    infile = codecs.open(infilename, "r", "utf-8")
-    line_nr = 0
+    info = {}
+    info_key = None
+    pagelabels = []
     title = ""
     level = 0
-    page = 0
-    for line in infile:
+    for line in input_lines(infilename, start=start, end=end):
         line_nr += 1
-        titlematch = titlepattern.match(line)
-        levelmatch = levelpattern.match(line)
-        pagematch  = pagepattern.match(line)
-        if titlematch:
-            title = titlematch.group(1)
-            # un-escape non-ascii characters
-            def unescape(match):
-                """Return the un-escaped replacement for the string matched"""
-                number = int(match.group(1))
-                return unichr(number)
-            while escape_re.search(title):
-                title = escape_re.sub(unescape, title)
-            title = saxutils.unescape(title, {'&quot;':'"', "&apos;": "'"})
-        elif levelmatch:
-            level = int(levelmatch.group(1))
-        elif pagematch:
-            page = int(pagematch.group(1))
-            # a pagematch concludes the bookmark, so we can add it to the tree
-            if level - current_level > 1:
+        key, colon, value = line.partition(':')
+        key = key.strip()
+        if key == 'BookmarkTitle':
+            title = unescape_pdftk(value.strip())
+        elif key == 'BookmarkLevel':
+            try:
+                level = int(value)
+            except ValueError:
+                warn("Ignored line %s. Not parsable" % line_nr)
+        elif key == 'BookmarkPageNumber':
+            try:
+                page = int(value)
+            except ValueError:
+                warn("Ignored line %s. Not parsable" % line_nr)
+                continue
+            # a page number concludes the bookmark
+            if (level < 1) or (level - current_level > 1):
                 die("There's something wrong with the level number"
                     +"at line %s" % line_nr)
-            while current_level > level:
-                current_node = current_node.parent()
-                current_level -= 1
-            if level == current_level:
-                current_node = current_node.parent()
-                current_level -= 1
-            current_node = current_node.newchild()
-            current_level += 1
-            current_node.title       = title.strip()
-            current_node.page        = page
-            current_node.action      = "GoTo"
+            current_level = level
+            yield (level, {'title': title.strip(), 'page': page,
+                           'action': "GoTo"})
+        elif key == 'InfoKey':
+            info_key = unescape_pdftk(value.strip())
+        elif key == 'InfoValue':
+            if info_key is None:
+                warn("Ignored line %s. InfoValue without InfoKey" % line_nr)
+            else:
+                info[info_key] = unescape_pdftk(value.strip())
+                if metadata is not None:
+                    metadata['info'] = info
+                    if info_key in ['Title', 'Author']:
+                        metadata[info_key.lower()] = info[info_key]
+                info_key = None
+        elif key == 'PageLabelBegin':
+            pagelabels.append({})
+        elif key.startswith('PageLabel') and colon:
+            field = key[len('PageLabel'):]
+            if not pagelabels or pagelabels[-1].has_key(field):
+                pagelabels.append({})
+            if metadata is not None:
+                metadata['pagelabels'] = pagelabels
+            value = unescape_pdftk(value.strip())
+            if field in ['NewIndex', 'Start']:
+                try:
+                    value = int(value)
+                except ValueError:
+                    warn("Ignored line %s. Not parsable" % line_nr)
+                    continue
+            pagelabels[-1][field] = value
+        elif key in ignored_keys:
+            pass
         else:
             warn("Ignored line %s. Not parsable" % line_nr)
-    infile.close()
-    return (root, {})
 
 
-def write_pdftk(root, outfilename, metadata={}):
-    """Write bookmarks to a pdftk text file"""
-    # TODO: write Metadata
-    def escape(source):
-        """Receive and return unicode string, convert all non-ascii characters
-        (or non-printables) to XML decimal entities"""
-        if source is None: return ""
-        encoded = []
-        for character in source:
-            if (ord(character) < 32) or (ord(character) >= 127):
-                encoded.append("&#%s;" % ord(character))
-            else:
-                encoded.append(saxutils.escape(character, {'"':'&quot;'}))
-        return (''.join(encoded)).decode('utf-8')
-    outfile = codecs.open(outfilename, "w", "utf-8")
-    warnings = set()
-    for node in root:
+def read_pdftk(infilename, jobs=1):
+    """ Read in a pdftk text file describing the bookmarks, return a tuple
+        (root, metadata), where root a root bookmark node and metadata is a dict
+        of metadata entries. The root node itself is empty, and contains all the
+        bookmarks as children.
+
+        The metadata contains the document information under the key 'info'
+        (a dict of InfoKey -> InfoValue), with the 'Title' and 'Author' entries
+        also copied to the keys 'title' and 'author'. The page labels are
+        stored as a list of dicts under the key 'pagelabels', each dict mapping
+        'NewIndex', 'Start', 'Prefix', and 'NumStyle' to their values.
+
+        With jobs > 1, the file is parsed in that many processes (see
+        iter_parallel).
+    """
+    metadata = {}
+    root = build_tree(iter_parallel(iter_pdftk, infilename, jobs, metadata))
+    return (root, metadata)
+
+
+def _escape_pdftk_title(title):
+    """Return the title as it is written to a pdftk file"""
+    return escape_pdftk(title.strip())
+
+
+def _write_pdftk_nodes(nodes, write, warnings):
+    """Format the nodes for write_pdftk, and pass the result to write"""
+    for node in nodes:
         if node.action != 'GoTo':
             warnings.add("WARNING: The pdftk format cannot express bookmarks " \
                 + "with actions different from GoTo. The resulting pdftk " \
@@ -1250,75 +2694,107 @@ def write_pdftk(root, outfilename, metadata={}):
         if not node.open:
             warnings.add(\
                         "WARNING: The pdftk format cannot express closed nodes")
-        outfile.write(  "BookmarkTitle: %s\n" \
-                                % escape( node.title.strip() )  )
-        outfile.write("BookmarkLevel: %s\n" % node.level())
+        write(  "BookmarkTitle: %s\n" \
+                                % node.rendered('title', _escape_pdftk_title))
+        write("BookmarkLevel: %s\n" % node.level())
         page = node.page
         if page is None: page = 0
-        outfile.write("BookmarkPageNumber: %s\n" % page)
+        write("BookmarkPageNumber: %s\n" % page)
+
+
+def write_pdftk(root, outfilename, metadata={}, jobs=1):
+    """Write bookmarks to a pdftk text file. Instead of a root node, root may
+    be any iterator over nodes in preorder (see iter_nodes). With jobs > 1,
+    the bookmarks of a tree are formatted in that many processes (see
+    write_nodes)"""
+    # TODO: write Metadata
+    outfile = OutputFile(outfilename)
+    warnings = set()
+    write_nodes(_write_pdftk_nodes, root, outfile.write, warnings, jobs)
     outfile.close()
     for warning in warnings:
         warn("")
         warn(warning)
 
 
-def read_text(infilename):
-    """ Read in a text file describing the bookmarks, return a tuple (root, {})
-        where root is a root bookmark node. The root node itself is empty, and
-        contains all the bookmarks as children.
+def iter_text(infilename, tabwidth=4, levelprefix=False, start=0, end=None,
+              line_nr=0):
+    """ Parse a text file describing the bookmarks, and yield a tuple
+        (level, fields) for every bookmark, in preorder (see iter_xml).
+
+        The level of each bookmark is taken from its indentation, at 4 columns
+        per level. A tab in the indentation advances to the next multiple of
+        tabwidth columns. If levelprefix is True, the level is instead given
+        explicitly as an integer in front of the title, e.g. '2 Sub1 :: 5',
+        and the indentation is ignored.
+
+        start, end and line_nr restrict the parsing to a range of bytes of the
+        file (see input_blocks), where line_nr is the number of lines that
+        precede start. They allow iter_parallel to parse the file in chunks.
     """
-    linepattern = re.compile(r'''
-      (?P<indent>\s*)
-      (?P<text>\S.*)   ::  [ ]*  (?P<page>[0-9]*)
-      [ ]* (?P<dest> (XYZ.*) | (Fit.*))?  [ ]*
-    ''', re.X)
-    root = Bookmark()
-    current_node = root
+    digits = re.compile(r'[0-9]*')
     current_level = 0
-    infile = codecs.open(infilename, "r", "utf-8")
-    line_nr = 0
-    for line in infile:
+    for line in input_lines(infilename, start=start, end=end):
         line_nr += 1
-        match = linepattern.match(line)
-        if match:
-            indent = match.group('indent')
-            level = len(indent.split("    "))
-            if level - current_level > 1:
-                die("There's something wrong with the indentation "
-                    +"at line %s" % line_nr)
-            while current_level > level:
-                current_node = current_node.parent()
-                current_level -= 1
-            if level == current_level:
-                current_node = current_node.parent()
-                current_level -= 1
-            current_node = current_node.newchild()
-            current_level += 1
-            current_node.title       = (match.group('text')).strip()
+        separator = line.rfind(u'::')
+        text = line[:max(separator, 0)].lstrip(u' \t\n\r\f\v')
+        if text == u'':
+            warn("Ignored line %s. Not parsable" % line_nr)
+            continue
+        if levelprefix:
+            level, space, text = text.partition(u' ')
+            text = text.lstrip()
             try:
-                current_node.page        = int((match.group('page')).strip())
+                level = int(level)
             except ValueError:
-                warn("page number '%s' in line %s " \
-                                    % ((match.group('page')).strip(), line_nr) \
-                     +"is not an integer. Setting to 0")
-
-                current_node.page        = 0
-            destination = (match.group('dest'))
-            if destination is not None:
-                current_node.destination = destination.strip()
-            current_node.action      = "GoTo"
+                warn("Ignored line %s. No level prefix" % line_nr)
+                continue
+            if text == u'':
+                warn("Ignored line %s. Not parsable" % line_nr)
+                continue
         else:
-            warn("Ignored line %s. Not parsable" % line_nr)
-    infile.close()
-    return (root, {})
+            column = 0
+            for character in line[:separator - len(text)]:
+                if character == u'\t':
+                    column += tabwidth - (column % tabwidth)
+                else:
+                    column += 1
+            level = column // 4 + 1
+        if (level < 1) or (level - current_level > 1):
+            die("There's something wrong with the indentation "
+                +"at line %s" % line_nr)
+        current_level = level
+        fields = {'title': text.strip(), 'action': "GoTo"}
+        # parse the page number and the (optional) destination following it
+        tail = line[separator+2:].lstrip(u' ')
+        page_end = digits.match(tail).end()
+        page = tail[:page_end]
+        try:
+            fields['page'] = int(page)
+        except ValueError:
+            warn("page number '%s' in line %s " % (page, line_nr)
+                 +"is not an integer. Setting to 0")
+            fields['page'] = 0
+        destination = tail[page_end:].lstrip(u' ')
+        if destination.startswith(u'XYZ') or destination.startswith(u'Fit'):
+            fields['destination'] = destination.strip()
+        yield (level, fields)
+
+
+def read_text(infilename, tabwidth=4, levelprefix=False, jobs=1):
+    """ Read in a text file describing the bookmarks, return a tuple (root, {})
+        where root is a root bookmark node. The root node itself is empty, and
+        contains all the bookmarks as children. See iter_text for the meaning
+        of tabwidth and levelprefix. With jobs > 1, the file is parsed in that
+        many processes (see iter_parallel).
+    """
+    return (build_tree(iter_parallel(iter_text, infilename, jobs,
+                                     args=(tabwidth, levelprefix))), {})
 
 
-def write_text(root, outfilename, metadata={}, long=False):
-    """ Write bookmarks to a text file. The metadata is ignored in this format
-    """
-    outfile = codecs.open(outfilename, "w", "utf-8")
-    warnings = set()
-    for node in root:
+def _write_text_nodes(nodes, write, warnings, long):
+    """Format the nodes for write_text, and pass the result to write"""
+    for node in nodes:
         title = node.title.strip()
         if title != node.title:
             warnings.add("WARNING: Titles in the text output format will be " \
@@ -1341,25 +2817,34 @@ def write_text(root, outfilename, metadata={}, long=False):
                     + "destinations unless you use the --long option")
         if not node.open:
             warnings.add("WARNING: The text format cannot express closed nodes")
-        outfile.write("    " * ( node.level() - 1 ))
-        outfile.write(title + " :: " + str(node.page))
+        write("    " * ( node.level() - 1 ))
+        write(title + " :: " + str(node.page))
         if long:
             if (node.destination is not None) and (node.destination != ""):
-                outfile.write(" " + node.destination)
-        outfile.write("\n")
+                write(" " + node.destination)
+        write("\n")
+
+
+def write_text(root, outfilename, metadata={}, long=False, jobs=1):
+    """ Write bookmarks to a text file. The metadata is ignored in this format.
+        Instead of a root node, root may be any iterator over nodes in preorder
+        (see iter_nodes). With jobs > 1, the bookmarks of a tree are formatted
+        in that many processes (see write_nodes)
+    """
+    outfile = OutputFile(outfilename)
+    warnings = set()
+    write_nodes(_write_text_nodes, root, outfile.write, warnings, jobs,
+                (long,))
     outfile.close()
     for warning in warnings:
         warn("")
         warn(warning)
 
 
-def read_latex(infilename):
-    """ Read in a latex file describing the bookmarks, return a tuple (root,
-        metadata) where root is a root bookmark node and metadata is a dict of
-        metadata. The root node itself is empty, and contains all the bookmarks
-        as children.
+def iter_latex(infilename):
+    """ Parse a latex file describing the bookmarks, and yield a tuple
+        (level, fields) for every bookmark, in preorder (see iter_xml).
     """
-    # TODO: read metadata
     linepattern = re.compile(r'''
       ^\s*\\bookmark(?P<options>\[.*\])\{(?P<text>.*)\}\s*$
     ''', re.X)
@@ -1378,17 +2863,14 @@ def read_latex(infilename):
     \{(?P<rgb>[0-9.]+\s*,\s*[0-9.]+\s*,\s*[0-9.]+)\}
     \s*[,\]]
     ''', re.X)
-    root = Bookmark()
-    current_node = root
     current_level = 0
-    infile = codecs.open(infilename, "r", "utf-8")
     line_nr = 0
-    for line in infile:
+    for line in input_lines(infilename):
         line_nr += 1
         match = linepattern.match(line)
         if match:
             options = match.group('options')
-            # determine level, create appropriate node
+            # determine level
             level = 1
             levelmatch = levelpattern.search(options)
             if levelmatch:
@@ -1396,16 +2878,9 @@ def read_latex(infilename):
             if level - current_level > 1:
                 die("There's something wrong with the level "
                     +"at line %s" % line_nr)
-            while current_level > level:
-                current_node = current_node.parent()
-                current_level -= 1
-            if level == current_level:
-                current_node = current_node.parent()
-                current_level -= 1
-            current_node = current_node.newchild()
-            current_level += 1
+            current_level = level
             # set title
-            current_node.title = (match.group('text')).strip()
+            fields = {'title': unescape_latex(match.group('text').strip())}
             # set action and "main" attributes
             gotormatch = gotorpattern.search(options)
             namedmatch = namedpattern.search(options)
@@ -1413,50 +2888,102 @@ def read_latex(infilename):
             if gotormatch:
                 destmatch = destpattern.search(options)
                 if destmatch:
-                    current_node.file = destmatch.group('dest')
+                    fields['file'] = destmatch.group('dest')
                 else:
                     pagematch = pagepattern.search(options)
                     if pagematch:
-                        current_node.page = int(pagematch.group("page"))
+                        fields['page'] = int(pagematch.group("page"))
                     viewmatch = viewpattern.search(options)
                     if viewmatch:
                         view = viewmatch.group("view")
                         if view.startswith("{"):
                             view = view[1:-1].strip()
-                        current_node.destination = view
+                        fields['destination'] = view
             elif namedmatch:
-                current_node.action = "GoToR"
-                current_node.named = namedmatch.group("named")
+                fields['action'] = "GoToR"
+                fields['named'] = namedmatch.group("named")
             elif urimatch:
-                current_node.action = "URI"
-                current_node.uri = urimatch.group("uri")
+                fields['action'] = "URI"
+                fields['uri'] = urimatch.group("uri")
             else:
-                current_node.action = "GoTo"
+                fields['action'] = "GoTo"
                 pagematch = pagepattern.search(options)
                 if pagematch:
-                    current_node.page = int(pagematch.group("page"))
+                    fields['page'] = int(pagematch.group("page"))
                 viewmatch = viewpattern.search(options)
                 if viewmatch:
                     view = viewmatch.group("view")
                     if view.startswith("{"):
                         view = view[1:-1].strip()
-                    current_node.destination = view
+                    fields['destination'] = view
             # set other attributes
             colormatch = colorpattern.search(options)
             if colormatch:
-                current_node.color = " ".join([c.strip() for c in
-                                     colormatch.group('rgb').split(",")])
+                fields['color'] = " ".join([c.strip() for c in
+                                  colormatch.group('rgb').split(",")])
             if boldpattern.search(options):
-                current_node.bold = True
+                fields['bold'] = True
             if italpattern.search(options):
-                current_node.italic = True
-    infile.close()
-    return (root, {})
+                fields['italic'] = True
+            yield (level, fields)
+
+
+def read_latex(infilename):
+    """ Read in a latex file describing the bookmarks, return a tuple (root,
+        metadata) where root is a root bookmark node and metadata is a dict of
+        metadata. The root node itself is empty, and contains all the bookmarks
+        as children.
+    """
+    # TODO: read metadata
+    return (build_tree(iter_latex(infilename)), {})
+
+
+def _write_latex_nodes(nodes, write, warnings):
+    """Format the nodes for write_latex, and pass the result to write"""
+    for node in nodes:
+        options = []
+        if node.action == 'Launch':
+            warnings.add("WARNING: The latex format cannot express the "
+                         + "Launch action")
+        if node.bold:
+            options.append('bold')
+        if node.italic:
+            options.append('italic')
+        if node.color is not None:
+            options.append("color=[rgb]{%s}" %  ",".join(node.color.split()))
+        if node.destination is not None:
+            options.append("view={%s}" % node.destination)
+        optstr = ", ".join(options)
+        if len(optstr) > 0:
+            optstr = optstr + ", "
+        write("    " * ( node.level() - 1 ))
+        title = node.rendered('title', escape_latex)
+        if node.action == 'GoTo':
+            if node.named is None:
+                write('\\bookmark[%spage=%i,level=%i]{%s}'
+                % (optstr, node.page, node.level()-1, title))
+            else:
+                write('\\bookmark[%sdest=%s,level=%i]{%s}'
+                % (optstr, node.named, node.level()-1, node.title))
+        elif node.action == 'GoToR':
+            if node.named is None:
+                write('\\bookmark[%sgotor=%s, page=%i,level=%i]{%s}'
+                % (optstr, node.file, node.page, node.level()-1, title))
+            else:
+                write('\\bookmark[%sgotor=%s, dest=%s,level=%i]{%s}'
+                % (optstr, node.file, node.named, node.level()-1, title))
+        elif node.action == 'URI':
+            write('\\bookmark[%suri=%s,level=%i]{%s}'
+            % (optstr, node.uri, node.level()-1, title))
+        write("\n")
 
 
-def write_latex(root, outfilename, metadata={}):
-    """Write bookmarks to a tex file"""
-    outfile = codecs.open(outfilename, "w", "utf-8")
+def write_latex(root, outfilename, metadata={}, jobs=1):
+    """Write bookmarks to a tex file. Instead of a root node, root may be any
+    iterator over nodes in preorder (see iter_nodes). With jobs > 1, the
+    bookmarks of a tree are formatted in that many processes (see
+    write_nodes)"""
+    outfile = OutputFile(outfilename)
     warnings = set()
     outfile.write("\\documentclass{article}\n")
     outfile.write("\\usepackage[utf8]{inputenc}\n")
@@ -1485,43 +3012,7 @@ def write_latex(root, outfilename, metadata={}):
         outfile.write("%\\setcounter{page}{1}\n")
         outfile.write("%\\includepdf[pages=-]{file.pdf}\n")
     outfile.write("\n")
-    for node in root:
-        options = []
-        if node.action == 'Launch':
-            warnings.add("WARNING: The latex format cannot express the "
-                         + "Launch action")
-        if node.bold:
-            options.append('bold')
-        if node.italic:
-            options.append('italic')
-        if node.color is not None:
-            options.append("color=[rgb]{%s}" %  ",".join(node.color.split()))
-        if node.destination is not None:
-            options.append("view={%s}" % node.destination)
-        optstr = ", ".join(options)
-        if len(optstr) > 0:
-            optstr = optstr + ", "
-        outfile.write("    " * ( node.level() - 1 ))
-        if node.action == 'GoTo':
-            if node.named is None:
-                outfile.write('\\bookmark[%spage=%i,level=%i]{%s}'
-                % (optstr, node.page, node.level()-1, escape_latex(node.title)))
-            else:
-                outfile.write('\\bookmark[%sdest=%s,level=%i]{%s}'
-                % (optstr, node.named, node.level()-1, node.title))
-        elif node.action == 'GoToR':
-            if node.named is None:
-                outfile.write('\\bookmark[%sgotor=%s, page=%i,level=%i]{%s}'
-                % (optstr, node.file, node.page, node.level()-1,
-                   escape_latex(node.title)))
-            else:
-                outfile.write('\\bookmark[%sgotor=%s, dest=%s,level=%i]{%s}'
-                % (optstr, node.file, node.named, node.level()-1,
-                   escape_latex(node.title)))
-        elif node.action == 'URI':
-            outfile.write('\\bookmark[%suri=%s,level=%i]{%s}'
-            % (optstr, node.uri, node.level()-1, escape_latex(node.title)))
-        outfile.write("\n")
+    write_nodes(_write_latex_nodes, root, outfile.write, warnings, jobs)
     outfile.write("\n")
     outfile.write("\\end{document}\n")
     outfile.close()
@@ -1530,28 +3021,38 @@ def write_latex(root, outfilename, metadata={}):
         warn(warning)
 
 
-def read_html(infilename):
-    """ Read in an a Djvu html file describing the bookmarks, return a tuple
-        (root, {}) where root is a root bookmark node. The root node itself is
-        empty, and contains all the bookmarks as children.
+def iter_html(infilename):
+    """ Parse a Djvu html file describing the bookmarks, and yield a tuple
+        (level, fields) for every bookmark, in preorder (see iter_xml).
     """
-    root = Bookmark()
+    records = []
 
     # Define specialized handler class
     from xml.sax import ContentHandler
     class docHandler(ContentHandler):
-        def __init__(self, root):
+        def __init__(self):
             """Initialize parser state variables """
-            self.current_node = root
+            self.level = 0
+            self.fields = None # fields of the bookmark whose title is read
             self.open_element = ""
+        def finish_title(self):
+            """Store the record of the bookmark whose title is being read, as
+            its title is complete once a child bookmark starts or the bookmark
+            ends"""
+            if self.fields is not None:
+                self.fields['title'] = self.fields['title'].strip()
+                records.append((self.level, self.fields))
+                self.fields = None
         def startElement(self, name, attrs):
             """Hook for opening XML tags """
             import re
             self.open_element = name
             if name == "li":
-                self.current_node = self.current_node.newchild()
-            if name == "a":
-                node      = self.current_node
+                self.finish_title()
+                self.level += 1
+                self.fields = {'title': u""}
+            if name == "a" and self.fields is not None:
+                fields    = self.fields
                 link      = attrs.get("href", None)
                 goto_re   = re.compile(r'#([0-9]+)')
                 gotor_re  = re.compile(r'(.+)#([0-9]+)')
@@ -1563,114 +3064,130 @@ def read_html(infilename):
                     match = re.match(link)
                     if match:
                         if re is goto_re:
-                            node.action = "GoTo"
-                            node.page = match.group(1)
+                            fields['action'] = "GoTo"
                             try:
-                                node.page = int(node.page)
+                                fields['page'] = int(match.group(1))
                             except ValueError:
                                 die("The Page reference "
-                                    +"'%s' could not be parsed" % node.page)
+                                    +"'%s' could not be parsed"
+                                    % match.group(1))
                         elif re is gotor_re:
-                            node.action = "GoToR"
-                            node.file = match.group(1)
-                            node.page = match.group(2)
+                            fields['action'] = "GoToR"
+                            fields['file'] = match.group(1)
                             try:
-                                node.page = int(node.page)
+                                fields['page'] = int(match.group(2))
                             except ValueError:
                                 die("The Page reference "
-                                    +"'%s' could not be parsed" % node.page)
+                                    +"'%s' could not be parsed"
+                                    % match.group(2))
                         elif re is goton_re:
-                            node.action = "GoTo"
-                            node.named = match.group(1)
+                            fields['action'] = "GoTo"
+                            fields['named'] = match.group(1)
                         elif re is gotonr_re:
-                            node.action = "GoToR"
-                            node.file = match.group(1)
-                            node.named = match.group(2)
+                            fields['action'] = "GoToR"
+                            fields['file'] = match.group(1)
+                            fields['named'] = match.group(2)
                         elif re is uri_re:
-                            node.action = "URI"
-                            node.uri = match.group(1)
+                            fields['action'] = "URI"
+                            fields['uri'] = match.group(1)
                         break
         def characters(self, content):
             """Hook for XML text data """
-            if self.open_element == "a":
-                self.current_node.title += content
+            if self.open_element == "a" and self.fields is not None:
+                self.fields['title'] += content
         def endElement(self, name):
             """Hook for closing XML tags """
             if name == "li":
+                self.finish_title()
                 self.open_element = ""
-                self.current_node.title = self.current_node.title.strip()
-                self.current_node = self.current_node.parent()
+                self.level -= 1
 
-    # Create an XML parser
+    # Create an incremental XML parser
     from xml.sax import make_parser
     parser = make_parser()
-    parser.setContentHandler(docHandler(root))
+    parser.setContentHandler(docHandler())
 
     # Parse the infile;
     try:
-        parser.parse(infilename)
+        for block in input_blocks(infilename):
+            parser.feed(block)
+            for record in records:
+                yield record
+            del records[:]
+        parser.close()
     except Exception, data:
         warn("There was a fatal error in parsing the html file:")
         die(data)
+    for record in records:
+        yield record
 
-    return (root, {})
+
+def read_html(infilename):
+    """ Read in an a Djvu html file describing the bookmarks, return a tuple
+        (root, {}) where root is a root bookmark node. The root node itself is
+        empty, and contains all the bookmarks as children.
+    """
+    return (build_tree(iter_html(infilename)), {})
 
 
 def write_html(root, outfilename, metadata={}):
     """ Write bookmarks to a Djvu html file. The metadata is ignored in this
-        format.
+        format. Instead of a root node, root may be any iterator over nodes in
+        preorder (see iter_nodes)
     """
-    outfile = codecs.open(outfilename, "w", "utf-8")
-    def str_bm(node):
-        if node.is_root():
-            s  = r'<html>'+"\n"
-            s += "<body>\n"
-            s += "<ul>\n"
-            for child in node.children():
-                s +=  str_bm(child)
-            s += "</ul>\n"
-            s += "</body>\n"
-            s += r'</html>'+"\n"
-        else:
-            s = "  " * node.level()
-            s += '<li><a href="'
-            if node.action == "GoTo":
-                if node.named is not None:
-                    s += "#%s" % saxutils.escape(unicode(node.named), \
-                                               {'"' : '&quot;', "'" : '&apos;'})
-                else:
-                    s += "#%s" % node.page
-            elif node.action == "GoToR":
-                if node.named is not None:
-                    s += "%s#%s" % ( saxutils.escape(unicode(node.file), \
-                                              {'"' : '&quot;', "'" : '&apos;'}),
-                                     saxutils.escape(unicode(node.named), \
-                                             {'"' : '&quot;', "'" : '&apos;'}) )
-                else:
-                    s += "%s#%s" % ( saxutils.escape(node.file, \
-                                                  {'"':'&quot;',"'": '&apos;'}),
-                                     node.page)
-            elif node.action == "URI":
-                s += saxutils.escape(unicode(node.uri), \
-                                               {'"' : '&quot;', "'" : '&apos;'})
-            s += '">%s</a>' % saxutils.escape(node.title)
-            if node.has_children():
-                s += "\n"
-                s += "  " * node.level() + "<ul>\n"
-                for child in node.children():
-                    s +=  str_bm(child)
-                s += "  " * node.level() + "</ul>\n"
-                s += "  " * node.level()
-            s += "</li>\n"
-        return s
-    outfile.write(str_bm(root))
+    outfile = OutputFile(outfilename)
+    outfile.write(r'<html>'+"\n")
+    outfile.write("<body>\n")
+    outfile.write("<ul>\n")
+    # As in write_xml, the level of the following node decides whether an
+    # item opens a nested list, and how many enclosing items are closed
+    previous_level = 0
+    for node in root:
+        level = node.level()
+        if previous_level > 0:
+            if level > previous_level:
+                outfile.write("\n" + "  " * previous_level + "<ul>\n")
+            else:
+                outfile.write("</li>\n")
+                for closed_level in xrange(previous_level - 1, level - 1, -1):
+                    outfile.write("  " * closed_level + "</ul>\n"
+                                  + "  " * closed_level + "</li>\n")
+        s = "  " * level
+        s += '<li><a href="'
+        if node.action == "GoTo":
+            if node.named is not None:
+                s += "#%s" % node.rendered('named', escape_xml)
+            else:
+                s += "#%s" % node.page
+        elif node.action == "GoToR":
+            if node.named is not None:
+                s += "%s#%s" % ( node.rendered('file', escape_xml),
+                                 node.rendered('named', escape_xml) )
+            else:
+                s += "%s#%s" % ( node.rendered('file', escape_xml), node.page)
+        elif node.action == "URI":
+            s += node.rendered('uri', escape_xml)
+        s += '">%s</a>' % node.rendered('title', saxutils.escape)
+        outfile.write(s)
+        previous_level = level
+    if previous_level > 0:
+        outfile.write("</li>\n")
+        for closed_level in xrange(previous_level - 1, 0, -1):
+            outfile.write("  " * closed_level + "</ul>\n"
+                          + "  " * closed_level + "</li>\n")
+    outfile.write("</ul>\n")
+    outfile.write("</body>\n")
+    outfile.write(r'</html>'+"\n")
     outfile.close()
 
 
-def read_csv(infilename):
-    """ Read in an jpdftweak csv file describing the bookmarks, return a tuple
-        (root, {}) where root is a root bookmark node. The root node itself is
-        empty, and contains all the bookmarks as children.
+def iter_csv(infilename, start=0, end=None, line_nr=0):
+    """ Parse a jpdftweak csv file describing the bookmarks, and yield a tuple
+        (level, fields) for every bookmark, in preorder (see iter_xml).
+
+        start, end and line_nr restrict the parsing to a range of bytes of the
+        file (see input_blocks), where line_nr is the number of lines that
+        precede start. They allow iter_parallel to parse the file in chunks.
     """
     linepattern = re.compile(r'''
     (?P<depth>         -?[0-9]+);
@@ -1680,25 +3197,6 @@ def read_csv(infilename):
     (?P<destination>   [ ][^;]+)?  # e.g. FitBV 100
     (?P<moreopts>      ;[^;]*)?    # key1=value1 key2=value2 ...
     ''', re.X)
-    def unescape(s):
-        """Undo the escape scheme used in the csv:
-        All nonprintable characters (ascii < 32) and the characters [\:"'] are
-        replaced by '\HH', where HH is the two digit ascii hex code (in upper
-        case) for that character.
-        """
-        if s is None: return None
-        result = ""
-        i = 0
-        while i < len(s):
-            c = s[i]
-            if c == "\\":
-                hexcode = s[i+1:i+3]
-                result += chr(int(hexcode, 16))
-                i+=2
-            else:
-                result += c
-            i += 1
-        return result
     def parse_moreopts(s):
         """Parse the list of moreopts into a dictionary
         s is the direct, unescaped value of the moreopts group
@@ -1709,7 +3207,7 @@ def read_csv(infilename):
         # the original implementation anyway
         result = {}
         if s is None: return result
-        s = (unescape(s[1:])).strip()
+        s = (unescape_csv(s[1:])).strip()
         while len(s) > 0:
             pos = s.find("=\"")
             key = s[0:pos]
@@ -1728,98 +3226,76 @@ def read_csv(infilename):
             result[key] = value
             s = s.strip()
         return result
-    root = Bookmark()
-    current_node = root
     current_level = 0
-    infile = codecs.open(infilename, "r", "utf-8")
-    line_nr = 0
-    for line in infile:
+    for line in input_lines(infilename, start=start, end=end):
         line_nr += 1
         match = linepattern.match(line)
         if match:
             level = int(match.group("depth"))
-            if level - current_level > 1:
+            if (level < 1) or (level - current_level > 1):
                 die("There's something wrong with the indentation "
                     +"at line %s" % line_nr)
-            while current_level > level:
-                current_node = current_node.parent()
-                current_level -= 1
-            if level == current_level:
-                current_node = current_node.parent()
-                current_level -= 1
-            current_node = current_node.newchild()
-            current_level += 1
-            current_node.title       = unescape((match.group("title")))
+            current_level = level
+            fields = {'title': unescape_csv((match.group("title")))}
             page = match.group("page")
             if page is not None:
-                current_node.page        = int((match.group("page")).strip())
-            current_node.destination = match.group("destination")
-            if current_node.destination is not None:
-                current_node.destination = current_node.destination.strip()
+                fields['page'] = int((match.group("page")).strip())
+            destination = match.group("destination")
+            if destination is not None:
+                destination = destination.strip()
+            fields['destination'] = destination
             moreopt_dict = parse_moreopts(match.group("moreopts"))
-            current_node.action      = moreopt_dict.setdefault("action", "GoTo")
-            current_node.open = ("O" in match.group("flags"))
+            fields['action'] = moreopt_dict.setdefault("action", "GoTo")
+            fields['open'] = ("O" in match.group("flags"))
             if ("B" in match.group("flags")):
-                current_node.bold = True
+                fields['bold'] = True
             if ("I" in match.group("flags")):
-                current_node.italic = True
-            current_node.file = unescape(moreopt_dict.setdefault("file", None))
-            current_node.uri = unescape(moreopt_dict.setdefault("uri", None))
-            current_node.color = moreopt_dict.setdefault("color", None)
+                fields['italic'] = True
+            fields['file'] = unescape_csv(moreopt_dict.setdefault("file", None))
+            fields['uri'] = unescape_csv(moreopt_dict.setdefault("uri", None))
+            fields['color'] = moreopt_dict.setdefault("color", None)
             if moreopt_dict.has_key("page"):
                 # This overrides the normal page and destinations
                 page = moreopt_dict["page"]
                 if (page is not None) and (page.find(" ") >= 0):
-                    current_node.destination = page.split(" ", 1)[1]
+                    fields['destination'] = page.split(" ", 1)[1]
                     try:
-                        current_node.page = int(page.split(" ", 1)[0])
+                        fields['page'] = int(page.split(" ", 1)[0])
                     except ValueError:
                         die("The Page reference '%s' could not be parsed"
                              % page)
+            yield (level, fields)
         else:
             warn("Ignored line %s. Not parsable" % line_nr)
-    infile.close()
-    return (root, {})
 
 
-def write_csv(root, outfilename, metadata={}):
-    """ Write bookmarks to a jpdftweak csv file. The metadata is ignored in
-        this format
+def read_csv(infilename, jobs=1):
+    """ Read in an jpdftweak csv file describing the bookmarks, return a tuple
+        (root, {}) where root is a root bookmark node. The root node itself is
+        empty, and contains all the bookmarks as children. With jobs > 1, the
+        file is parsed in that many processes (see iter_parallel).
     """
-    def escape(s):
-        """Apply the escape scheme used in the csv:
-        All nonprintable characters (ascii < 32) and the characters [\:"'] are
-        replaced by '\HH', where HH is the two digit ascii hex code (in upper
-        case) for that character.
-        """
-        import string
-        result = []
-        for c in s:
-            if (ord(c) < 32) or c in "\\;\"'":
-                escaped_char = "\\" + (hex(ord(c))[-2:]).upper()
-                if escaped_char[1] not in string.hexdigits:
-                    escaped_char = escaped_char[0] + "0" + escaped_char[-1]
-                result.append(escaped_char)
-            else:
-                result.append(c)
-        return ''.join(result)
-    outfile = codecs.open(outfilename, "w", "utf-8")
-    for node in root:
-        outfile.write(str(node.level()) + ";")
+    return (build_tree(iter_parallel(iter_csv, infilename, jobs)), {})
+
+
+def _write_csv_nodes(nodes, write, warnings):
+    """Format the nodes for write_csv, and pass the result to write"""
+    for node in nodes:
+        write(str(node.level()) + ";")
         if node.open:
-            outfile.write("O")
+            write("O")
         if node.bold:
-            outfile.write("B")
+            write("B")
         if node.italic:
-            outfile.write("I")
-        outfile.write(";")
-        outfile.write(escape(node.title) + ";")
+            write("I")
+        write(";")
+        write(node.rendered('title', escape_csv) + ";")
         if node.action == "GoTo":
-            outfile.write(str(node.page))
+            write(str(node.page))
             if (node.destination is not None) and (node.destination != ""):
-                outfile.write(" " + unicode(node.destination))
+                write(" " + unicode(node.destination))
         else:
-            outfile.write("0")
+            write("0")
         if (node.action != "GoTo") or (node.file is not None) \
         or (node.uri is not None) or (node.color is not None):
             moreopts_string = ""
@@ -1837,106 +3313,85 @@ def write_csv(root, outfilename, metadata={}):
                 moreopts_string += 'URI="' + node.uri + '" '
             if (node.color is not None):
                 moreopts_string += 'Color="' + node.color + '" '
-            escaped_moreopts = escape(moreopts_string.strip())
+            escaped_moreopts = escape_csv(moreopts_string.strip())
             if escaped_moreopts != "":
-                outfile.write(";")
-                outfile.write(escape(moreopts_string.strip()))
-        outfile.write("\n")
+                write(";")
+                write(escape_csv(moreopts_string.strip()))
+        write("\n")
+
+
+def write_csv(root, outfilename, metadata={}, jobs=1):
+    """ Write bookmarks to a jpdftweak csv file. The metadata is ignored in
+        this format. Instead of a root node, root may be any iterator over
+        nodes in preorder (see iter_nodes). With jobs > 1, the bookmarks of a
+        tree are formatted in that many processes (see write_nodes)
+    """
+    outfile = OutputFile(outfilename)
+    write_nodes(_write_csv_nodes, root, outfile.write, set(), jobs)
     outfile.close()
 
 
-def read_djvused(infilename):
-    """ Read in a djvused text file describing the bookmarks, return a tuple
-        (root, {}) where root is a root bookmark node. The root node itself is
-        empty, and contains all the bookmarks as children.
+def iter_djvused(infilename):
+    """ Parse a djvused text file describing the bookmarks, and yield a tuple
+        (level, fields) for every bookmark, in preorder (see iter_xml).
     """
     startpattern = re.compile(r'\s*  \(bookmarks  \s*  ', re.X)
     titlepattern = re.compile(r'\s*  \(  "(?P<title> .*)"  \s*  ', re.X)
     targetpattern = re.compile(r'''
         \s*   "(?P<target> .*)"     (?P<endings> ( \s*\) )* )   \s* ''', re.X)
-    def unescape(encoded):
-        """Receive and return unicode string, unescape all octal-escaped UTF-8
-        characters"""
-        decoded = encoded.encode('utf-8')
-        replacements = {}
-        for octc in re.findall(r'\\(\d{3})', decoded):
-            replacements[r'\%s' % octc] = chr(int(octc, 8))
-        replacements[r'\"'] = '"'
-        for code in replacements:
-            decoded = decoded.replace(code, replacements[code])
-        return decoded.decode('utf8')
-    root = Bookmark()
-    current_node = None
-    infile = codecs.open(infilename, "r", "utf-8")
+    level = 0
+    fields = None # fields of the bookmark whose target is still missing
     line_nr = 0
-    for line in infile:
+    for line in input_lines(infilename):
         line_nr += 1
         if startpattern.match(line):
-            current_node = root
+            level = 0
             continue
         titlepattern_match = titlepattern.match(line)
         if titlepattern_match:
-            current_node = current_node.newchild()
-            current_node.title = unescape(titlepattern_match.group("title"))
+            if fields is not None:
+                yield (level, fields)
+            level += 1
+            fields = {'title': unescape_djvused(
+                                        titlepattern_match.group("title"))}
             continue
         targetpattern_match = targetpattern.match(line)
-        if targetpattern_match:
-            target = targetpattern_match.group("target")
-            if target.find("#") < 0: # Target is URI
-                current_node.action = "URI"
-                current_node.uri = target
-            elif re.match(r"#[0-9]+", target): # Target is Page Reference
-                current_node.action = "GoTo"
-                current_node.page = int(target[1:])
-            else: # Target is external
-                current_node.action = "GoToR"
-                current_node.file = target.split("#")[0]
-                current_node.page = target.split("#")[1]
-            for i in xrange(targetpattern_match.group("endings").count(")")):
-                current_node = current_node.parent()
+        if targetpattern_match and (fields is not None):
+            _djvu_target(fields, targetpattern_match.group("target"))
+            yield (level, fields)
+            fields = None
+            level -= targetpattern_match.group("endings").count(")")
             continue
         else:
             warn("Ignored line %s. Not parsable" % line_nr)
-    infile.close()
-    return (root, {})
+    if fields is not None:
+        yield (level, fields)
+
+
+def read_djvused(infilename):
+    """ Read in a djvused text file describing the bookmarks, return a tuple
+        (root, {}) where root is a root bookmark node. The root node itself is
+        empty, and contains all the bookmarks as children.
+    """
+    return (build_tree(iter_djvused(infilename)), {})
 
 
 def write_djvused(root, outfilename, metadata={}):
     """ Write bookmarks to a djvused text file. The metadata is ignored in this
         format.
     """
-    def escape(source):
-        """Receive and return unicode string, convert all non-ascii characters
-        (or non-printables) to octal-escaped UTF-8"""
-        if source is None: return ""
-        encoded = []
-        for character in source:
-            if (ord(character) < 32) or (ord(character) >= 127):
-                for byte in character.encode('utf8'):
-                    encoded.append("\%03o" % ord(byte))
-            else:
-                if character == '"': character = r'\"'
-                encoded.append(character)
-        return (''.join(encoded)).decode('utf-8')
-    outfile = codecs.open(outfilename, "w", "utf-8")
+    outfile = OutputFile(outfilename)
     def str_bm(node):
         if node.is_root():
             s = ["(bookmarks"]
         else:
             s = ['\n%s("%s"\n' % ( \
                 node.level() * " ",  \
-                escape(node.title) \
+                node.rendered('title', escape_djvused) \
             )]
-            target = ""
-            if node.action == "GoTo":
-                target = "#%s" % node.page
-            elif node.action == "GoToR":
-                target = "%s#%s" % (unicode(node.file), node.page)
-            elif node.action == "URI":
-                target = node.uri
             s.append( '%s"%s"' % ( \
                 (node.level() + 1) * " ",  \
-                escape(target) \
+                escape_djvused(_djvu_link(node)) \
             ) )
         for child in node.children():
             s.append(str_bm(child))
@@ -1947,36 +3402,1979 @@ def write_djvused(root, outfilename, metadata={}):
     outfile.close()
 
 
-def read_pdf(infilename):
-    """ Read bookmarkds directly from a pdf file, and return a tuple (root,
-        metadata), where root is a root bookmark node. The root node itself is
-        empty, and contains all the bookmarks as children. Formatting of the
-        bookmark titles is disregarded. The metadata is a dict of metadata
-        extracted from the pdf, and additionally with the key 'pdf' set to the
-        value of infilename.
+# DjVu reader
+
+class _DjvuError(Exception):
+    """Raised for djvu files that cannot be read"""
+
+
+# the states of the adaptive ZP coder of DjVu: for every state, the
+# probability of the less probable symbol, the threshold for adapting after
+# a more probable symbol, and the next state after a more (up) and a less
+# (down) probable symbol. The states 251 to 255 are never used.
+_zp_table = [
+    (0x8000, 0x0000, 84, 145), (0x8000, 0x0000, 3, 4), (0x8000, 0x0000, 4, 3),
+    (0x6bbd, 0x10a5, 5, 1), (0x6bbd, 0x10a5, 6, 2), (0x5d45, 0x1f28, 7, 3),
+    (0x5d45, 0x1f28, 8, 4), (0x51b9, 0x2bd3, 9, 5), (0x51b9, 0x2bd3, 10, 6),
+    (0x4813, 0x36e3, 11, 7), (0x4813, 0x36e3, 12, 8), (0x3fd5, 0x408c, 13, 9),
+    (0x3fd5, 0x408c, 14, 10), (0x38b1, 0x48fd, 15, 11),
+    (0x38b1, 0x48fd, 16, 12), (0x3275, 0x505d, 17, 13),
+    (0x3275, 0x505d, 18, 14), (0x2cfd, 0x56d0, 19, 15),
+    (0x2cfd, 0x56d0, 20, 16), (0x2825, 0x5c71, 21, 17),
+    (0x2825, 0x5c71, 22, 18), (0x23ab, 0x615b, 23, 19),
+    (0x23ab, 0x615b, 24, 20), (0x1f87, 0x65a5, 25, 21),
+    (0x1f87, 0x65a5, 26, 22), (0x1bbb, 0x6962, 27, 23),
+    (0x1bbb, 0x6962, 28, 24), (0x1845, 0x6ca2, 29, 25),
+    (0x1845, 0x6ca2, 30, 26), (0x1523, 0x6f74, 31, 27),
+    (0x1523, 0x6f74, 32, 28), (0x1253, 0x71e6, 33, 29),
+    (0x1253, 0x71e6, 34, 30), (0x0fcf, 0x7404, 35, 31),
+    (0x0fcf, 0x7404, 36, 32), (0x0d95, 0x75d6, 37, 33),
+    (0x0d95, 0x75d6, 38, 34), (0x0b9d, 0x7768, 39, 35),
+    (0x0b9d, 0x7768, 40, 36), (0x09e3, 0x78c2, 41, 37),
+    (0x09e3, 0x78c2, 42, 38), (0x0861, 0x79ea, 43, 39),
+    (0x0861, 0x79ea, 44, 40), (0x0711, 0x7ae7, 45, 41),
+    (0x0711, 0x7ae7, 46, 42), (0x05f1, 0x7bbe, 47, 43),
+    (0x05f1, 0x7bbe, 48, 44), (0x04f9, 0x7c75, 49, 45),
+    (0x04f9, 0x7c75, 50, 46), (0x0425, 0x7d0f, 51, 47),
+    (0x0425, 0x7d0f, 52, 48), (0x0371, 0x7d91, 53, 49),
+    (0x0371, 0x7d91, 54, 50), (0x02d9, 0x7dfe, 55, 51),
+    (0x02d9, 0x7dfe, 56, 52), (0x0259, 0x7e5a, 57, 53),
+    (0x0259, 0x7e5a, 58, 54), (0x01ed, 0x7ea6, 59, 55),
+    (0x01ed, 0x7ea6, 60, 56), (0x0193, 0x7ee6, 61, 57),
+    (0x0193, 0x7ee6, 62, 58), (0x0149, 0x7f1a, 63, 59),
+    (0x0149, 0x7f1a, 64, 60), (0x010b, 0x7f45, 65, 61),
+    (0x010b, 0x7f45, 66, 62), (0x00d5, 0x7f6b, 67, 63),
+    (0x00d5, 0x7f6b, 68, 64), (0x00a5, 0x7f8d, 69, 65),
+    (0x00a5, 0x7f8d, 70, 66), (0x007b, 0x7faa, 71, 67),
+    (0x007b, 0x7faa, 72, 68), (0x0057, 0x7fc3, 73, 69),
+    (0x0057, 0x7fc3, 74, 70), (0x003b, 0x7fd7, 75, 71),
+    (0x003b, 0x7fd7, 76, 72), (0x0023, 0x7fe7, 77, 73),
+    (0x0023, 0x7fe7, 78, 74), (0x0013, 0x7ff2, 79, 75),
+    (0x0013, 0x7ff2, 80, 76), (0x0007, 0x7ffa, 81, 77),
+    (0x0007, 0x7ffa, 82, 78), (0x0001, 0x7fff, 81, 79),
+    (0x0001, 0x7fff, 82, 80), (0x5695, 0x0000, 9, 85),
+    (0x24ee, 0x0000, 86, 226), (0x8000, 0x0000, 5, 6),
+    (0x0d30, 0x0000, 88, 176), (0x481a, 0x0000, 89, 143),
+    (0x0481, 0x0000, 90, 138), (0x3579, 0x0000, 91, 141),
+    (0x017a, 0x0000, 92, 112), (0x24ef, 0x0000, 93, 135),
+    (0x007b, 0x0000, 94, 104), (0x1978, 0x0000, 95, 133),
+    (0x0028, 0x0000, 96, 100), (0x10ca, 0x0000, 97, 129),
+    (0x000d, 0x0000, 82, 98), (0x0b5d, 0x0000, 99, 127),
+    (0x0034, 0x0000, 76, 72), (0x078a, 0x0000, 101, 125),
+    (0x00a0, 0x0000, 70, 102), (0x050f, 0x0000, 103, 123),
+    (0x0117, 0x0000, 66, 60), (0x0358, 0x0000, 105, 121),
+    (0x01ea, 0x0000, 106, 110), (0x0234, 0x0000, 107, 119),
+    (0x0144, 0x0000, 66, 108), (0x0173, 0x0000, 109, 117),
+    (0x0234, 0x0000, 60, 54), (0x00f5, 0x0000, 111, 115),
+    (0x0353, 0x0000, 56, 48), (0x00a1, 0x0000, 69, 113),
+    (0x05c5, 0x0000, 114, 134), (0x011a, 0x0000, 65, 59),
+    (0x03cf, 0x0000, 116, 132), (0x01aa, 0x0000, 61, 55),
+    (0x0285, 0x0000, 118, 130), (0x0286, 0x0000, 57, 51),
+    (0x01ab, 0x0000, 120, 128), (0x03d3, 0x0000, 53, 47),
+    (0x011a, 0x0000, 122, 126), (0x05c5, 0x0000, 49, 41),
+    (0x00ba, 0x0000, 124, 62), (0x08ad, 0x0000, 43, 37),
+    (0x007a, 0x0000, 72, 66), (0x0ccc, 0x0000, 39, 31),
+    (0x01eb, 0x0000, 60, 54), (0x1302, 0x0000, 33, 25),
+    (0x02e6, 0x0000, 56, 50), (0x1b81, 0x0000, 29, 131),
+    (0x045e, 0x0000, 52, 46), (0x24ef, 0x0000, 23, 17),
+    (0x0690, 0x0000, 48, 40), (0x2865, 0x0000, 23, 15),
+    (0x09de, 0x0000, 42, 136), (0x3987, 0x0000, 137, 7),
+    (0x0dc8, 0x0000, 38, 32), (0x2c99, 0x0000, 21, 139),
+    (0x10ca, 0x0000, 140, 172), (0x3b5f, 0x0000, 15, 9),
+    (0x0b5d, 0x0000, 142, 170), (0x5695, 0x0000, 9, 85),
+    (0x078a, 0x0000, 144, 168), (0x8000, 0x0000, 141, 248),
+    (0x050f, 0x0000, 146, 166), (0x24ee, 0x0000, 147, 247),
+    (0x0358, 0x0000, 148, 164), (0x0d30, 0x0000, 149, 197),
+    (0x0234, 0x0000, 150, 162), (0x0481, 0x0000, 151, 95),
+    (0x0173, 0x0000, 152, 160), (0x017a, 0x0000, 153, 173),
+    (0x00f5, 0x0000, 154, 158), (0x007b, 0x0000, 155, 165),
+    (0x00a1, 0x0000, 70, 156), (0x0028, 0x0000, 157, 161),
+    (0x011a, 0x0000, 66, 60), (0x000d, 0x0000, 81, 159),
+    (0x01aa, 0x0000, 62, 56), (0x0034, 0x0000, 75, 71),
+    (0x0286, 0x0000, 58, 52), (0x00a0, 0x0000, 69, 163),
+    (0x03d3, 0x0000, 54, 48), (0x0117, 0x0000, 65, 59),
+    (0x05c5, 0x0000, 50, 42), (0x01ea, 0x0000, 167, 171),
+    (0x08ad, 0x0000, 44, 38), (0x0144, 0x0000, 65, 169),
+    (0x0ccc, 0x0000, 40, 32), (0x0234, 0x0000, 59, 53),
+    (0x1302, 0x0000, 34, 26), (0x0353, 0x0000, 55, 47),
+    (0x1b81, 0x0000, 30, 174), (0x05c5, 0x0000, 175, 193),
+    (0x24ef, 0x0000, 24, 18), (0x03cf, 0x0000, 177, 191),
+    (0x2b74, 0x0000, 178, 222), (0x0285, 0x0000, 179, 189),
+    (0x201d, 0x0000, 180, 218), (0x01ab, 0x0000, 181, 187),
+    (0x1715, 0x0000, 182, 216), (0x011a, 0x0000, 183, 185),
+    (0x0fb7, 0x0000, 184, 214), (0x00ba, 0x0000, 69, 61),
+    (0x0a67, 0x0000, 186, 212), (0x01eb, 0x0000, 59, 53),
+    (0x06e7, 0x0000, 188, 210), (0x02e6, 0x0000, 55, 49),
+    (0x0496, 0x0000, 190, 208), (0x045e, 0x0000, 51, 45),
+    (0x030d, 0x0000, 192, 206), (0x0690, 0x0000, 47, 39),
+    (0x0206, 0x0000, 194, 204), (0x09de, 0x0000, 41, 195),
+    (0x0155, 0x0000, 196, 202), (0x0dc8, 0x0000, 37, 31),
+    (0x00e1, 0x0000, 198, 200), (0x2b74, 0x0000, 199, 243),
+    (0x0094, 0x0000, 72, 64), (0x201d, 0x0000, 201, 239),
+    (0x0188, 0x0000, 62, 56), (0x1715, 0x0000, 203, 237),
+    (0x0252, 0x0000, 58, 52), (0x0fb7, 0x0000, 205, 235),
+    (0x0383, 0x0000, 54, 48), (0x0a67, 0x0000, 207, 233),
+    (0x0547, 0x0000, 50, 44), (0x06e7, 0x0000, 209, 231),
+    (0x07e2, 0x0000, 46, 38), (0x0496, 0x0000, 211, 229),
+    (0x0bc0, 0x0000, 40, 34), (0x030d, 0x0000, 213, 227),
+    (0x1178, 0x0000, 36, 28), (0x0206, 0x0000, 215, 225),
+    (0x19da, 0x0000, 30, 22), (0x0155, 0x0000, 217, 223),
+    (0x24ef, 0x0000, 26, 16), (0x00e1, 0x0000, 219, 221),
+    (0x320e, 0x0000, 20, 220), (0x0094, 0x0000, 71, 63),
+    (0x432a, 0x0000, 14, 8), (0x0188, 0x0000, 61, 55),
+    (0x447d, 0x0000, 14, 224), (0x0252, 0x0000, 57, 51),
+    (0x5ece, 0x0000, 8, 2), (0x0383, 0x0000, 53, 47),
+    (0x8000, 0x0000, 228, 87), (0x0547, 0x0000, 49, 43),
+    (0x481a, 0x0000, 230, 246), (0x07e2, 0x0000, 45, 37),
+    (0x3579, 0x0000, 232, 244), (0x0bc0, 0x0000, 39, 33),
+    (0x24ef, 0x0000, 234, 238), (0x1178, 0x0000, 35, 27),
+    (0x1978, 0x0000, 138, 236), (0x19da, 0x0000, 29, 21),
+    (0x2865, 0x0000, 24, 16), (0x24ef, 0x0000, 25, 15),
+    (0x3987, 0x0000, 240, 8), (0x320e, 0x0000, 19, 241),
+    (0x2c99, 0x0000, 22, 242), (0x432a, 0x0000, 13, 7),
+    (0x3b5f, 0x0000, 16, 10), (0x447d, 0x0000, 13, 245),
+    (0x5695, 0x0000, 10, 2), (0x5ece, 0x0000, 7, 1), (0x8000, 0x0000, 244, 83),
+    (0x8000, 0x0000, 249, 250), (0x5695, 0x0000, 10, 2),
+    (0x481a, 0x0000, 89, 143), (0x481a, 0x0000, 230, 246)
+]
+_zp_p = [state[0] for state in _zp_table] + [0] * 5
+_zp_m = [state[1] for state in _zp_table] + [0] * 5
+_zp_up = [state[2] for state in _zp_table] + [0] * 5
+_zp_down = [state[3] for state in _zp_table] + [0] * 5
+# the number of leading 1 bits of every byte
+_zp_ffz = [next(bit for bit in xrange(9) if not (byte << bit) & 0x80)
+           for byte in xrange(256)]
+
+
+class _ZPDecoder:
+    """ Decoder for the ZP arithmetic coder of DjVu
+
+        decode() decodes a bit with the adaptive model contexts[index], where
+        contexts is a list of states (indices into _zp_table), which is
+        updated. decode_simple() decodes a bit without a model, with a
+        probability of 1/2.
     """
-    # TODO: parse metadata
-    metadata = {}
-    metadata['pdf'] = infilename
+
+    def __init__(self, data):
+        """Start decoding the string data"""
+        self._data = data
+        self._pos = 0
+        self._a = 0
+        self._code = (self._byte() << 8) | self._byte()
+        self._delay = 25 # bytes that can be read beyond the end of data
+        self._bits = 0 # number of bits in _buffer
+        self._buffer = 0
+        self._preload()
+        self._fence = min(self._code, 0x7fff)
+
+    def _byte(self):
+        """Return the next byte of the data, or 0xff beyond its end"""
+        self._pos += 1
+        if self._pos > len(self._data):
+            return 0xff
+        return ord(self._data[self._pos - 1])
+
+    def _preload(self):
+        """Fill up the bit buffer"""
+        while self._bits <= 24:
+            if self._pos >= len(self._data):
+                self._delay -= 1
+                if self._delay < 1:
+                    raise _DjvuError("Unexpected end of the compressed data")
+            self._buffer = ((self._buffer << 8) | self._byte()) & 0xffffffff
+            self._bits += 8
+
+    def decode(self, contexts, index):
+        """Return the next bit, decoded with the model contexts[index]"""
+        state = contexts[index]
+        z = self._a + _zp_p[state]
+        if z <= self._fence:
+            self._a = z
+            return state & 1
+        # avoid the reversal of the interval
+        limit = 0x6000 + ((z + self._a) >> 2)
+        if z > limit:
+            z = limit
+        if z > self._code:
+            contexts[index] = _zp_down[state]
+            return self._lps(z, state & 1)
+        if self._a >= _zp_m[state]:
+            contexts[index] = _zp_up[state]
+        return self._mps(z, state & 1)
+
+    def decode_simple(self):
+        """Return the next bit, decoded without a model"""
+        z = 0x8000 + (self._a >> 1)
+        if z > self._code:
+            return self._lps(z, 0)
+        return self._mps(z, 0)
+
+    def _lps(self, z, mps):
+        """Decode the less probable symbol, given the more probable mps"""
+        z = 0x10000 - z
+        self._a += z
+        self._code += z
+        # renormalize
+        if self._a >= 0xff00:
+            shift = _zp_ffz[self._a & 0xff] + 8
+        else:
+            shift = _zp_ffz[self._a >> 8]
+        self._bits -= shift
+        self._a = (self._a << shift) & 0xffff
+        self._code = ((self._code << shift) & 0xffff) \
+                     | ((self._buffer >> self._bits) & ((1 << shift) - 1))
+        if self._bits < 16:
+            self._preload()
+        self._fence = min(self._code, 0x7fff)
+        return mps ^ 1
+
+    def _mps(self, z, mps):
+        """Decode the more probable symbol mps"""
+        self._bits -= 1
+        self._a = (z << 1) & 0xffff
+        self._code = ((self._code << 1) & 0xffff) \
+                     | ((self._buffer >> self._bits) & 1)
+        if self._bits < 16:
+            self._preload()
+        self._fence = min(self._code, 0x7fff)
+        return mps
+
+class _ZPEncoder:
+    """ Encoder for the ZP arithmetic coder of DjVu, the counterpart of
+        _ZPDecoder
+
+        encode() encodes a bit with the adaptive model contexts[index],
+        which is updated in the same way as by the decoder. encode_simple()
+        encodes a bit without a model. finish() returns the encoded data.
+    """
+
+    def __init__(self):
+        """Start encoding"""
+        self._a = 0
+        self._subend = 0
+        self._buffer = 0xffffff # the bits that may still change by a carry
+        self._run = 0 # number of bits that follow the buffer
+        self._delay = 25 # leading bits that are not written
+        self._byte = 0
+        self._bits = 0 # number of bits in _byte
+        self._output = bytearray()
+
+    def encode(self, bit, contexts, index):
+        """Encode bit with the model contexts[index]"""
+        state = contexts[index]
+        z = self._a + _zp_p[state]
+        if bit != (state & 1):
+            # avoid the reversal of the interval
+            limit = 0x6000 + ((z + self._a) >> 2)
+            if z > limit:
+                z = limit
+            contexts[index] = _zp_down[state]
+            self._lps(z)
+        elif z >= 0x8000:
+            limit = 0x6000 + ((z + self._a) >> 2)
+            if z > limit:
+                z = limit
+            if self._a >= _zp_m[state]:
+                contexts[index] = _zp_up[state]
+            self._mps(z)
+        else:
+            self._a = z
+
+    def encode_simple(self, bit):
+        """Encode bit without a model"""
+        z = 0x8000 + (self._a >> 1)
+        if bit:
+            self._lps(z)
+        else:
+            self._mps(z)
+
+    def _lps(self, z):
+        """Encode the less probable symbol"""
+        z = 0x10000 - z
+        self._subend += z
+        self._a += z
+        while self._a >= 0x8000:
+            self._emit(1 - (self._subend >> 15))
+            self._subend = (self._subend << 1) & 0xffff
+            self._a = (self._a << 1) & 0xffff
+
+    def _mps(self, z):
+        """Encode the more probable symbol"""
+        self._a = z
+        if self._a >= 0x8000:
+            self._emit(1 - (self._subend >> 15))
+            self._subend = (self._subend << 1) & 0xffff
+            self._a = (self._a << 1) & 0xffff
+
+    def _emit(self, bit):
+        """Add bit (or -1, for a borrow) to the buffer, and write out the
+        bits that can no longer change"""
+        self._buffer = ((self._buffer << 1) + bit) & 0xffffffff
+        carry = self._buffer >> 24
+        self._buffer &= 0xffffff
+        if carry == 1:
+            self._write_bit(1)
+            while self._run:
+                self._write_bit(0)
+                self._run -= 1
+        elif carry == 0xff:
+            self._write_bit(0)
+            while self._run:
+                self._write_bit(1)
+                self._run -= 1
+        else:
+            self._run += 1
+
+    def _write_bit(self, bit):
+        """Write bit to the output"""
+        if self._delay > 0:
+            self._delay -= 1
+            return
+        self._byte = (self._byte << 1) | bit
+        self._bits += 1
+        if self._bits == 8:
+            self._output.append(self._byte)
+            self._byte = 0
+            self._bits = 0
+
+    def finish(self):
+        """Write out the remaining bits, and return the encoded data"""
+        if self._subend > 0x8000:
+            self._subend = 0x10000
+        elif self._subend > 0:
+            self._subend = 0x8000
+        while (self._buffer != 0xffffff) or self._subend:
+            self._emit(1 - (self._subend >> 15))
+            self._subend = (self._subend << 1) & 0xffff
+        self._write_bit(1)
+        while self._run:
+            self._write_bit(0)
+            self._run -= 1
+        # fill up the last byte
+        while self._bits > 0:
+            self._write_bit(1)
+        return str(self._output)
+
+
+def _bzz_decode(data):
+    """ Return the string that is compressed as data in the BZZ format of
+        DjVu
+
+        The data is a sequence of blocks, each coded with the ZP coder: the
+        size of the block, and the characters of its Burrows-Wheeler
+        transform, which are coded by their position in a list of the
+        recently used characters. A block of size 0 ends the data.
+    """
+    decoder = _ZPDecoder(data)
+    contexts = [0] * 300
+    blocks = []
+    while True:
+        size = _zp_decode_raw(decoder, 24)
+        if size == 0:
+            break
+        if size > 4096 * 1024:
+            raise _DjvuError("Invalid block size %i" % size)
+        # the speed with which the frequencies adapt
+        shift = 0
+        if decoder.decode_simple():
+            shift += 1
+            if decoder.decode_simple():
+                shift += 1
+        mtf = range(256)
+        frequencies = [0, 0, 0, 0]
+        increment = 4
+        block = bytearray(size)
+        marker = -1 # the position of the end of the block in the transform
+        position = 3
+        for i in xrange(size):
+            if decoder.decode(contexts, min(position, 2)):
+                position = 0
+            elif decoder.decode(contexts, 3 + min(position, 2)):
+                position = 1
+            else:
+                # the contexts of every range of positions 2**bits to
+                # 2**(bits + 1) - 1 start at first
+                first = 6
+                for bits in xrange(1, 8):
+                    if decoder.decode(contexts, first):
+                        position = 1
+                        while position < (1 << bits):
+                            position = (position << 1) \
+                                       | decoder.decode(contexts,
+                                                        first + position)
+                        break
+                    first += 1 << bits
+                else:
+                    position = 256
+                    marker = i
+                    continue
+            character = block[i] = mtf[position]
+            # move the character forward by its frequency
+            increment += increment >> shift
+            if increment > 0x10000000:
+                increment >>= 24
+                frequencies = [frequency >> 24 for frequency in frequencies]
+            frequency = increment
+            if position < 4:
+                frequency += frequencies[position]
+            k = position
+            while k >= 4:
+                mtf[k] = mtf[k - 1]
+                k -= 1
+            while k > 0 and frequency >= frequencies[k - 1]:
+                mtf[k] = mtf[k - 1]
+                frequencies[k] = frequencies[k - 1]
+                k -= 1
+            mtf[k] = character
+            frequencies[k] = frequency
+        if not 0 < marker < size:
+            raise _DjvuError("Invalid block")
+        blocks.append(_bwt_decode(block, marker))
+    return ''.join(blocks)
+
+def _zp_decode_raw(decoder, bits):
+    """Return the number of the given bits decoded without a model"""
+    number = 1
+    while number < (1 << bits):
+        number = (number << 1) | decoder.decode_simple()
+    return number - (1 << bits)
+
+def _bwt_decode(block, marker):
+    """Return the string whose Burrows-Wheeler transform is the bytearray
+    block, where the end of the string, which sorts before all characters,
+    is at the position marker"""
+    counts = [0] * 256
+    ranks = [0] * len(block)
+    for i in xrange(len(block)):
+        if i != marker:
+            character = block[i]
+            ranks[i] = counts[character]
+            counts[character] += 1
+    # the first row of every character in the sorted rotations
+    starts = [0] * 256
+    total = 1 # the row that starts with the end of the string
+    for character in xrange(256):
+        starts[character] = total
+        total += counts[character]
+    result = bytearray(len(block) - 1)
+    row = 0
+    for i in xrange(len(block) - 2, -1, -1):
+        character = result[i] = block[row]
+        row = starts[character] + ranks[row]
+    if row != marker:
+        raise _DjvuError("Invalid block")
+    return str(result)
+
+def _bzz_encode(data, blocksize=1048575):
+    """ Return the string data compressed in the BZZ format of DjVu (see
+        _bzz_decode), in blocks of blocksize characters
+
+        The characters of every block are coded with the same models as
+        djvulibre uses, so that the result is the same as that of
+        'bzz -e'.
+    """
+    encoder = _ZPEncoder()
+    contexts = [0] * 300
+    for start in xrange(0, len(data), blocksize):
+        (block, marker) = _bwt_encode(data[start:start + blocksize])
+        size = len(block)
+        _zp_encode_raw(encoder, size, 24)
+        # larger blocks adapt the frequencies more slowly
+        if size < 100000:
+            shift = 0
+            encoder.encode_simple(0)
+        elif size < 1000000:
+            shift = 1
+            encoder.encode_simple(1)
+            encoder.encode_simple(0)
+        else:
+            shift = 2
+            encoder.encode_simple(1)
+            encoder.encode_simple(1)
+        mtf = range(256)
+        positions = range(256) # the position of every character in mtf
+        frequencies = [0, 0, 0, 0]
+        increment = 4
+        position = 3
+        for i in xrange(size):
+            context = min(position, 2)
+            if i == marker:
+                position = 256
+            else:
+                character = block[i]
+                position = positions[character]
+            encoder.encode(position == 0, contexts, context)
+            if position > 0:
+                encoder.encode(position == 1, contexts, 3 + context)
+            if position > 1:
+                first = 6
+                for bits in xrange(1, 8):
+                    found = position < (2 << bits)
+                    encoder.encode(found, contexts, first)
+                    if found:
+                        # the bits below the leading one, each coded in
+                        # the context of the ones before it
+                        index = 1
+                        for bit in xrange(bits - 1, -1, -1):
+                            value = (position >> bit) & 1
+                            encoder.encode(value, contexts, first + index)
+                            index = (index << 1) | value
+                        break
+                    first += 1 << bits
+            if position == 256:
+                continue
+            # move the character forward by its frequency, as the decoder
+            increment += increment >> shift
+            if increment > 0x10000000:
+                increment >>= 24
+                frequencies = [frequency >> 24 for frequency in frequencies]
+            frequency = increment
+            if position < 4:
+                frequency += frequencies[position]
+            k = position
+            while k >= 4:
+                mtf[k] = mtf[k - 1]
+                positions[mtf[k]] = k
+                k -= 1
+            while k > 0 and frequency >= frequencies[k - 1]:
+                mtf[k] = mtf[k - 1]
+                positions[mtf[k]] = k
+                frequencies[k] = frequencies[k - 1]
+                k -= 1
+            mtf[k] = character
+            positions[character] = k
+            frequencies[k] = frequency
+    _zp_encode_raw(encoder, 0, 24)
+    return encoder.finish()
+
+def _zp_encode_raw(encoder, number, bits):
+    """Encode the number as the given bits without a model"""
+    for bit in xrange(bits - 1, -1, -1):
+        encoder.encode_simple((number >> bit) & 1)
+
+def _bwt_encode(data):
+    """Return a tuple (block, marker), where the bytearray block is the
+    Burrows-Wheeler transform of the string data, and marker the position
+    of its end, which sorts before all characters (see _bwt_decode)"""
+    size = len(data)
+    # sort the suffixes by their first length characters, then tell those
+    # with the same ones apart by the suffixes length characters further
+    # on, doubling length until all are told apart
+    length = 32
+    order = sorted(xrange(size + 1), key=lambda i: data[i:i + length])
+    key = lambda i: data[i:i + length]
+    while True:
+        ranks = [0] * (size + 1)
+        previous = None
+        groups = 0
+        for (row, i) in enumerate(order):
+            current = key(i)
+            if current != previous:
+                first = row
+                previous = current
+                groups += 1
+            ranks[i] = first
+        if groups > size:
+            break
+        keys = [(ranks[i], ranks[i + length] if i + length <= size else -1)
+                for i in xrange(size + 1)]
+        order.sort(key=keys.__getitem__)
+        key = keys.__getitem__
+        length *= 2
+    block = bytearray(size + 1)
+    marker = 0
+    for (row, i) in enumerate(order):
+        if i == 0:
+            marker = row
+        else:
+            block[row] = data[i - 1]
+    return (block, marker)
+
+
+def _iff_chunks(fp, start, end):
+    """Yield a tuple (id, offset, size) for every chunk of the IFF file fp
+    between the offsets start and end, where offset is the start of the
+    data of the chunk. For a FORM, id is 'FORM:' followed by its type,
+    and the data starts after the type. Only the chunk headers are read."""
+    offset = start
+    while offset + 8 <= end:
+        fp.seek(offset)
+        header = fp.read(8)
+        if len(header) < 8:
+            break
+        chunk_id = header[:4]
+        size = struct.unpack(">I", header[4:])[0]
+        if offset + 8 + size > end:
+            raise _DjvuError("The chunk %s at %i is truncated"
+                             % (chunk_id, offset))
+        if chunk_id == 'FORM':
+            chunk_id += ':' + fp.read(4)
+            yield (chunk_id, offset + 12, size - 4)
+        else:
+            yield (chunk_id, offset + 8, size)
+        # chunks start at even offsets
+        offset += 8 + size + (size & 1)
+
+def _djvu_form(fp):
+    """Return a tuple (type, start, end) for the FORM that makes up the
+    djvu file fp, with the offsets of its first chunk and of its end. The
+    end is that of the file if the file is truncated."""
+    fp.seek(0, 2)
+    filesize = fp.tell()
+    fp.seek(0)
+    start = 0
+    header = fp.read(16)
+    if header[:4] == 'AT&T':
+        start = 4
+        header = header[4:]
+    if (len(header) < 12) or (header[:4] != 'FORM'):
+        raise _DjvuError("Not a djvu file")
+    size = struct.unpack(">I", header[4:8])[0]
+    return (header[8:12], start + 12, min(start + 8 + size, filesize))
+
+def _djvu_outline(fp):
+    """Return the decoded NAVM chunk of the djvu file fp, or None if it has
+    no outline"""
+    (form_type, start, end) = _djvu_form(fp)
+    if form_type != 'DJVM':
+        # single page documents have no outline
+        return None
+    for (chunk_id, offset, size) in _iff_chunks(fp, start, end):
+        if chunk_id == 'NAVM':
+            fp.seek(offset)
+            return _bzz_decode(fp.read(size))
+    return None
+
+def _djvu_target(fields, target):
+    """Set the action of the bookmark fields according to the djvu link
+    target, which is a page number ('#12'), a page in another file
+    ('file.djvu#12'), or a URI"""
+    if target.find("#") < 0: # Target is URI
+        fields['action'] = "URI"
+        fields['uri'] = target
+    elif re.match(r"#[0-9]+", target): # Target is Page Reference
+        fields['action'] = "GoTo"
+        fields['page'] = int(target[1:])
+    else: # Target is external
+        fields['action'] = "GoToR"
+        fields['file'] = target.split("#")[0]
+        fields['page'] = target.split("#")[1]
+
+def _djvu_link(node):
+    """Return the djvu link target of the bookmark node (see _djvu_target),
+    or None for a URI bookmark without a URI"""
+    if node.action == "GoTo":
+        return u"#%s" % node.page
+    elif node.action == "GoToR":
+        return u"%s#%s" % (unicode(node.file), node.page)
+    elif node.action == "URI":
+        return node.uri
+    return u""
+
+
+def iter_djvu(infilename):
+    """ Read the bookmarks directly from a (bundled or indirect) djvu file,
+        and yield a tuple (level, fields) for every bookmark, in preorder
+        (see iter_xml). Instead of a file name, infilename may be a seekable
+        file-like object opened in binary mode.
+
+        The bookmarks are the same as read_djvused finds in the output of
+        'djvused -e print-outline', but no external program is needed: the
+        outline is the NAVM chunk of the document, which is found by
+        skipping the other chunks, and decoded by a built-in BZZ decoder.
+        For an indirect document, infilename is the index file.
+    """
+    if input_compression(infilename) is not None:
+        fp = cStringIO.StringIO(''.join(input_blocks(infilename)))
+    elif is_filelike(infilename):
+        fp = infilename
+    else:
+        fp = open(infilename, 'rb')
     try:
-        from pdfminer.psparser  import PSKeyword, PSLiteral
-        from pdfminer.pdfparser import PDFDocument, PDFParser, \
-                                       PDFNoOutlines, PDFDestinationNotFound
-        from pdfminer.pdftypes  import PDFStream, PDFObjRef, resolve1, \
-                                       stream_value
-    except ImportError:
-        die("You must install the pdfminer package to read bookmarkds "
-            "directly from pdf")
-    def resolve_dest(dest):
-        if isinstance(dest, str):
+        try:
+            outline = _djvu_outline(fp)
+        except (_DjvuError, struct.error), details:
+            die("Cannot read the djvu file: %s" % details)
+    finally:
+        if fp is not infilename:
+            fp.close()
+    if outline is None:
+        return
+    # the number of bookmarks, and then every bookmark in preorder, with
+    # the number of its children, and the lengths of its title and target
+    position = 2
+    remaining = [] # the number of children still to come on every level
+    for i in xrange(struct.unpack(">H", outline[:2])[0]):
+        if position + 7 > len(outline):
+            die("Cannot read the djvu file: the outline is truncated")
+        children = ord(outline[position])
+        length = struct.unpack(">I", "\0" + outline[position + 1:
+                                                    position + 4])[0]
+        title = outline[position + 4:position + 4 + length]
+        position += 4 + length
+        length = struct.unpack(">I", "\0" + outline[position:
+                                                    position + 3])[0]
+        target = outline[position + 3:position + 3 + length]
+        position += 3 + length
+        while remaining and remaining[-1] == 0:
+            remaining.pop()
+        if remaining:
+            remaining[-1] -= 1
+        fields = {'title': title.decode('utf-8', 'replace')}
+        _djvu_target(fields, target.decode('utf-8', 'replace'))
+        yield (len(remaining) + 1, fields)
+        remaining.append(children)
+
+
+def read_djvu(infilename):
+    """ Read the bookmarks directly from a djvu file (see iter_djvu), and
+        return a tuple (root, metadata) where root is a root bookmark node.
+        The root node itself is empty, and contains all the bookmarks as
+        children. The key 'djvu' of the metadata is set to the value of
+        infilename, so that write_djvu adds the bookmarks to the same file.
+    """
+    root = build_tree(iter_djvu(infilename))
+    if is_filelike(infilename):
+        infilename = getattr(infilename, 'name', None)
+    if infilename is None:
+        return (root, {})
+    return (root, {'djvu': infilename})
+
+
+def _djvu_navm(root):
+    """Return the content of the NAVM chunk, before its compression, for the
+    bookmarks in the tree root: their number, and then every bookmark in
+    preorder, with the number of its children, and its title and target"""
+    records = []
+    stack = list(reversed(root.children()))
+    while stack:
+        node = stack.pop()
+        children = node.children()
+        if len(children) > 255:
+            # the message of a _DjvuError is a str, like the file names
+            raise _DjvuError("the bookmark '%s' has %i children, but at "
+                             "most 255 are possible"
+                             % (unicode(node.title).encode('utf-8'),
+                                len(children)))
+        title = unicode(node.title).encode('utf-8')
+        target = (_djvu_link(node) or u"").encode('utf-8')
+        records.append(chr(len(children))
+                       + struct.pack(">I", len(title))[1:] + title
+                       + struct.pack(">I", len(target))[1:] + target)
+        stack.extend(reversed(children))
+    if len(records) > 65535:
+        raise _DjvuError("there are %i bookmarks, but at most 65535 are "
+                         "possible" % len(records))
+    return struct.pack(">H", len(records)) + ''.join(records)
+
+def _djvu_layout(fp, navm):
+    """ Return the djvu file fp with the outline replaced by the compressed
+        NAVM chunk navm (or removed, if navm is None), as a list of pieces,
+        which are either strings, or tuples (offset, size) of data that is
+        copied unchanged from fp.
+
+        The NAVM chunk follows the directory (the DIRM chunk). In a bundled
+        document, the directory holds the offsets of the files that follow,
+        which are adjusted to their new positions.
+    """
+    (form_type, start, end) = _djvu_form(fp)
+    if form_type != 'DJVM':
+        raise _DjvuError("a single page document cannot have an outline")
+    pieces = [None] # the header of the FORM, which needs its size
+    position = start # the offset in the new file
+    positions = {} # the new offsets of the chunks, by their old offsets
+    directory = None # the index of the DIRM chunk in pieces
+    for (chunk_id, offset, size) in _iff_chunks(fp, start, end):
+        if chunk_id == 'NAVM':
+            continue
+        # chunks start at even offsets
+        if position & 1:
+            pieces.append('\0')
+            position += 1
+        header = offset - (chunk_id.startswith('FORM:') and 12 or 8)
+        positions[header] = position
+        pieces.append((header, offset + size - header))
+        position += offset + size - header
+        if chunk_id == 'DIRM' and directory is None:
+            directory = len(pieces) - 1
+            if navm is not None:
+                if position & 1:
+                    pieces.append('\0')
+                    position += 1
+                pieces.append('NAVM' + struct.pack(">I", len(navm)) + navm)
+                position += 8 + len(navm)
+    if directory is None:
+        raise _DjvuError("the document has no directory")
+    (header, size) = pieces[directory]
+    fp.seek(header)
+    dirm = fp.read(size)
+    if ord(dirm[8]) & 0x80:
+        # a bundled document
+        count = struct.unpack(">H", dirm[9:11])[0]
+        offsets = struct.unpack(">%iI" % count, dirm[11:11 + 4 * count])
+        try:
+            offsets = [positions[offset] for offset in offsets]
+        except KeyError, details:
+            raise _DjvuError("the directory refers to the offset %s, where "
+                             "no file starts" % details)
+        pieces[directory] = dirm[:11] + struct.pack(">%iI" % count, *offsets) \
+                            + dirm[11 + 4 * count:]
+    pieces[0] = (start > 12 and 'AT&T' or '') + 'FORM' \
+                + struct.pack(">I", position - start + 4) + 'DJVM'
+    return pieces
+
+
+def write_djvu(root, outfilename, metadata={}):
+    """ Add the bookmarks to the djvu file metadata['djvu'], replacing its
+        outline, and write the result to outfilename.
+
+        The bookmarks are the same that djvused adds with the 'set-outline'
+        command of the output of write_djvused, but no external program is
+        needed: the outline is compressed by a built-in BZZ encoder into a
+        NAVM chunk, which takes the place of the old one. The other chunks
+        are copied unchanged, except for the sizes and offsets in the headers
+        and the directory that change with it. Without bookmarks, the
+        outline is removed.
+
+        The djvu file must be a bundled document, or the index file of an
+        indirect one, where only the index file is written. Single page
+        documents cannot have an outline.
+    """
+    if not metadata.has_key('djvu'):
+        die("No key 'djvu' in the metadata. Use the --djvu option to give "
+            "the djvu file that the bookmarks are added to")
+    djvufilename = metadata['djvu']
+    if input_compression(djvufilename) is not None:
+        fp = cStringIO.StringIO(''.join(input_blocks(djvufilename)))
+    else:
+        fp = open(djvufilename, 'rb')
+    try:
+        try:
+            navm = None
+            if root.children():
+                navm = _bzz_encode(_djvu_navm(root))
+            pieces = _djvu_layout(fp, navm)
+        except (_DjvuError, struct.error), details:
+            die("Cannot add the bookmarks to '%s': %s" % (djvufilename,
+                                                          details))
+        outfile = OutputFile(outfilename)
+        for piece in pieces:
+            if isinstance(piece, str):
+                outfile.write_bytes(piece)
+                continue
+            (offset, size) = piece
+            fp.seek(offset)
+            while size > 0:
+                block = fp.read(min(size, 1048576))
+                outfile.write_bytes(block)
+                size -= len(block)
+    finally:
+        # the output may replace the djvu file itself
+        fp.close()
+    outfile.close()
+
+
+# Pdf reader
+#
+# A minimal reader for the parts of a pdf file that are needed to extract the
+# outline: the cross-reference tables and streams, object streams, and the
+# objects of the document catalog, the outline, the page tree, and the named
+# destinations. Objects are only parsed when they are resolved. The objects
+# are represented like in pdfminer, so that the outline can be extracted by
+# the same code with both: names are _PdfName objects, whose repr() is e.g.
+# '/GoTo', references are _PdfRef objects with an objid attribute, strings
+# are byte strings, and dictionaries are dicts with the names of the keys (as
+# strings) as keys.
+
+class _PdfError(Exception):
+    """A pdf file, or a part of it, that the native reader cannot read"""
+
+
+class _PdfName:
+    """A pdf name object, e.g. /GoTo (with the name 'GoTo')"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return '/' + self.name
+
+    __str__ = __repr__
+
+    def __eq__(self, other):
+        return isinstance(other, _PdfName) and (other.name == self.name)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash(self.name)
+
+
+class _PdfRef:
+    """A reference to the indirect object objid"""
+
+    def __init__(self, objid, genno=0):
+        self.objid = objid
+        self.genno = genno
+
+    def __repr__(self):
+        return "<%i %i R>" % (self.objid, self.genno)
+
+
+class _PdfStream:
+    """A pdf stream, with its dictionary attrs, whose undecoded data is
+    data[start:end]. The data is only copied out of the file when it is
+    needed."""
+
+    def __init__(self, attrs, data, start, end):
+        self.attrs = attrs
+        self._data = data
+        self._start = start
+        self._end = end
+
+    def get(self, key, default=None):
+        """Return the entry key of the stream dictionary"""
+        return self.attrs.get(key, default)
+
+    def get_rawdata(self):
+        """Return the undecoded data of the stream"""
+        return self._data[self._start:self._end]
+
+
+# characters that end a regular token
+_pdf_regular = r'[^\x00\t\n\x0c\r ()<>\[\]{}/%]'
+_pdf_space_re = re.compile(r'(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*')
+# a token, with the whitespace and comments before it
+_pdf_token_re = re.compile(
+    r'(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*(?:'
+    r'(?P<ref>([0-9]+)[\x00\t\n\x0c\r ]+([0-9]+)[\x00\t\n\x0c\r ]+R'
+    r'(?!' + _pdf_regular + r'))'
+    r'|(?P<number>[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))'
+    r'|(?P<name>/' + _pdf_regular + r'*)'
+    r'|(?P<open_dict><<)|(?P<close_dict>>>)'
+    r'|(?P<open_array>\[)|(?P<close_array>\])'
+    r'|(?P<hex><[0-9A-Fa-f\x00\t\n\x0c\r ]*>)'
+    r'|(?P<literal>\()'
+    r'|(?P<keyword>' + _pdf_regular + r'+))')
+_pdf_literal_re = re.compile(r'[()\\]')
+_pdf_escape_re = re.compile(r'[0-7]{1,3}|\r\n|[\s\S]')
+_pdf_escapes = {'n': '\n', 'r': '\r', 't': '\t', 'b': '\b', 'f': '\f',
+                '\r\n': '', '\r': '', '\n': ''}
+_pdf_keywords = {'true': True, 'false': False, 'null': None}
+_pdf_names = {} # name => _PdfName, so that every name exists only once
+
+def _pdf_name(name):
+    """Return the _PdfName for the undecoded name (without the slash)"""
+    try:
+        return _pdf_names[name]
+    except KeyError:
+        decoded = name
+        if '#' in name:
+            decoded = re.sub(r'#([0-9A-Fa-f]{2})',
+                             lambda m: chr(int(m.group(1), 16)), name)
+        _pdf_names[name] = _PdfName(decoded)
+        return _pdf_names[name]
+
+def _pdf_literal(data, pos):
+    """Parse the rest of the literal string whose opening parenthesis ends at
+    offset pos of data. Return the string and the offset after it"""
+    parts = []
+    depth = 1
+    while True:
+        match = _pdf_literal_re.search(data, pos)
+        if match is None:
+            raise _PdfError("Unterminated string")
+        parts.append(data[pos:match.start()])
+        pos = match.end()
+        character = match.group()
+        if character == '(':
+            depth += 1
+        elif character == ')':
+            depth -= 1
+            if depth == 0:
+                return (''.join(parts), pos)
+        else:
+            escape = _pdf_escape_re.match(data, pos)
+            if escape is None:
+                raise _PdfError("Unterminated string")
+            pos = escape.end()
+            character = escape.group()
+            if character[0] in '01234567':
+                character = chr(int(character, 8) & 255)
+            else:
+                character = _pdf_escapes.get(character, character)
+        parts.append(character)
+
+def _pdf_parse(data, pos):
+    """Parse the pdf object at offset pos of data (a string, or an mmap).
+    Return the object, and the offset after it. A keyword that is not part
+    of an object (e.g. 'stream', or 'endobj') is returned as a string,
+    wrapped in a tuple."""
+    stack = [] # (is_dict, items) of the arrays and dicts being parsed
+    while True:
+        match = _pdf_token_re.match(data, pos)
+        if match is None:
+            raise _PdfError("Unexpected data at offset %i" % pos)
+        kind = match.lastgroup
+        pos = match.end()
+        if kind == 'ref':
+            obj = _PdfRef(int(match.group(2)), int(match.group(3)))
+        elif kind == 'number':
+            token = match.group(kind)
+            if '.' in token:
+                obj = float(token)
+            else:
+                obj = int(token)
+        elif kind == 'name':
+            obj = _pdf_name(match.group(kind)[1:])
+        elif kind == 'literal':
+            obj, pos = _pdf_literal(data, pos)
+        elif kind == 'hex':
+            digits = re.sub(r'[^0-9A-Fa-f]', '', match.group(kind))
+            if len(digits) % 2:
+                digits += '0'
+            obj = binascii.unhexlify(digits)
+        elif kind in ('open_dict', 'open_array'):
+            stack.append((kind == 'open_dict', []))
+            continue
+        elif kind in ('close_dict', 'close_array'):
+            if not stack:
+                raise _PdfError("Unexpected %s at offset %i"
+                                % (match.group(kind), match.start(kind)))
+            is_dict, items = stack.pop()
+            if is_dict:
+                obj = {}
+                for i in xrange(0, len(items) - 1, 2):
+                    if isinstance(items[i], _PdfName):
+                        obj[items[i].name] = items[i + 1]
+            else:
+                obj = items
+        else:
+            keyword = match.group(kind)
+            if keyword in _pdf_keywords:
+                obj = _pdf_keywords[keyword]
+            elif stack:
+                # as in pdfminer, unknown keywords in objects are ignored
+                continue
+            else:
+                return ((keyword,), pos)
+        if not stack:
+            return (obj, pos)
+        stack[-1][1].append(obj)
+
+
+def _pdf_predict(data, parameters):
+    """Undo the PNG or TIFF predictor given in the dict parameters (the
+    /DecodeParms of a stream) on data"""
+    predictor = parameters.get('Predictor', 1)
+    if predictor == 1:
+        return data
+    colors = parameters.get('Colors', 1)
+    bits = parameters.get('BitsPerComponent', 8)
+    columns = parameters.get('Columns', 1)
+    pixel = max(1, colors * bits // 8) # bytes per pixel
+    width = (colors * bits * columns + 7) // 8 # bytes per row
+    if predictor == 2:
+        if bits != 8:
+            raise _PdfError("Unsupported TIFF predictor")
+        rows = []
+        for start in xrange(0, len(data), width):
+            row = bytearray(data[start:start + width])
+            for i in xrange(pixel, len(row)):
+                row[i] = (row[i] + row[i - pixel]) & 255
+            rows.append(str(row))
+        return ''.join(rows)
+    rows = []
+    previous = bytearray(width)
+    for start in xrange(0, len(data), width + 1):
+        kind = ord(data[start])
+        row = bytearray(data[start + 1:start + 1 + width])
+        row.extend(bytearray(width - len(row)))
+        if kind == 1: # Sub
+            for i in xrange(pixel, width):
+                row[i] = (row[i] + row[i - pixel]) & 255
+        elif kind == 2: # Up
+            row = bytearray(map(lambda a, b: (a + b) & 255, row, previous))
+        elif kind == 3: # Average
+            for i in xrange(width):
+                left = row[i - pixel] if i >= pixel else 0
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 255
+        elif kind == 4: # Paeth
+            for i in xrange(width):
+                left = row[i - pixel] if i >= pixel else 0
+                upper_left = previous[i - pixel] if i >= pixel else 0
+                estimate = left + previous[i] - upper_left
+                if abs(estimate - left) <= min(abs(estimate - previous[i]),
+                                               abs(estimate - upper_left)):
+                    closest = left
+                elif abs(estimate - previous[i]) <= abs(estimate - upper_left):
+                    closest = previous[i]
+                else:
+                    closest = upper_left
+                row[i] = (row[i] + closest) & 255
+        elif kind != 0:
+            raise _PdfError("Unknown PNG predictor %i" % kind)
+        rows.append(str(row))
+        previous = row
+    return ''.join(rows)
+
+
+class _PdfReader:
+    """ Random access to the objects of a pdf file
+
+        data is the content of the file, as a string, or as an mmap of the
+        file. The cross-reference tables (or streams) are read on
+        construction, with all previous versions of the file. If they are
+        damaged, the objects are found by scanning the whole file instead.
+        All other objects are parsed directly from data at their offsets
+        when they are resolved, and the data of streams is only copied when
+        they are decoded. Thus, for an mmap, only the parts of the file that
+        are actually used are read from the disk. Encrypted files are not
+        supported.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._xref = {} # objid => (1, offset), (2, objstm objid, index), or
+                        # None for a free object
+        self._objects = {} # objid => parsed object
+        self._objstms = {} # objid => (list of (objid, offset), data)
+        self._reconstructed = False
+        self.trailer = {}
+        # the offset of the newest cross-reference section, and whether it
+        # is a stream, for appending an update (None if it was damaged)
+        self.startxref = None
+        self.xref_stream = False
+        try:
+            self._read_xrefs()
+        except (_PdfError, ValueError, IndexError, zlib.error):
+            self._reconstruct()
+        if 'Encrypt' in self.trailer:
+            raise _PdfError("Encrypted pdf files are not supported")
+        self.catalog = self.resolve(self.trailer.get('Root'))
+        if not isinstance(self.catalog, dict) and not self._reconstructed:
+            self._reconstruct()
+            self.catalog = self.resolve(self.trailer.get('Root'))
+        if not isinstance(self.catalog, dict):
+            raise _PdfError("The document catalog is missing")
+
+    def resolve(self, obj):
+        """Return the object that obj refers to, if it is a reference, and
+        obj itself otherwise"""
+        for i in xrange(32):
+            if not isinstance(obj, _PdfRef):
+                return obj
+            obj = self.getobj(obj.objid)
+        raise _PdfError("Too many levels of references")
+
+    def size(self):
+        """Return the number of the first object that is not in use"""
+        size = self.resolve(self.trailer.get('Size'))
+        if not isinstance(size, int):
+            size = 0
+        return max([size] + [objid + 1 for objid in self._xref])
+
+    def getobj(self, objid):
+        """Return the indirect object objid (None if it does not exist)"""
+        if objid not in self._objects:
+            entry = self._xref.get(objid)
             try:
-                dest = resolve1(doc.get_dest(dest))
-            except PDFDestinationNotFound:
-                warn("Destination not found: %s" % dest)
-        elif isinstance(dest, PSLiteral):
-            dest = resolve1(doc.get_dest(dest.name))
+                if entry is None:
+                    obj = None
+                elif entry[0] == 1:
+                    obj = self._parse_indirect(objid, entry[1])
+                else:
+                    obj = self._parse_compressed(objid, entry[1], entry[2])
+            except (ValueError, IndexError, TypeError, zlib.error), details:
+                raise _PdfError("Damaged object %i: %s" % (objid, details))
+            self._objects[objid] = obj
+        return self._objects[objid]
+
+    _header_re = re.compile(r'[\x00\t\n\x0c\r ]*([0-9]+)[\x00\t\n\x0c\r ]+'
+                            r'([0-9]+)[\x00\t\n\x0c\r ]+obj(?!' + _pdf_regular
+                            + r')')
+
+    _stream_re = re.compile(r'(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*stream(?!'
+                            + _pdf_regular + r')')
+
+    def _parse_indirect(self, objid, offset):
+        """Parse the indirect object objid at offset, including the stream,
+        if it is one"""
+        match = self._header_re.match(self.data, offset)
+        if (match is None) or (int(match.group(1)) != objid):
+            if self._reconstructed:
+                raise _PdfError("Object %i not found" % objid)
+            # the offsets in the cross-reference table are wrong
+            self._reconstruct()
+            return self.getobj(objid)
+        obj, pos = _pdf_parse(self.data, match.end())
+        if isinstance(obj, dict):
+            match = self._stream_re.match(self.data, pos)
+            if match is not None:
+                obj = self._parse_stream(obj, match.end())
+        return obj
+
+    def _parse_stream(self, attrs, pos):
+        """Return the _PdfStream with the dictionary attrs, whose keyword
+        'stream' ends at pos"""
+        data = self.data
+        if data[pos:pos + 2] == '\r\n':
+            pos += 2
+        elif data[pos:pos + 1] in ('\n', '\r'):
+            pos += 1
+        length = attrs.get('Length')
+        try:
+            length = self.resolve(length)
+        except _PdfError:
+            length = None
+        end = None
+        if isinstance(length, int) and (length >= 0):
+            match = _pdf_space_re.match(data, pos + length)
+            if data[match.end():match.end() + 9] == 'endstream':
+                end = pos + length
+        if end is None:
+            # the length is wrong, so the stream ends before 'endstream'
+            end = data.find('endstream', pos)
+            if end < 0:
+                raise _PdfError("Unterminated stream")
+            if data[end - 2:end] == '\r\n':
+                end -= 2
+            elif data[end - 1:end] in ('\n', '\r'):
+                end -= 1
+        return _PdfStream(attrs, data, pos, end)
+
+    def decode(self, stream):
+        """Return the decoded data of the _PdfStream stream"""
+        filters = self.resolve(stream.get('Filter', []))
+        parameters = self.resolve(stream.get('DecodeParms', []))
+        if not isinstance(filters, list):
+            filters = [filters]
+        if not isinstance(parameters, list):
+            parameters = [parameters]
+        data = stream.get_rawdata()
+        for (i, name) in enumerate(filters):
+            name = getattr(self.resolve(name), 'name', None)
+            if i < len(parameters) and isinstance(self.resolve(parameters[i]),
+                                                  dict):
+                parameter = self.resolve(parameters[i])
+            else:
+                parameter = {}
+            if name in ('FlateDecode', 'Fl'):
+                # a decompressobj tolerates garbage after the end of the data
+                data = zlib.decompressobj().decompress(data)
+                data = _pdf_predict(data, parameter)
+            elif name in ('ASCIIHexDecode', 'AHx'):
+                digits = re.sub(r'[^0-9A-Fa-f]', '', data.split('>')[0])
+                if len(digits) % 2:
+                    digits += '0'
+                data = binascii.unhexlify(digits)
+            else:
+                raise _PdfError("Unsupported filter %s" % name)
+        return data
+
+    def _parse_compressed(self, objid, stmid, index):
+        """Parse the object objid, which is the object number index in the
+        object stream stmid"""
+        if stmid not in self._objstms:
+            stream = self.getobj(stmid)
+            if not isinstance(stream, _PdfStream):
+                raise _PdfError("Object stream %i not found" % stmid)
+            data = self.decode(stream)
+            first = self.resolve(stream.get('First'))
+            count = self.resolve(stream.get('N'))
+            numbers = data[:first].split()
+            offsets = [(int(numbers[i]), first + int(numbers[i + 1]))
+                       for i in xrange(0, 2 * count, 2)]
+            self._objstms[stmid] = (offsets, data)
+        offsets, data = self._objstms[stmid]
+        if (index >= len(offsets)) or (offsets[index][0] != objid):
+            # the index is wrong, but the object may still be in the stream
+            index = [number for (number, offset)
+                     in offsets].index(objid)
+        return _pdf_parse(data, offsets[index][1])[0]
+
+    def _read_xrefs(self):
+        """Read all cross-reference sections, starting with the last one"""
+        data = self.data
+        position = data.rfind('startxref', max(0, len(data) - 4096))
+        if position < 0:
+            raise _PdfError("startxref not found")
+        offsets = [_pdf_parse(data, position + 9)[0]]
+        self.startxref = offsets[0]
+        seen = set()
+        while offsets:
+            offset = offsets.pop(0)
+            if not isinstance(offset, int) or offset in seen:
+                continue
+            seen.add(offset)
+            start = _pdf_space_re.match(data, offset).end()
+            if data[start:start + 4] == 'xref':
+                trailer = self._read_xref_table(start + 4)
+            else:
+                trailer = self._read_xref_stream(offset)
+                self.xref_stream |= (offset == self.startxref)
+            for (key, value) in trailer.items():
+                self.trailer.setdefault(key, value)
+            # in a hybrid file, the entries of the stream come after those of
+            # the table, but before those of the previous sections
+            offsets[0:0] = [trailer.get('XRefStm'), trailer.get('Prev')]
+        if not self._xref:
+            raise _PdfError("No cross-reference entries found")
+
+    _xref_section_re = re.compile(r'([0-9]+)[\x00\t\n\x0c\r ]+([0-9]+)')
+    _xref_entry_re = re.compile(r'([0-9]{10})[ ]([0-9]{5})[ ]([nf])')
+
+    def _read_xref_table(self, pos):
+        """Read the cross-reference table that starts at pos (after the
+        keyword 'xref'). Return the trailer dictionary"""
+        data = self.data
+        while True:
+            pos = _pdf_space_re.match(data, pos).end()
+            match = self._xref_section_re.match(data, pos)
+            if match is None:
+                break
+            start, count = int(match.group(1)), int(match.group(2))
+            pos = _pdf_space_re.match(data, match.end()).end()
+            # the entries are 20 bytes each, but not all files get this right
+            entries = self._xref_entry_re.findall(data[pos:pos + 20 * count])
+            if len(entries) == count:
+                pos += 20 * count
+            else:
+                entries = []
+                for i in xrange(count):
+                    pos = _pdf_space_re.match(data, pos).end()
+                    entry = self._xref_entry_re.match(data, pos)
+                    if entry is None:
+                        raise _PdfError("Damaged cross-reference table")
+                    entries.append(entry.groups())
+                    pos = entry.end()
+            for (i, (offset, generation, kind)) in enumerate(entries):
+                if kind == 'n':
+                    self._xref.setdefault(start + i, (1, int(offset)))
+                else:
+                    self._xref.setdefault(start + i, None)
+        if data[pos:pos + 7] != 'trailer':
+            raise _PdfError("trailer not found")
+        trailer = _pdf_parse(data, pos + 7)[0]
+        if not isinstance(trailer, dict):
+            raise _PdfError("Damaged trailer")
+        return trailer
+
+    def _read_xref_stream(self, offset):
+        """Read the cross-reference stream at offset. Return its dictionary,
+        which is the trailer"""
+        match = self._header_re.match(self.data, offset)
+        if match is None:
+            raise _PdfError("No cross-reference section at offset %i"
+                            % offset)
+        stream = self._parse_indirect(int(match.group(1)), offset)
+        if not isinstance(stream, _PdfStream):
+            raise _PdfError("Damaged cross-reference stream")
+        data = self.decode(stream)
+        widths = self.resolve(stream.get('W'))
+        index = self.resolve(stream.get('Index',
+                                        [0, self.resolve(stream.get('Size'))]))
+        row = sum(widths)
+        position = 0
+        for i in xrange(0, len(index) - 1, 2):
+            for objid in xrange(index[i], index[i] + index[i + 1]):
+                fields = []
+                for width in widths:
+                    value = 0
+                    for byte in data[position:position + width]:
+                        value = (value << 8) + ord(byte)
+                    fields.append(value)
+                    position += width
+                if position > len(data):
+                    raise _PdfError("Damaged cross-reference stream")
+                if widths[0] == 0:
+                    fields[0] = 1
+                if fields[0] == 1:
+                    self._xref.setdefault(objid, (1, fields[1]))
+                elif fields[0] == 2:
+                    self._xref.setdefault(objid, (2, fields[1], fields[2]))
+                else:
+                    self._xref.setdefault(objid, None)
+        return stream.attrs
+
+    _any_header_re = re.compile(r'(?<![0-9])([0-9]+)[\x00\t\n\x0c\r ]+'
+                                r'([0-9]+)[\x00\t\n\x0c\r ]+obj(?!'
+                                + _pdf_regular + r')')
+
+    def _reconstruct(self):
+        """Find all objects by scanning the file, for a file whose
+        cross-reference sections are damaged"""
+        data = self.data
+        self._reconstructed = True
+        self.startxref = None
+        self._xref = {}
+        self._objects = {}
+        self._objstms = {}
+        for match in self._any_header_re.finditer(data):
+            # later objects replace earlier ones, as in incremental updates
+            self._xref[int(match.group(1))] = (1, match.start())
+        trailers = []
+        position = data.find('trailer')
+        while position >= 0:
+            try:
+                trailer = _pdf_parse(data, position + 7)[0]
+                if isinstance(trailer, dict):
+                    trailers.append(trailer)
+            except _PdfError:
+                pass
+            position = data.find('trailer', position + 7)
+        objids = sorted(self._xref)
+        for objid in objids:
+            try:
+                obj = self.getobj(objid)
+            except _PdfError:
+                continue
+            if isinstance(obj, _PdfStream):
+                kind = repr(obj.get('Type'))
+                if kind == '/XRef':
+                    trailers.append(obj.attrs)
+                elif kind == '/ObjStm':
+                    try:
+                        self._index_objstm(objid, obj)
+                    except (_PdfError, ValueError, IndexError, zlib.error):
+                        pass
+            elif isinstance(obj, dict) and repr(obj.get('Type')) == \
+                 '/Catalog':
+                trailers.append({'Root': _PdfRef(objid)})
+        self.trailer = {}
+        for trailer in reversed(trailers):
+            for (key, value) in trailer.items():
+                self.trailer.setdefault(key, value)
+        # the entries for the objects in object streams were added later
+        self._objects = {}
+
+    def _index_objstm(self, stmid, stream):
+        """Add the objects in the object stream stmid to the cross-reference
+        entries, unless they are also stored as regular objects"""
+        data = self.decode(stream)
+        first = self.resolve(stream.get('First'))
+        count = self.resolve(stream.get('N'))
+        numbers = data[:first].split()
+        for i in xrange(count):
+            self._xref.setdefault(int(numbers[2 * i]), (2, stmid, i))
+
+
+# PDFDocEncoding, where it differs from Latin-1
+_pdfdoc_encoding = {
+    0x18: u'˘', 0x19: u'ˇ', 0x1a: u'ˆ', 0x1b: u'˙',
+    0x1c: u'˝', 0x1d: u'˛', 0x1e: u'˚', 0x1f: u'˜',
+    0x80: u'•', 0x81: u'†', 0x82: u'‡', 0x83: u'…',
+    0x84: u'—', 0x85: u'–', 0x86: u'ƒ', 0x87: u'⁄',
+    0x88: u'‹', 0x89: u'›', 0x8a: u'−', 0x8b: u'‰',
+    0x8c: u'„', 0x8d: u'“', 0x8e: u'”', 0x8f: u'‘',
+    0x90: u'’', 0x91: u'‚', 0x92: u'™', 0x93: u'ﬁ',
+    0x94: u'ﬂ', 0x95: u'Ł', 0x96: u'Œ', 0x97: u'Š',
+    0x98: u'Ÿ', 0x99: u'Ž', 0x9a: u'ı', 0x9b: u'ł',
+    0x9c: u'œ', 0x9d: u'š', 0x9e: u'ž', 0xa0: u'€',
+}
+
+def _decode_pdf_text(string):
+    """Decode a pdf text string (in PDFDocEncoding, or UTF-16BE with a byte
+    order mark) to unicode"""
+    if string.startswith('\xfe\xff'):
+        return string[2:].decode('utf-16be', 'ignore')
+    return string.decode('latin-1').translate(_pdfdoc_encoding)
+
+
+_pdf_printable_re = re.compile(r'[\x20-\x7e]*\Z')
+_pdf_name_escape_re = re.compile(r'[^!-~]|[()<>\[\]{}/%#]')
+
+def _encode_pdf_text(unistring):
+    """Encode unistring as a pdf text string object: a literal string if it
+    consists of printable ascii characters, and a hexadecimal string in
+    UTF-16BE (with a byte order mark) otherwise"""
+    if _pdf_printable_re.match(unistring):
+        return _pdf_serialize(str(unistring))
+    return '<FEFF%s>' % binascii.hexlify(unistring.encode('utf-16be')).upper()
+
+
+def _pdf_serialize(obj):
+    """Return the pdf syntax for obj, which is a native pdf object (see
+    _PdfReader), a bool, None, a number, a (byte) string, a unicode string
+    (as a text string), or a list or dict of those"""
+    if isinstance(obj, bool):
+        return obj and 'true' or 'false'
+    if obj is None:
+        return 'null'
+    if isinstance(obj, (int, long)):
+        return str(obj)
+    if isinstance(obj, float):
+        number = ('%.6f' % obj).rstrip('0').rstrip('.')
+        if number in ('', '-', '-0'):
+            number = '0'
+        return number
+    if isinstance(obj, unicode):
+        return _encode_pdf_text(obj)
+    if isinstance(obj, str):
+        if _pdf_printable_re.match(obj):
+            return '(%s)' % re.sub(r'([\\()])', r'\\\1', obj)
+        return '<%s>' % binascii.hexlify(obj).upper()
+    if isinstance(obj, _PdfName):
+        return '/' + _pdf_name_escape_re.sub(lambda m: '#%02X'
+                                             % ord(m.group()), obj.name)
+    if isinstance(obj, _PdfRef):
+        return '%i %i R' % (obj.objid, obj.genno)
+    if isinstance(obj, list):
+        return '[%s]' % ' '.join([_pdf_serialize(item) for item in obj])
+    if isinstance(obj, dict):
+        return '<<%s>>' % ''.join([_pdf_serialize(_PdfName(key)) + ' '
+                                   + _pdf_serialize(value) for (key, value)
+                                   in sorted(obj.items())])
+    raise _PdfError("Cannot write %r" % (obj,))
+
+class OutlineLimits:
+    """ Limits for the work of reading the outline of a pdf file
+
+        A damaged or malicious pdf file can have an outline that never ends,
+        or takes very long to read. Once the outline has more than
+        max_items bookmarks, or the bookmarks have been looked up as more
+        than max_objects pdf objects, the bookmarks read so far are
+        returned, and the rest is skipped. Bookmarks that are more than
+        max_depth levels deep are skipped as well. Change the class
+        attributes to change the limits for all pdf files.
+
+        Independently of the limits, a bookmark that is reached a second
+        time (because the /Next or /First entries form a loop) is skipped.
+        In all cases, a warning is added to the diagnostics (see iter_pdf).
+        write_pdf gives up if the pages of the bookmarks cannot be looked up
+        within max_objects.
+    """
+
+    max_items = 1000000
+    max_depth = 256
+    max_objects = 50000000
+
+
+class _OutlineLimitError(Exception):
+    """Raised when reading an outline exceeds the OutlineLimits"""
+
+
+def _limited_resolve(resolve, max_objects):
+    """Return a function that works like resolve, but raises an
+    _OutlineLimitError once it is called more than max_objects times"""
+    calls = [0]
+    def limited(obj):
+        """Return the object that obj refers to"""
+        calls[0] += 1
+        if calls[0] > max_objects:
+            raise _OutlineLimitError("Reading the outline takes more than %i "
+                                     "pdf objects, the remaining bookmarks "
+                                     "are skipped" % max_objects)
+        return resolve(obj)
+    return limited
+
+
+def _pdf_outline(catalog, resolve, note, max_items=None, max_depth=None):
+    """Yield a tuple (level, title, dest, action, se) for every item of the
+    outline of the pdf document with the given catalog, in preorder, as
+    pdfminer's get_outlines, but also for the items without an action or
+    destination, whose children would otherwise seem to belong to the
+    item before them. resolve is a function that returns the object
+    a reference points to, and note is called with a warning for the items
+    that are skipped. The outline is walked without recursion, so that
+    only max_items and max_depth limit the number and the depth of the
+    items, and every item is visited only once, even if the links between
+    them form a loop."""
+    outlines = resolve(catalog.get('Outlines'))
+    if not isinstance(outlines, dict):
+        return
+    items = []
+    visited = set()
+    looped = set() # the items that have been noted as reached again
+    def push(item, level):
+        """Add item to the items still to be walked, unless it has been
+        added before"""
+        objid = getattr(item, 'objid', None)
+        if objid is not None:
+            if objid in visited:
+                if objid not in looped:
+                    note("The outline item %s is reached a second time, the "
+                         "loop is skipped" % objid)
+                    looped.add(objid)
+                return
+            visited.add(objid)
+        items.append((item, level))
+    push(outlines.get('First'), 1)
+    walked = 0
+    deep = False # whether items were skipped for max_depth
+    while items:
+        item, level = items.pop()
+        objid = getattr(item, 'objid', None)
+        walked += 1
+        if (max_items is not None) and (walked > max_items):
+            note("The outline has more than %i items, the remaining "
+                 "bookmarks are skipped" % max_items)
+            return
+        try:
+            item = resolve(item)
+        except _OutlineLimitError:
+            raise
+        except Exception, details:
+            note("The outline item %s cannot be read (%s: %s), the "
+                 "bookmarks after it on its level are skipped"
+                 % (objid, details.__class__.__name__, details))
+            continue
+        if not isinstance(item, dict):
+            continue
+        # the children come before the next item
+        if item.get('Next') is not None:
+            push(item['Next'], level)
+        if item.get('First') is not None:
+            if (max_depth is None) or (level < max_depth):
+                push(item['First'], level + 1)
+            elif not deep:
+                note("The bookmarks deeper than %i levels are skipped"
+                     % max_depth)
+                deep = True
+        if 'Title' in item:
+            try:
+                title = resolve(item['Title'])
+            except _OutlineLimitError:
+                raise
+            except Exception, details:
+                note("The title of the outline item %s cannot be read "
+                     "(%s: %s)" % (objid, details.__class__.__name__,
+                                   details))
+                title = ''
+            if not isinstance(title, str):
+                title = ''
+            yield (level, _decode_pdf_text(title), item.get('Dest'),
+                   item.get('A'), item.get('SE'))
+
+
+class _PageNumbers:
+    """ Map the page objects of a pdf file to their page numbers (starting
+        at 0), without enumerating all pages.
+
+        The page tree is walked upwards from a page object, via the /Parent
+        entries. The page number is the number of the first page in the
+        parent, plus the /Count of the preceding siblings (or 1 for a
+        preceding page). This requires resolving only the ancestors of the
+        pages that are looked up, and their preceding siblings, while whole
+        subtrees of the page tree are skipped. All numbers found are kept,
+        and the siblings are counted only as far as needed, so that every
+        node is looked at only once.
+
+        The attribute pages maps the object ids of the pages that have been
+        looked up to their numbers.
+
+        Conversely, ref() finds the page object for a page number, by
+        walking the page tree downwards, and skipping the subtrees before
+        the page by their /Count. The running totals of the /Count of the
+        kids of a node are kept from its first visit, so that the kid that
+        holds a page is found by bisection.
+    """
+
+    def __init__(self, resolve):
+        """resolve is a function that returns the object an indirect
+        reference (with an objid attribute) points to"""
+        self._resolve = resolve
+        self._numbers = {} # objid => number of the first page in the node
+        # objid => (index, start) of the first kid whose pages have not been
+        # counted, and the number of its first page
+        self._counted = {}
+        self._pending = set() # objids of the nodes whose number is sought
+        # objid => (kids, the number of pages up to the end of every kid)
+        self._totals = {}
+        self.pages = {}
+
+    def number(self, ref):
+        """Return the page number of the page object that ref points to.
+        Raise a KeyError or a ValueError if the page tree is damaged"""
+        number = self._start(ref)
+        self.pages[ref.objid] = number
+        return number
+
+    def _start(self, ref):
+        """Return the number of the first page in the node of the page tree
+        that ref points to"""
+        objid = ref.objid
+        if objid not in self._numbers:
+            if objid in self._pending:
+                raise ValueError("The page tree has a loop at object %s"
+                                 % objid)
+            parent = self._resolve(ref).get('Parent')
+            if parent is None:
+                # the root of the page tree
+                self._numbers[objid] = 0
+            else:
+                self._pending.add(objid)
+                try:
+                    kids = self._resolve(parent)['Kids']
+                    index, start = self._counted.get(parent.objid,
+                                                     (0, self._start(parent)))
+                    while index < len(kids):
+                        self._numbers.setdefault(kids[index].objid, start)
+                        if kids[index].objid == objid:
+                            break
+                        start += self._count(kids[index])
+                        index += 1
+                    self._counted[parent.objid] = (index, start)
+                finally:
+                    self._pending.discard(objid)
+                if objid not in self._numbers:
+                    raise KeyError("Page object %s is not a child of its "
+                                   "parent" % objid)
+        return self._numbers[objid]
+
+    def ref(self, root, number):
+        """Return the reference to the page with the given number (starting
+        at 0) in the page tree whose root is the reference root, or None if
+        there is no such page"""
+        node = root
+        visited = set()
+        while True:
+            if node.objid in visited:
+                return None
+            visited.add(node.objid)
+            if node.objid not in self._totals:
+                kids = self._resolve(self._resolve(node).get('Kids'))
+                totals = []
+                if kids is not None:
+                    total = 0
+                    for kid in kids:
+                        total += self._count(kid)
+                        totals.append(total)
+                self._totals[node.objid] = (kids, totals)
+            kids, totals = self._totals[node.objid]
+            if kids is None:
+                if number == 0:
+                    return node
+                return None
+            index = bisect.bisect_right(totals, number)
+            if index >= len(kids):
+                return None
+            if index > 0:
+                number -= totals[index - 1]
+            node = kids[index]
+
+    def _count(self, ref):
+        """Return the number of pages in the node that ref points to"""
+        node = self._resolve(ref)
+        if repr(node.get('Type')) == '/Pages':
+            return int(self._resolve(node['Count']))
+        return 1
+
+
+class _NamedDestinations:
+    """ Index of the named destinations of a pdf file
+
+        The index is built on the first lookup, in a single pass over the
+        /Dests name tree in the /Names dictionary of the document catalog
+        (for destinations named by strings), and the /Dests dictionary of
+        the catalog (for destinations named by names, before PDF 1.2).
+        Every lookup after that is a dict access.
+    """
+
+    def __init__(self, catalog, resolve):
+        """catalog is the document catalog, and resolve is a function that
+        returns the object an indirect reference points to (and any other
+        object unchanged)"""
+        self._catalog = catalog
+        self._resolve = resolve
+        self._index = None
+
+    def lookup(self, name):
+        """Return the destination (array, or dictionary with a /D entry)
+        with the given name, or None if there is no such destination"""
+        if self._index is None:
+            self._index = {}
+            dests = self._resolve(self._catalog.get('Dests'))
+            if isinstance(dests, dict):
+                for (key, dest) in dests.items():
+                    self._index[key] = dest
+            names = self._resolve(self._catalog.get('Names'))
+            if isinstance(names, dict):
+                self._add_tree(names.get('Dests'))
+        dest = self._index.get(name)
+        if dest is None:
+            return None
+        return self._resolve(dest)
+
+    def _add_tree(self, root):
+        """Add all names in the name tree root to the index"""
+        visited = set()
+        nodes = [root]
+        while nodes:
+            node = nodes.pop()
+            objid = getattr(node, 'objid', None)
+            if objid is not None:
+                if objid in visited:
+                    continue
+                visited.add(objid)
+            node = self._resolve(node)
+            if not isinstance(node, dict):
+                continue
+            entries = self._resolve(node.get('Names', []))
+            for i in xrange(0, len(entries) - 1, 2):
+                key = self._resolve(entries[i])
+                if isinstance(key, str):
+                    self._index.setdefault(key, entries[i + 1])
+            # the kids are visited in order, so that the first of several
+            # entries with the same name wins
+            nodes.extend(reversed(self._resolve(node.get('Kids', []))))
+
+
+class OutlineCache:
+    """ Persistent cache of the outlines extracted from pdf files
+
+        iter_pdf stores the bookmarks it extracted from a pdf file, and the
+        numbers of the page objects they point to, in a file in the
+        directory given by the class attribute directory. As long as the pdf
+        file is unchanged, the bookmarks are then taken from the cache,
+        without parsing the pdf file again. A pdf file is identified by its
+        size, its modification time, and a hash of its first and last
+        blocks, so that a file that is renamed or moved is still found. A
+        copy gets a new modification time, unless it is kept (e.g. by
+        'cp -p'), and is read again.
+
+        The total size of the cache is limited to max_size bytes. When it
+        grows beyond that, the entries that have been used least recently
+        are removed. Set the class attribute enabled to False to disable
+        the cache.
+    """
+
+    enabled = True
+    directory = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                            os.path.expanduser('~/.cache')),
+                             'bmconverter')
+    max_size = 67108864 # 64 MB
+    # entries written by older versions of the extraction are not used
+    version = 7
+
+    def __init__(self, infilename):
+        """Find the cache entry for the pdf file infilename"""
+        status = os.stat(infilename)
+        infile = open(infilename, "rb")
+        try:
+            partial = hashlib.sha1(infile.read(65536))
+            infile.seek(max(65536, status.st_size - 65536))
+            partial.update(infile.read(65536))
+        finally:
+            infile.close()
+        # an outline that was cut short by the OutlineLimits is only valid
+        # for the same limits
+        key = hashlib.sha1("%i:%i:%i:%i:%i:%r:%s"
+                           % (self.version, OutlineLimits.max_items,
+                              OutlineLimits.max_depth,
+                              OutlineLimits.max_objects, status.st_size,
+                              status.st_mtime, partial.hexdigest()))
+        self.name = os.path.join(self.directory, key.hexdigest() + ".pickle")
+
+    def load(self):
+        """Return the cached dict {'records': records, 'pages': pages,
+        'messages': messages}, where records is the list of (level, fields)
+        tuples yielded by iter_pdf, pages maps the object ids of the pages
+        that are used to their page numbers (starting at 0), and messages is
+        a list of tuples (index, warning) of the warnings that were printed
+        before the record at index. Return None if there is no valid entry"""
+        try:
+            entry_file = open(self.name, "rb")
+        except IOError:
+            return None
+        try:
+            try:
+                entry = cPickle.load(entry_file)
+            finally:
+                entry_file.close()
+            # mark the entry as recently used
+            os.utime(self.name, None)
+            return entry
+        except Exception:
+            # a damaged entry is removed, and the pdf file is parsed again
+            self._remove(self.name)
+            return None
+
+    def store(self, records, pages, messages):
+        """Store the records, pages, and messages of the pdf file (see load),
+        and remove the least recently used entries if the cache is too large.
+        Errors are ignored, as the cache is only an optimization."""
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            handle, tempname = tempfile.mkstemp(dir=self.directory,
+                                                suffix=".tmp")
+            entry_file = os.fdopen(handle, "wb")
+            try:
+                cPickle.dump({'records': records, 'pages': pages,
+                              'messages': messages}, entry_file, 2)
+            finally:
+                entry_file.close()
+            if os.name == 'nt' and os.path.exists(self.name):
+                os.remove(self.name)
+            os.rename(tempname, self.name)
+            self.evict()
+        except (IOError, OSError):
+            pass
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is no
+        larger than max_size"""
+        entries = []
+        total = 0
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".pickle"):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+            total += status.st_size
+        entries.sort()
+        for (mtime, size, path) in entries:
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        """Remove the file path, if possible"""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _iter_outline(catalog, resolve, name_type, pages, note, limits=None):
+    """ Yield a tuple (level, fields) for every bookmark of the pdf document
+        with the given catalog, in preorder (see iter_pdf). resolve is a
+        function that returns the object a reference points to, name_type is
+        the class of pdf names, pages is the _PageNumbers of the document,
+        and note is called with the warnings for the bookmarks. limits are
+        the OutlineLimits, or None for no limits. The objects looked up by
+        resolve count against limits.max_objects only if resolve was made
+        by _limited_resolve, which pages should use as well.
+
+        A damaged outline is read as far as possible: a bookmark whose
+        action cannot be read is yielded with its title only, and once a
+        limit is exceeded, the bookmarks yielded so far are the result. The
+        warnings say what was skipped.
+    """
+    max_items = max_depth = None
+    if limits is not None:
+        max_items = limits.max_items
+        max_depth = limits.max_depth
+    named_dests = _NamedDestinations(catalog, resolve)
+    def resolve_dest(dest):
+        """Return the destination array for dest, which may be named, or
+        None if the named destination does not exist"""
+        dest = resolve(dest)
+        if isinstance(dest, (str, name_type)):
+            name = getattr(dest, 'name', dest)
+            dest = named_dests.lookup(name)
+            if dest is None:
+                note("Destination not found: %s" % name)
+                return None
         if isinstance(dest, dict):
-            dest = dest['D']
+            dest = resolve(dest['D'])
         for i, element in enumerate(dest):
             if str(element) in [r'/XYZ', r'/Fit', r'/FitH', r'/FitV', r'/FitR',
             r'/FitB', r'/FitBH', r'/FitBV']:
@@ -1984,88 +5382,738 @@ def read_pdf(infilename):
             if element is None:
                 dest[i] = 'null'
         return dest
-    root = Bookmark()
-    current_node = root
-    current_level = 0
+    try:
+        for (level,title,dest,a,se) in _pdf_outline(catalog, resolve, note,
+                                                    max_items, max_depth):
+            fields = {'title': title}
+            try:
+                _outline_action(fields, resolve(dest), resolve(a),
+                                resolve, resolve_dest, name_type, pages, note)
+            except _OutlineLimitError:
+                raise
+            except Exception, details:
+                # pdfminer raises all kinds of exceptions for damaged objects,
+                # and the native reader a _PdfError
+                note("The action of the bookmark '%s' cannot be read (%s: %s)"
+                     % (title, details.__class__.__name__, details))
+                fields = {'title': title}
+            yield (level, fields)
+    except _OutlineLimitError, details:
+        note(str(details))
+
+
+def _outline_action(fields, dest, action, resolve, resolve_dest, name_type,
+                    pages, note):
+    """Set the fields for the action of a bookmark in fields (see
+    _iter_outline), which already contain its title, from the /Dest and /A
+    entries dest and action of its outline item"""
+    title = fields['title']
+    if action:
+        if not isinstance(action, dict):
+            note("The action of the bookmark '%s' is not a dictionary"
+                 % title)
+            return
+        subtype = action.get('S')
+        if repr(subtype) == '/GoTo':
+            fields['action'] = 'GoTo'
+            dest = resolve_dest(action['D'])
+            if dest is not None:
+                fields['page'] = pages.number(dest[0]) + 1
+                fields['destination'] = u" ".join([str(d) for d in dest[1:]])
+        elif repr(subtype) == '/GoToR':
+            fields['action'] = 'GoToR'
+            if isinstance(resolve(action['D']), (str, name_type)):
+                # the name refers to a destination in the other file
+                note("Named destinations in other files are not currently "
+                     "supported ('%s')" % title)
+            else:
+                dest = resolve_dest(action['D'])
+                fields['fileno'] = int(dest[0])
+                fields['destination'] = u" ".join([str(d) for d in dest[1:]])
+            fields['file'] = unicode(resolve(action['F'])['F'])
+        elif repr(subtype) == '/Launch':
+            filespec = resolve(action['F'])
+            if repr(filespec['Type']) == '/Filespec':
+                fields['action'] = 'Launch'
+                fields['file'] = unicode(filespec['F'])
+            else:
+                note("Only /Launch actions for files are supported ('%s')"
+                     % title)
+        elif repr(subtype) == '/URI':
+            fields['action'] = 'URI'
+            fields['uri'] = unicode(action['URI'])
+        elif repr(subtype) in ['/Named', '/Sound', '/GotoE', '/Movie',
+        '/Hide', '/SubmitForm', '/ResetForm', '/ImportData', '/JavaScript',
+        '/SetOCGState', '/Rendition', '/Trans', '/GoTo3DView']:
+            note("The %s action is not currently supported ('%s')"
+                 % (repr(subtype), title))
+        else:
+            note("Unknown action %s ('%s')" % (subtype, title))
+    elif dest:
+        fields['action'] = 'GoTo'
+        dest = resolve_dest(dest)
+        if dest is not None:
+            fields['page'] = pages.number(dest[0]) + 1
+            fields['destination'] = u" ".join([str(d) for d in dest[1:]])
+
+
+def _read_outline(fp, backend=None):
+    """ Extract the bookmarks from the pdf file fp (a seekable file object),
+        and return a dict {'records': records, 'pages': pages, 'messages':
+        messages}, as OutlineCache.load. backend is 'native' for the native
+        reader, 'pdfminer' for pdfminer, or None for the native reader, with
+        pdfminer as fallback for the files that the native reader cannot
+        read (e.g. encrypted files).
+    """
+    records = []
+    messages = []
+    def note(msg):
+        """Keep the warning msg, to be printed before the next record"""
+        messages.append((len(records), msg))
+    if backend != 'pdfminer':
+        try:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError,
+                io.UnsupportedOperation):
+            # not a regular (non-empty) file
+            fp.seek(0)
+            data = fp.read()
+        try:
+            reader = _PdfReader(data)
+            resolve = _limited_resolve(reader.resolve,
+                                       OutlineLimits.max_objects)
+            pages = _PageNumbers(resolve)
+            records.extend(_iter_outline(reader.catalog, resolve, _PdfName,
+                                         pages, note, OutlineLimits))
+            return {'records': records, 'pages': pages.pages,
+                    'messages': messages}
+        except _PdfError, details:
+            if backend == 'native':
+                die("Cannot read the pdf file: %s" % details)
+            del records[:]
+            del messages[:]
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    try:
+        from pdfminer.psparser  import PSLiteral
+        from pdfminer.pdfparser import PDFDocument, PDFParser
+        from pdfminer.pdftypes  import resolve1
+    except ImportError:
+        die("You must install the pdfminer package to read this pdf file")
+    fp.seek(0)
     doc = PDFDocument()
-    fp = file(infilename, 'rb')
     parser = PDFParser(fp)
     parser.set_document(doc)
     doc.set_parser(parser)
     doc.initialize()
-    pages = dict( (page.pageid, pageno)
-                  for (pageno,page) in enumerate(doc.get_pages()) )
+    resolve = _limited_resolve(resolve1, OutlineLimits.max_objects)
+    pages = _PageNumbers(resolve)
+    records.extend(_iter_outline(doc.catalog, resolve, PSLiteral, pages,
+                                 note, OutlineLimits))
+    parser.close()
+    return {'records': records, 'pages': pages.pages, 'messages': messages}
+
+
+def iter_pdf(infilename, metadata=None, backend=None):
+    """ Read the bookmarks directly from a pdf file, and yield a tuple
+        (level, fields) for every bookmark, in preorder (see iter_xml).
+        Formatting of the bookmark titles is disregarded. If a dict is given
+        as metadata, its key 'pdf' is set to infilename, and its key
+        'diagnostics' to the list of warnings about the outline (which are
+        also printed). Instead of a file
+        name, infilename may be a seekable file-like object opened in binary
+        mode.
+
+        The pdf file is read by a native reader, which parses only the
+        objects that make up the outline, and the parts of the page tree
+        that are needed to number the pages. The files that it cannot read
+        (e.g. encrypted files) are read with the pdfminer library instead,
+        which must be installed for this. With backend set to 'native' or
+        'pdfminer', only that one is used.
+
+        The native reader maps a pdf file into memory, so that only the
+        parts of it that are needed are ever read, even for very large
+        files. As the pdf parsers need random access to the file, a
+        compressed pdf file is decompressed into memory.
+
+        The bookmarks of a pdf file (given by name) are kept in the
+        OutlineCache, unless it is disabled, or a backend is given.
+
+        A damaged outline is read as far as the OutlineLimits allow: the
+        bookmarks that can be read are yielded, and the diagnostics tell
+        which ones were skipped, or lack their action.
+    """
+    cache = None
+    entry = None
+    if OutlineCache.enabled and (backend is None) \
+    and not is_filelike(infilename):
+        cache = OutlineCache(infilename)
+        entry = cache.load()
+    if entry is None:
+        if input_compression(infilename) is not None:
+            fp = cStringIO.StringIO(''.join(input_blocks(infilename)))
+        elif is_filelike(infilename):
+            fp = infilename
+        else:
+            fp = file(infilename, 'rb')
+        try:
+            entry = _read_outline(fp, backend)
+        finally:
+            if fp is not infilename:
+                fp.close()
+        if cache is not None:
+            cache.store(entry['records'], entry['pages'], entry['messages'])
+    if is_filelike(infilename):
+        infilename = getattr(infilename, 'name', None)
+    if (metadata is not None) and (infilename is not None):
+        metadata['pdf'] = infilename
+    if metadata is not None:
+        metadata['diagnostics'] = [message for (index, message)
+                                   in entry['messages']]
+    messages = {}
+    for (index, message) in entry['messages']:
+        messages.setdefault(index, []).append(message)
+    for (index, record) in enumerate(entry['records']):
+        for message in messages.get(index, []):
+            warn(message)
+        yield record
+    for message in messages.get(len(entry['records']), []):
+        warn(message)
+
+
+def read_pdf(infilename, backend=None):
+    """ Read bookmarkds directly from a pdf file, and return a tuple (root,
+        metadata), where root is a root bookmark node. The root node itself is
+        empty, and contains all the bookmarks as children. Formatting of the
+        bookmark titles is disregarded. The metadata is a dict of metadata
+        extracted from the pdf, and additionally with the key 'pdf' set to the
+        value of infilename, and the key 'diagnostics' set to the warnings
+        about the outline. See iter_pdf for the backend.
+    """
+    # TODO: parse metadata
+    metadata = {}
+    return (build_tree(iter_pdf(infilename, metadata, backend)), metadata)
+
+
+def iter_pdf_batch(infilenames, jobs=1, timeout=None, outputs=None):
+    """ Read the bookmarks of many pdf files in jobs worker processes, and
+        yield a tuple (infilename, records, messages, error) for every file
+        in infilenames, in the order in which they are done. records is the
+        list of records of iter_pdf, messages are the warnings for the file,
+        and error is None, or the reason why the file could not be read, in
+        which case records is None.
+
+        If outputs is given, it maps the file names to tuples (to_format,
+        outfilename). The bookmarks of these files are written to
+        outfilename in to_format by the worker, instead of being returned
+        (records is None even if the file was read).
+
+        A worker that takes longer than timeout seconds for a file is killed
+        and replaced by a new one, and so is a worker that dies, so that a
+        broken pdf file never stops the batch. The workers are started only
+        once, so that the start of the interpreter, and the import of
+        pdfminer, are paid once per worker, not once per file. If jobs is
+        less than 1, one worker per CPU is started.
+    """
+    if jobs < 1:
+        jobs = multiprocessing.cpu_count()
+    if outputs is None:
+        outputs = {}
+    infilenames = iter(infilenames)
+    workers = [] # [process, connection, infilename, deadline]
     try:
-        outlines = doc.get_outlines()
-    except PDFNoOutlines:
-        pass
-    for (level,title,dest,a,se) in outlines:
-        while current_level > level:
-            current_node = current_node.parent()
-            current_level -= 1
-        if level == current_level:
-            current_node = current_node.parent()
-            current_level -= 1
-        current_node = current_node.newchild()
-        current_level += 1
-        current_node.title = title
-        if a:
-            action = a.resolve()
-            if isinstance(action, dict):
-                subtype = action.get('S')
-                if repr(subtype) == '/GoTo':
-                    current_node.action = 'GoTo'
-                    dest = resolve_dest(action['D'])
-                    if type(dest) is str:
-                        warn("Named string destinations are not currently"
-                             + " supported ('%s')" % title)
-                    else:
-                        current_node.page = int(pages[dest[0].objid]) + 1
-                        if dest is not None:
-                            current_node.destination = \
-                            u" ".join([str(d) for d in dest[1:]])
-                elif repr(subtype) == '/GoToR':
-                    current_node.action = 'GoToR'
-                    dest = resolve_dest(action['D'])
-                    current_node.fileno = int(dest[0])
-                    current_node.destination = \
-                                           u" ".join([str(d) for d in dest[1:]])
-                    current_node.file = unicode(action['F'].resolve()['F'])
-                elif repr(subtype) == '/Launch':
-                    current_node.action = 'Launch'
-                    dest = action['F'].resolve()
-                    if repr(dest['Type']) == '/Filespec':
-                        current_node.file = unicode(dest['F'])
-                    else:
-                        die("We can only handle /Launch links to files: %s"
-                            % str(dest))
-                elif repr(subtype) == '/URI':
-                    current_node.action = 'URI'
-                    current_node.uri = unicode(action['URI'])
-                elif repr(subtype) in ['/Named', '/Sound', '/GotoE', '/Movie',
-                '/Hide', '/SubmitForm', '/ResetForm', '/ImportData',
-                '/JavaScript', '/SetOCGState', '/Rendition', '/Trans',
-                '/GoTo3DView']:
-                    warn("The %s action is not currently supported ('%s')"
-                         % (repr(subtype), title))
+        while True:
+            for worker in workers + [None] * (jobs - len(workers)):
+                if worker is not None and worker[2] is not None:
+                    continue
+                try:
+                    infilename = infilenames.next()
+                except StopIteration:
+                    break
+                if worker is None:
+                    worker = _start_batch_worker()
+                    workers.append(worker)
+                worker[1].send((infilename, outputs.get(infilename)))
+                worker[2] = infilename
+                if timeout is not None:
+                    worker[3] = time.time() + timeout
+            busy = [worker for worker in workers if worker[2] is not None]
+            if not busy:
+                break
+            wait = None
+            if timeout is not None:
+                wait = max(0, min([worker[3] for worker in busy])
+                              - time.time())
+            ready = _wait_connections([worker[1] for worker in busy], wait)
+            for worker in busy:
+                (process, connection, infilename, deadline) = worker
+                if connection in ready:
+                    try:
+                        result = connection.recv()
+                    except (EOFError, IOError):
+                        process.join()
+                        result = (None, [], "The worker process died (exit "
+                                            "status %s)" % process.exitcode)
+                elif (deadline is not None) and (time.time() >= deadline):
+                    _stop_batch_worker(process)
+                    result = (None, [], "Timed out after %g seconds"
+                                        % timeout)
+                else:
+                    continue
+                if process.is_alive():
+                    worker[2] = None
                 else:
-                    die("Unkown action %s" % subtype)
+                    connection.close()
+                    workers.remove(worker)
+                yield (infilename,) + result
+        for (process, connection, infilename, deadline) in workers:
+            connection.send(None)
+            process.join()
+    finally:
+        for (process, connection, infilename, deadline) in workers:
+            if process.is_alive():
+                _stop_batch_worker(process)
+
+def _start_batch_worker():
+    """Start a worker process of iter_pdf_batch, and return the list
+    [process, connection, infilename, deadline] for it"""
+    connection, worker_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_batch_worker,
+                                      args=(worker_connection,))
+    process.daemon = True
+    process.start()
+    worker_connection.close()
+    return [process, connection, None, None]
+
+def _stop_batch_worker(process):
+    """Terminate the worker process, and kill it if it does not end"""
+    process.terminate()
+    process.join(1)
+    if process.is_alive() and hasattr(signal, 'SIGKILL'):
+        os.kill(process.pid, signal.SIGKILL)
+    process.join()
+
+def _wait_connections(connections, timeout):
+    """Return the connections that can be read from, waiting up to timeout
+    seconds (or forever if timeout is None) for the first one"""
+    if os.name != 'nt':
+        import select
+        return select.select(connections, [], [], timeout)[0]
+    # pipes cannot be selected on Windows
+    end = None
+    if timeout is not None:
+        end = time.time() + timeout
+    while True:
+        ready = [connection for connection in connections
+                 if connection.poll()]
+        if ready or ((end is not None) and (time.time() >= end)):
+            return ready
+        time.sleep(0.01)
+
+def _batch_worker(connection):
+    """Read the pdf files received from connection, until None is received,
+    and send back the tuple (records, messages, error) for each (see
+    iter_pdf_batch)"""
+    # the main process handles interrupts; a worker that is terminated
+    # removes the output file that it was writing
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # the output files of the main process are not the worker's to remove
+    _open_outputs.clear()
+    def terminate(signum, frame):
+        _discard_open_outputs()
+        os._exit(1)
+    signal.signal(signal.SIGTERM, terminate)
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        connection.send(_batch_task(*task))
+    connection.close()
+
+def _batch_task(infilename, output):
+    """Read the bookmarks of the pdf file infilename, and write them to
+    output (a tuple (to_format, outfilename)), if given. Return the tuple
+    (records, messages, error) of iter_pdf_batch"""
+    result = {'records': None, 'error': None}
+    def task():
+        try:
+            if output is None:
+                result['records'] = list(iter_pdf(infilename))
             else:
-                die("Unexpected a -> %s" % action)
-        elif dest:
-            current_node.action = 'GoTo'
-            dest = resolve_dest(dest)
-            current_node.page = int(pages[dest[0].objid]) + 1
-            current_node.destination = u" ".join([str(d) for d in dest[1:]])
+                (to_format, outfilename) = output
+                root, metadata = read_pdf(infilename)
+                formats[to_format][1](root, outfilename, metadata)
+        except Exception, details:
+            result['error'] = "%s: %s" % (details.__class__.__name__, details)
+    try:
+        (messages, status) = _capture_stderr(task)
+    finally:
+        _discard_open_outputs()
+    (records, error) = (result['records'], result['error'])
+    if status is not None:
+        error = "Failed"
+    if (error == "Failed") and messages:
+        error = messages.pop()
+    return (records, messages, error)
+
+
+def _pdf_outline_objects(root, pages, page_tree, outline_id):
+    """ Return a dict that maps object ids to the pdf syntax of the objects
+        of the outline for the bookmarks in the tree root. The outline
+        dictionary gets the id outline_id, and the items the ids that follow.
+        pages is the _PageNumbers of the document, and page_tree the
+        reference to the root of its page tree.
+    """
+    ids = {id(root): outline_id} # id of a node => id of its object
+    nodes = [root]
+    for node in root:
+        ids[id(node)] = outline_id + len(nodes)
+        nodes.append(node)
+    # the number of descendants that are visible if a node is open, which
+    # is only known once all its children have been seen
+    visible = {}
+    links = {} # id of a node => its parent, previous and next sibling
+    for node in reversed(nodes):
+        children = node.children()
+        visible[id(node)] = sum([1 + (child.open and visible[id(child)] or 0)
+                                 for child in children])
+        for (i, child) in enumerate(children):
+            previous = following = None
+            if i > 0:
+                previous = children[i - 1]
+            if i + 1 < len(children):
+                following = children[i + 1]
+            links[id(child)] = (node, previous, following)
+    objects = {}
+    for node in nodes:
+        entries = []
+        children = node.children()
+        if node is root:
+            entries.append('/Type /Outlines')
         else:
-            warn("level: %s" % level)
-            warn("title: %s" % title)
-            warn("dest : %s" % dest)
-            warn("a    : %s" % a)
-            warn("se   : %s" % se)
-            die("Can't get action")
-    parser.close()
-    return (root, metadata)
+            entries.append('/Title %s' % _encode_pdf_text(node.title))
+            parent, previous, following = links[id(node)]
+            entries.append('/Parent %i 0 R' % ids[id(parent)])
+            if previous is not None:
+                entries.append('/Prev %i 0 R' % ids[id(previous)])
+            if following is not None:
+                entries.append('/Next %i 0 R' % ids[id(following)])
+            entries.extend(_pdf_outline_action(node, pages, page_tree))
+            color = Bookmark.colorpattern.match(node.color or u'')
+            if color is not None:
+                entries.append('/C [%s]' % ' '.join([_pdf_serialize(
+                                 float(value)) for value in color.groups()]))
+            flags = (node.italic and 1 or 0) + (node.bold and 2 or 0)
+            if flags:
+                entries.append('/F %i' % flags)
+        if children:
+            entries.append('/First %i 0 R' % ids[id(children[0])])
+            entries.append('/Last %i 0 R' % ids[id(children[-1])])
+            if node.open or node is root:
+                entries.append('/Count %i' % visible[id(node)])
+            else:
+                entries.append('/Count -%i' % visible[id(node)])
+        objects[ids[id(node)]] = '<< %s >>' % ' '.join(entries)
+    return objects
+
+
+_pdf_number_re = re.compile(r'[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)\Z')
+
+def _pdf_destination(page, destination):
+    """Return the pdf syntax for the destination array of the page (a
+    reference, or a page number for another file), and the destination
+    string of a Bookmark"""
+    if isinstance(page, _PdfRef):
+        page = _pdf_serialize(page)
+    values = (destination or 'Fit').split()
+    kind = values[0].lstrip('/')
+    if kind not in ['XYZ', 'Fit', 'FitH', 'FitV', 'FitR', 'FitB', 'FitBH',
+                    'FitBV']:
+        kind = 'Fit'
+        values = ['Fit']
+    for (i, value) in enumerate(values[1:]):
+        if _pdf_number_re.match(value):
+            continue
+        try:
+            values[i + 1] = _pdf_serialize(float(value))
+        except ValueError:
+            values[i + 1] = 'null'
+    return '[%s]' % ' '.join([str(page), '/' + kind] + values[1:])
+
+
+def _pdf_outline_action(node, pages, page_tree):
+    """Return the entries of the outline item for the action of node"""
+    if node.action == 'GoTo':
+        if node.named is not None:
+            return ['/Dest %s' % _encode_pdf_text(node.named)]
+        if node.namedn is not None:
+            return ['/Dest %s' % _pdf_serialize(_PdfName(
+                                                node.namedn.encode('utf-8')))]
+        page = pages.ref(page_tree, node.page - 1)
+        if page is None:
+            warn("The page %i of the bookmark '%s' does not exist"
+                 % (node.page, node.title))
+            return []
+        return ['/Dest %s' % _pdf_destination(page, node.destination)]
+    if node.action == 'GoToR':
+        if node.named is not None:
+            dest = _encode_pdf_text(node.named)
+        elif node.namedn is not None:
+            dest = _pdf_serialize(_PdfName(node.namedn.encode('utf-8')))
+        else:
+            dest = _pdf_destination(max(node.page - 1, 0), node.destination)
+        action = '/S /GoToR /F << /Type /Filespec /F %s >> /D %s' \
+                 % (_encode_pdf_text(node.file or u''), dest)
+        if node.newwindow is not None:
+            action += ' /NewWindow %s' % (str(node.newwindow).lower() == 'true'
+                                          and 'true' or 'false')
+        return ['/A << %s >>' % action]
+    if node.action == 'URI':
+        return ['/A << /S /URI /URI %s >>'
+                % _pdf_serialize((node.uri or u'').encode('utf-8'))]
+    if node.action == 'Launch':
+        return ['/A << /S /Launch /F << /Type /Filespec /F %s >> >>'
+                % _encode_pdf_text(node.file or u'')]
+    return []
+
+
+def _pdf_update(reader, root, offset):
+    """ Return the incremental update that replaces the outline of the pdf
+        file read by reader with the bookmarks in the tree root, to be
+        appended at offset: a new outline, a copy of the document catalog
+        that refers to it, and a cross-reference section for these objects.
+    """
+    catalog_ref = reader.trailer.get('Root')
+    if (not isinstance(catalog_ref, _PdfRef)) or (reader.startxref is None):
+        raise _PdfError("The pdf file is damaged")
+    outline_id = reader.size()
+    pages = _PageNumbers(_limited_resolve(reader.resolve,
+                                          OutlineLimits.max_objects))
+    try:
+        objects = _pdf_outline_objects(root, pages,
+                                       reader.catalog.get('Pages'), outline_id)
+    except _OutlineLimitError:
+        raise _PdfError("Looking up the pages of the bookmarks takes more "
+                        "than %i pdf objects" % OutlineLimits.max_objects)
+    catalog = dict(reader.catalog)
+    catalog['Outlines'] = _PdfRef(outline_id)
+    generations = {catalog_ref.objid: catalog_ref.genno}
+    objects[catalog_ref.objid] = _pdf_serialize(catalog)
+    parts = ['\n']
+    offsets = {}
+    position = offset + 1
+    for objid in sorted(objects):
+        offsets[objid] = position
+        part = '%i %i obj\n%s\nendobj\n' % (objid, generations.get(objid, 0),
+                                            objects[objid])
+        parts.append(part)
+        position += len(part)
+    trailer = {'Root': catalog_ref, 'Prev': reader.startxref}
+    for key in ['Info', 'ID']:
+        if key in reader.trailer:
+            trailer[key] = reader.trailer[key]
+    if reader.xref_stream:
+        # the update of a file with cross-reference streams needs a stream
+        xref_id = max(objects) + 1
+        offsets[xref_id] = position
+        width = len('%x' % position) // 2 + 1
+        rows = []
+        index = []
+        for objid in sorted(offsets):
+            if index and (index[-2] + index[-1] == objid):
+                index[-1] += 1
+            else:
+                index.extend([objid, 1])
+            rows.append('01' + ('%0*x' % (2 * width, offsets[objid]))
+                        + ('%02x' % generations.get(objid, 0)))
+        data = ''.join(rows).upper() + '>'
+        trailer.update({'Type': _PdfName('XRef'), 'Size': xref_id + 1,
+                        'Index': index, 'W': [1, width, 1],
+                        'Filter': _PdfName('ASCIIHexDecode'),
+                        'Length': len(data)})
+        parts.append('%i 0 obj\n%s\nstream\n%s\nendstream\nendobj\n'
+                     % (xref_id, _pdf_serialize(trailer), data))
+    else:
+        parts.append('xref\n')
+        objids = sorted(offsets)
+        start = 0
+        for (i, objid) in enumerate(objids):
+            if (i + 1 == len(objids)) or (objids[i + 1] != objid + 1):
+                parts.append('%i %i\n' % (objids[start], i + 1 - start))
+                for entry in objids[start:i + 1]:
+                    parts.append('%010i %05i n \n'
+                                 % (offsets[entry], generations.get(entry, 0)))
+                start = i + 1
+        trailer['Size'] = max(objids) + 1
+        parts.append('trailer\n%s\n' % _pdf_serialize(trailer))
+    parts.append('startxref\n%i\n%%%%EOF\n' % position)
+    return ''.join(parts)
+
+
+def write_pdf(root, outfilename, metadata={}):
+    """ Add the bookmarks to the pdf file metadata['pdf'], replacing its
+        outline, and write the result to outfilename.
+
+        The bookmarks are added as an incremental update: the new outline, a
+        new version of the document catalog that refers to it, and a
+        cross-reference section for them are appended to the pdf file, whose
+        content is left untouched. If outfilename is the pdf file itself,
+        the update is appended to it in place, which takes time in
+        proportion to the size of the outline, not of the document.
+        Otherwise, the pdf file is copied to outfilename first.
+
+        The page numbers of the bookmarks refer to the pages of the pdf
+        file. Bookmarks to pages that do not exist get no destination.
+        Encrypted pdf files are not supported.
+    """
+    if not metadata.has_key('pdf'):
+        die("No key 'pdf' in the metadata. Use the --pdf option to give "
+            "the pdf file that the bookmarks are added to")
+    pdffilename = metadata['pdf']
+    in_place = (not is_filelike(outfilename)) \
+               and os.path.exists(outfilename) \
+               and os.path.samefile(outfilename, pdffilename) \
+               and (input_compression(pdffilename) is None) \
+               and (compression_for(outfilename) is None)
+    pdffile = None
+    if input_compression(pdffilename) is not None:
+        data = ''.join(input_blocks(pdffilename))
+    else:
+        pdffile = open(pdffilename, 'rb')
+        try:
+            data = mmap.mmap(pdffile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            data = pdffile.read()
+    size = len(data)
+    try:
+        try:
+            update = _pdf_update(_PdfReader(data), root, len(data))
+        except _PdfError, details:
+            die("Cannot add the bookmarks to '%s': %s" % (pdffilename,
+                                                          details))
+        if not in_place:
+            outfile = OutputFile(outfilename)
+            for block in input_blocks(pdffilename):
+                outfile.write_bytes(block)
+            outfile.write_bytes(update)
+            outfile.close()
+            return
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+        if pdffile is not None:
+            pdffile.close()
+    outfile = open(pdffilename, 'r+b')
+    try:
+        try:
+            outfile.seek(size)
+            outfile.write(update)
+            outfile.flush()
+            if OutputFile.fsync:
+                os.fsync(outfile.fileno())
+        except:
+            # never leave a partial update behind
+            outfile.truncate(size)
+            raise
+    finally:
+        outfile.close()
+
+
+# the reader, writer, and iterator of every format, by name
+formats = {
+    'csv'     : (read_csv,     write_csv,     iter_csv),
+    'html'    : (read_html,    write_html,    iter_html),
+    'pdftk'   : (read_pdftk,   write_pdftk,   iter_pdftk),
+    'text'    : (read_text,    write_text,    iter_text),
+    'xml'     : (read_xml,     write_xml,     iter_xml),
+    'djvused' : (read_djvused, write_djvused, iter_djvused),
+    'latex'   : (read_latex,   write_latex,   iter_latex),
+    'pdf'     : (read_pdf,     write_pdf,     iter_pdf),
+    'djvu'    : (read_djvu,    write_djvu,    iter_djvu),
+}
+
+
+def _handler(name, index):
+    """Return the reader (index 0) or writer (index 1) of the named format,
+    or raise a ValueError if there is none"""
+    handler = formats.get(name, (None, None, None))[index]
+    if handler is None:
+        raise ValueError("No %s for the format '%s'"
+                         % (["reader", "writer"][index], name))
+    return handler
+
+def _options_for(handler, options):
+    """Return the items of the dict options that are keyword arguments of
+    the function handler"""
+    names = inspect.getargspec(handler)[0]
+    return dict((key, value) for (key, value) in options.items()
+                if key in names)
+
+def _input_object(data):
+    """Return a file-like object for the bytes, unicode string, or file-like
+    object data"""
+    if is_filelike(data):
+        return data
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return cStringIO.StringIO(data)
+
+
+def read_data(data, from_format, **options):
+    """Read bookmarks in from_format from data, which is a (UTF-8 encoded)
+    byte string, a unicode string, or a file-like object, without touching
+    the filesystem. Return a tuple (root, metadata), like read_<format>.
+    The options are passed on to the reader (e.g. tabwidth for text)."""
+    reader = _handler(from_format, 0)
+    return reader(_input_object(data), **options)
+
+def write_data(root, to_format, metadata={}, **options):
+    """Write the bookmarks root in to_format into memory, and return the
+    output as a UTF-8 encoded byte string. The options are passed on to the
+    writer (e.g. long for text)."""
+    writer = _handler(to_format, 1)
+    output = cStringIO.StringIO()
+    writer(root, output, metadata, **options)
+    return output.getvalue()
+
+def convert(data, from_format, to_format, **options):
+    """Convert the bookmarks in data from from_format to to_format in memory,
+    and return the result. data may be a byte string, a unicode string, or
+    a file-like object; the result is a unicode string if data is one, and a
+    UTF-8 encoded byte string otherwise.
+
+    The option offset shifts all page numbers. All other options are passed
+    on to the reader and the writer if they take them as keyword arguments,
+    e.g. tabwidth and levelprefix for reading text, long for writing text,
+    and jobs, and are ignored otherwise. The metadata read from data is
+    passed on to the writer, updated with the option metadata, if given.
+    """
+    reader = _handler(from_format, 0)
+    writer = _handler(to_format, 1)
+    options = dict(options)
+    offset = options.pop('offset', 0)
+    extra_metadata = options.pop('metadata', {})
+    # options that only apply to other formats are ignored, so that the same
+    # options can be used for any conversion
+    known = set()
+    for handler in itertools.chain(*formats.values()):
+        if handler is not None:
+            known.update(inspect.getargspec(handler)[0])
+    for key in options:
+        if key not in known:
+            raise TypeError("convert() got an unexpected keyword argument "
+                            "'%s'" % key)
+    reader_options = _options_for(reader, options)
+    writer_options = _options_for(writer, options)
+    root, metadata = reader(_input_object(data), **reader_options)
+    metadata.update(extra_metadata)
+    if offset != 0:
+        root.shift_pagenumber(offset)
+    result = write_data(root, to_format, metadata, **writer_options)
+    if isinstance(data, unicode):
+        result = result.decode('utf-8')
+    return result
 
 if __name__ == "__main__":
     main()
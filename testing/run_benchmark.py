@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for bmconverter.py
+
+Usage: run_benchmark.py [size_in_MB]
+
+The size of the generated input file for the input benchmarks defaults to
+500 MB. The escape benchmarks run on a fixed set of titles.
+"""
+
+import os
+import sys
+import time
+import codecs
+import tempfile
+import string
+import shutil
+import subprocess
+import multiprocessing
+from xml.sax import saxutils
+from bmconverter import *
+from bmconverter import _latex_special_chars
+
+
+def make_input(filename, size):
+    """Write a pdftk file of (roughly) size bytes to filename"""
+    record = u"BookmarkTitle: Kapitel %i: Gr\xf6\xdfen und Ma\xdfe\n" \
+             u"BookmarkLevel: %i\nBookmarkPageNumber: %i\n"
+    outfile = codecs.open(filename, "w", "utf-8")
+    written = 0
+    i = 0
+    while written < size:
+        chunk = u''.join([record % (j, j % 3 + 1, j) for j in
+                          xrange(i, i + 10000)]).encode('utf-8')
+        outfile.stream.write(chunk)
+        written += len(chunk)
+        i += 10000
+    outfile.close()
+
+
+def make_pdf(filename, pages, bookmarks, fanout=10):
+    """Write a pdf file with the given number of (empty) pages, in a page
+    tree of fanout kids per node, and as many bookmarks to the pages. With
+    fanout >= pages, all pages are kids of the root of the page tree."""
+    objects = [None, None] # the catalog and the outline come first
+    def page_tree(first, count, parent):
+        """Add the node for count pages starting at first, return its id"""
+        objects.append(None)
+        objid = len(objects)
+        if count == 1:
+            objects[objid - 1] = "<< /Type /Page /Parent %i 0 R " \
+                                 "/MediaBox [0 0 612 792] >>" % parent
+            return objid
+        step = max(1, -(-count // fanout))
+        kids = [page_tree(start, min(step, first + count - start), objid)
+                for start in xrange(first, first + count, step)]
+        objects[objid - 1] = "<< /Type /Pages %s/Kids [%s] /Count %i >>" \
+                             % (parent and "/Parent %i 0 R " % parent or "",
+                                " ".join(["%i 0 R" % kid for kid in kids]),
+                                count)
+        return objid
+    page_tree(0, pages, 0)
+    leaves = [i + 1 for (i, obj) in enumerate(objects)
+              if obj and "/Type /Page " in obj]
+    first_item = len(objects) + 1
+    for i in xrange(bookmarks):
+        links = "/Parent 2 0 R"
+        if i > 0:
+            links += " /Prev %i 0 R" % (first_item + i - 1)
+        if i < bookmarks - 1:
+            links += " /Next %i 0 R" % (first_item + i + 1)
+        objects.append("<< /Title (Bookmark %i) %s /Dest [%i 0 R /Fit] >>"
+                       % (i, links, leaves[(i * 7919) % pages]))
+    objects[0] = "<< /Type /Catalog /Pages 3 0 R /Outlines 2 0 R >>"
+    objects[1] = "<< /Type /Outlines /First %i 0 R /Last %i 0 R /Count %i >>" \
+                 % (first_item, len(objects), bookmarks)
+    outfile = open(filename, "wb")
+    outfile.write("%PDF-1.4\n")
+    offsets = []
+    for (i, obj) in enumerate(objects):
+        offsets.append(outfile.tell())
+        outfile.write("%i 0 obj\n%s\nendobj\n" % (i + 1, obj))
+    xref = outfile.tell()
+    outfile.write("xref\n0 %i\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        outfile.write("%010i 00000 n \n" % offset)
+    outfile.write("trailer\n<< /Size %i /Root 1 0 R >>\nstartxref\n%i\n"
+                  "%%%%EOF\n" % (len(objects) + 1, xref))
+    outfile.close()
+
+
+def benchmark(name, function):
+    """Time the given function and print the result"""
+    start = time.time()
+    result = function()
+    print "%-30s %8.2f s   (%s)" % (name, time.time() - start, result)
+
+
+def codecs_lines(filename):
+    """Count the lines read by iterating over codecs.open"""
+    count = 0
+    infile = codecs.open(filename, "r", "utf-8")
+    for line in infile:
+        count += 1
+    infile.close()
+    return count
+
+
+def input_layer_lines(filename):
+    """Count the lines read through input_lines"""
+    count = 0
+    for line in input_lines(filename):
+        count += 1
+    return count
+
+
+def codecs_write(filename, pieces, times):
+    """Write the pieces the given number of times through codecs.open, one
+    call per piece"""
+    outfile = codecs.open(filename, "w", "utf-8")
+    for piece in repeat_pieces(pieces, times):
+        outfile.write(piece)
+    outfile.close()
+    return os.path.getsize(filename)
+
+
+def repeat_pieces(pieces, times):
+    """Yield the pieces the given number of times, without copying them"""
+    for i in xrange(times):
+        for piece in pieces:
+            yield piece
+
+
+def output_file_write(filename, pieces, times):
+    """Write the pieces the given number of times through an OutputFile, one
+    call per piece"""
+    outfile = OutputFile(filename)
+    for piece in repeat_pieces(pieces, times):
+        outfile.write(piece)
+    outfile.close()
+    return os.path.getsize(filename)
+
+
+# The character-by-character escapes that were used by the writers before the
+# table-driven codecs, as a reference for the escape benchmarks
+
+def loop_escape_pdftk(source):
+    """Escape source for pdftk, one character at a time"""
+    encoded = []
+    for character in source:
+        if (ord(character) < 32) or (ord(character) >= 127):
+            encoded.append("&#%s;" % ord(character))
+        else:
+            encoded.append(saxutils.escape(character, {'"':'&quot;'}))
+    return (''.join(encoded)).decode('utf-8')
+
+
+def loop_escape_djvused(source):
+    """Escape source for djvused, one character at a time"""
+    encoded = []
+    for character in source:
+        if (ord(character) < 32) or (ord(character) >= 127):
+            for byte in character.encode('utf8'):
+                encoded.append("\%03o" % ord(byte))
+        else:
+            if character == '"': character = r'\"'
+            if character == '\\': character = r'\\'
+            encoded.append(character)
+    return (''.join(encoded)).decode('utf-8')
+
+
+def loop_escape_csv(s):
+    """Escape s for csv, one character at a time"""
+    result = []
+    for c in s:
+        if (ord(c) < 32) or c in "\;\"'":
+            escaped_char = "\\" + (hex(ord(c))[-2:]).upper()
+            if escaped_char[1] not in string.hexdigits:
+                escaped_char = escaped_char[0] + "0" + escaped_char[-1]
+            result.append(escaped_char)
+        else:
+            result.append(c)
+    return ''.join(result)
+
+
+def loop_escape_latex(unistring):
+    """Escape unistring for LaTeX, one character at a time"""
+    return u''.join(_latex_special_chars.get(c, c) for c in unistring)
+
+
+def make_titles(count, cjk):
+    """Return a list of count titles that are mostly ASCII, or mostly CJK"""
+    if cjk:
+        template = u"\u7b2c%i\u7ae0 \u65e5\u672c\u8a9e\u306e\u6587\u5b57" \
+                   u"\u3068\u4e2d\u6587\u5b57\u7b26 (%i)"
+    else:
+        template = u"Chapter %i: Introduction to Bookmarks (part %i)"
+    titles = [template % (i, i % 7) for i in xrange(count)]
+    # a few titles with characters that actually have to be escaped
+    for i in xrange(0, count, 10):
+        titles[i] += u' & "quotes" $50_% {x}'
+    return titles
+
+
+def escape_all(function, titles):
+    """Apply function to all titles, return the total length of the results"""
+    return sum([len(function(title)) for title in titles])
+
+
+def pdf_write(root, filename):
+    """Add the bookmarks in root to the pdf file filename, return its size"""
+    write_pdf(root, filename, {'pdf': filename})
+    return os.path.getsize(filename)
+
+
+def djvu_write(root, filename):
+    """Add the bookmarks in root to a copy of normal.djvu in filename, return
+    its size"""
+    write_djvu(root, filename, {'djvu': 'normal.djvu'})
+    return os.path.getsize(filename)
+
+
+def render_repeatedly(root, filename, cache, times=3):
+    """Write root to filename in several formats, the given number of times,
+    with Bookmark.cache_rendered set to cache"""
+    Bookmark.cache_rendered = cache
+    try:
+        for i in xrange(times):
+            for writer in [write_xml, write_pdftk, write_csv, write_djvused,
+                           write_html]:
+                writer(root, filename)
+    finally:
+        Bookmark.cache_rendered = False
+    return times
+
+
+def main():
+    size = 500
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    handle, filename = tempfile.mkstemp(suffix=".pdftk")
+    os.close(handle)
+    try:
+        print "Generating %i MB of input in %s" % (size, filename)
+        make_input(filename, size * 1024 * 1024)
+        print "== Line input =="
+        benchmark("codecs.open iteration", lambda: codecs_lines(filename))
+        benchmark("input_lines", lambda: input_layer_lines(filename))
+        print "== Parsing =="
+        jobs = multiprocessing.cpu_count()
+        benchmark("read_pdftk", lambda: len(read_pdftk(filename)[0]))
+        benchmark("read_pdftk, %i jobs" % jobs,
+                  lambda: len(read_pdftk(filename, jobs=jobs)[0]))
+        print "== Output (one write per line) =="
+        # the lines of the first MB, written repeatedly, so that the
+        # output is as large as the input, but only a slice is in memory
+        pieces = []
+        length = 0
+        for line in input_lines(filename):
+            pieces.append(line)
+            length += len(line)
+            if length >= 1024 * 1024:
+                break
+        times = max(1, size * 1024 * 1024 // length)
+        benchmark("codecs.open",
+                  lambda: codecs_write(filename, pieces, times))
+        benchmark("OutputFile",
+                  lambda: output_file_write(filename, pieces, times))
+    finally:
+        os.remove(filename)
+    handle, filename = tempfile.mkstemp(suffix=".pdf")
+    os.close(handle)
+    try:
+        make_pdf(filename, 20000, 2000)
+        print "== Pdf outline (20000 pages, 2000 bookmarks) =="
+        for backend in ['pdfminer', 'native']:
+            benchmark("read_pdf, %s" % backend, lambda:
+                      len(read_pdf(filename, backend=backend)[0].children()))
+    finally:
+        os.remove(filename)
+    root = Bookmark()
+    for i in xrange(5000):
+        node = root.newchild()
+        node.title = u"Bookmark %i" % i
+        node.action = u'GoTo'
+        node.page = (i * 7919) % 20000 + 1
+    handle, filename = tempfile.mkstemp(suffix=".pdf")
+    os.close(handle)
+    try:
+        print "== Adding 5000 bookmarks to a pdf file (20000 pages) =="
+        for (kind, fanout) in [('balanced', 10), ('flat', 20000)]:
+            make_pdf(filename, 20000, 1, fanout)
+            benchmark("write_pdf, %s page tree" % kind,
+                      lambda: pdf_write(root, filename))
+    finally:
+        os.remove(filename)
+    root = Bookmark()
+    for i in xrange(2000):
+        node = root.newchild()
+        node.title = u"Bookmark %i" % i
+        node.action = u'GoTo'
+        node.page = i % 89 + 1
+    handle, filename = tempfile.mkstemp(suffix=".djvu")
+    os.close(handle)
+    try:
+        print "== Djvu outline (2000 bookmarks) =="
+        benchmark("write_djvu", lambda: djvu_write(root, filename))
+        benchmark("read_djvu",
+                  lambda: len(read_djvu(filename)[0].children()))
+    finally:
+        os.remove(filename)
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = [os.path.join(directory, "%i.pdf" % i) for i in xrange(50)]
+        for filename in filenames:
+            make_pdf(filename, 200, 20)
+        print "== Batch of pdf files (50 files) =="
+        benchmark("one process per file",
+                  lambda: len([filename for filename in filenames
+                               if subprocess.call([sys.executable,
+                                   "bmconverter.py", "--no-cache", "-f",
+                                   "-m", "pdf2xml", filename, os.devnull],
+                                   stderr=open(os.devnull, "w")) == 0]))
+        OutlineCache.enabled = False
+        benchmark("iter_pdf_batch",
+                  lambda: len([error for (name, records, messages, error)
+                               in iter_pdf_batch(filenames)
+                               if error is None]))
+        OutlineCache.enabled = True
+    finally:
+        shutil.rmtree(directory)
+    escapes = [('pdftk', loop_escape_pdftk, escape_pdftk),
+               ('djvused', loop_escape_djvused, escape_djvused),
+               ('csv', loop_escape_csv, escape_csv),
+               ('latex', loop_escape_latex, escape_latex)]
+    for (kind, cjk) in [('ASCII', False), ('CJK', True)]:
+        titles = make_titles(20000, cjk)
+        print "== Escapes (20000 mostly %s titles) ==" % kind
+        for (name, loop_escape, escape) in escapes:
+            benchmark("%s, per character" % name,
+                      lambda: escape_all(loop_escape, titles))
+            benchmark("escape_%s" % name, lambda: escape_all(escape, titles))
+    print "== Repeated rendering (20000 mostly CJK titles, 5 formats) =="
+    root = Bookmark()
+    for title in make_titles(20000, True):
+        node = root.newchild()
+        node.title = title
+        node.action = u'GoTo'
+        node.page = 1
+    handle, filename = tempfile.mkstemp()
+    os.close(handle)
+    try:
+        benchmark("without cache",
+                  lambda: render_repeatedly(root, filename, False))
+        benchmark("cache_rendered", lambda: render_repeatedly(root, filename,
+                                                              True))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -116,7 +116,63 @@ tests = [
     {'commands' : [ modificationtest ],
      'expected' :  'modificationtest.xml',
      'out'      :  'out.xml',
-     'cleanup'  :  ['out.xml', 'out.csv']}
+     'cleanup'  :  ['out.xml', 'out.csv']},
+     # pdf Tests
+     # 16
+    {'commands' : [ 'bmconverter.py -m xml2pdf --pdf normal_nobookmarks.pdf '
+                    'normal.in.xml out.pdf',
+                    'bmconverter.py -m pdf2xml out.pdf out.xml'],
+     'expected' :  'normal.via_pdf.xml',
+     'out'      :  'out.xml',
+     'cleanup'  :  ['out.pdf', 'out.xml']},
+     # 17
+    {'commands' : [ 'bmconverter.py --batch --ndjson out.ndjson normal.pdf '
+                    'missing.pdf pathological.pdf'],
+     'expected' :  'batch.ndjson',
+     'out'      :  'out.ndjson',
+     'cleanup'  :  ['out.ndjson']},
+     # 18
+    {'commands' : [ 'bmconverter.py -m pdf2xml malformed.pdf out.xml'],
+     'expected' :  'malformed.via_pdf.xml',
+     'out'      :  'out.xml',
+     'cleanup'  :  ['out.xml']},
+     # 19
+    {'commands' : [ 'bmconverter.py -m xml2pdf --pdf normal_nobookmarks.pdf '
+                    'nopage.in.xml out.pdf',
+                    'bmconverter.py -m pdf2xml out.pdf out.xml'],
+     'expected' :  'nopage.via_pdf.xml',
+     'out'      :  'out.xml',
+     'cleanup'  :  ['out.pdf', 'out.xml']},
+     # 20
+    {'commands' : [ 'bmconverter.py -m pdf2xml unicode.pdf out.xml'],
+     'expected' :  'unicode.via_pdf.xml',
+     'out'      :  'out.xml',
+     'cleanup'  :  ['out.xml']},
+     # djvu Tests
+     # 21
+    {'commands' : [ 'bmconverter.py -m djvu2xml normal.djvu out.xml'],
+     'expected' :  'normal.via_djvu.xml',
+     'out'      :  'out.xml',
+     'cleanup'  :  ['out.xml']},
+     # 22
+    {'commands' : [ 'bmconverter.py -m djvused2xml normal.djvused out.xml'],
+     'expected' :  'normal.via_djvu.xml',
+     'out'      :  'out.xml',
+     'cleanup'  :  ['out.xml']},
+     # 23
+    {'commands' : [ 'bmconverter.py -m xml2djvu --djvu pathological.djvu '
+                    'normal.in.xml out.djvu',
+                    'bmconverter.py -m djvu2xml out.djvu out.xml'],
+     'expected' :  'normal.via_djvu.xml',
+     'out'      :  'out.xml',
+     'cleanup'  :  ['out.djvu', 'out.xml']},
+     # latex Tests
+     # 24
+    {'commands' : [ 'bmconverter.py -m xml2latex latex.in.xml out.tex',
+                    'bmconverter.py -m latex2xml out.tex out.xml'],
+     'expected' :  'latex.in.xml',
+     'out'      :  'out.xml',
+     'cleanup'  :  ['out.tex', 'out.xml']}
 ]
 
 i = 0